@@ -1,19 +1,51 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse, ORJSONResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
 import asyncio
 import httpx
+import numpy as np
+import hashlib
+import base64
+import gzip
+import json
+import math
+import copy
+import time
+import random
+import re
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
+
+# Optional brotli support for precompressed static payloads
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# Optional orjson for fast serialization of large trip payloads
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # LLM Integration
 try:
@@ -30,16 +62,112 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Run explain() on hot queries at startup and warn about collection scans
+DB_INDEX_SELF_CHECK = os.environ.get('DB_INDEX_SELF_CHECK', 'false').lower() == 'true'
+
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', os.urandom(32).hex())
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 72
 
+# Password hashing: bcrypt work factor and size of the dedicated hashing pool
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+
+# Authenticated-user cache; TRUST_JWT_CLAIMS lets read-only endpoints skip the lookup entirely
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+TRUST_JWT_CLAIMS = os.environ.get('TRUST_JWT_CLAIMS', 'false').lower() == 'true'
+
+# Optional extended city/airport dataset: JSON list of CITIES_AIRPORTS-shaped entries
+CITY_DATA_FILE = os.environ.get('CITY_DATA_FILE')
+
+# Optional extra offline-planner data: JSON object of POI_DATA-shaped city entries
+POI_DATA_FILE = os.environ.get('POI_DATA_FILE')
+
+# Optional visa rules overriding the built-in defaults: {"<passport>": {"<destination>": "<rule>"}}
+VISA_DATA_FILE = os.environ.get('VISA_DATA_FILE')
+# Answer the trip visa section from the rules matrix instead of asking the LLM
+VISA_MATRIX_FOR_TRIPS = os.environ.get('VISA_MATRIX_FOR_TRIPS', 'true').lower() == 'true'
+
+# Opt-in orjson responses for large trip payloads (requires the orjson package)
+FAST_JSON = os.environ.get('FAST_JSON', 'false').lower() == 'true' and ORJSON_AVAILABLE
+
+# Cache lifetime for precompressed reference data (countries, currencies, ...)
+STATIC_CACHE_MAX_AGE = int(os.environ.get('STATIC_CACHE_MAX_AGE', 3600))
+
+# Trip cache configuration
+TRIP_CACHE_TTL_SECONDS = int(os.environ.get('TRIP_CACHE_TTL_SECONDS', 6 * 3600))
+TRIP_CACHE_MAX_ENTRIES = int(os.environ.get('TRIP_CACHE_MAX_ENTRIES', 512))
+TRIP_CACHE_SHARED = os.environ.get('TRIP_CACHE_SHARED', 'false').lower() == 'true'
+TRIP_CACHE_BUDGET_STEP = float(os.environ.get('TRIP_CACHE_BUDGET_STEP', 0.1))
+
+# Saved trips re-denominated into another currency
+CONVERTED_TRIP_CACHE_MAX_ENTRIES = int(os.environ.get('CONVERTED_TRIP_CACHE_MAX_ENTRIES', 1024))
+CONVERTED_TRIP_CACHE_TTL_SECONDS = int(os.environ.get('CONVERTED_TRIP_CACHE_TTL_SECONDS', 3600))
+
+# "document" stores each trip whole; "split" stores a header plus one document per itinerary day
+TRIP_STORAGE_MODE = os.environ.get('TRIP_STORAGE_MODE', 'document')
+
+# Near-duplicate reuse: adapt a past generation with the same route and duration instead of calling the LLM
+TRIP_REUSE_ENABLED = os.environ.get('TRIP_REUSE_ENABLED', 'true').lower() == 'true'
+TRIP_REUSE_MAX_ENTRIES = int(os.environ.get('TRIP_REUSE_MAX_ENTRIES', 5000))
+TRIP_REUSE_MIN_SIMILARITY = float(os.environ.get('TRIP_REUSE_MIN_SIMILARITY', 0.9))
+TRIP_REUSE_BUDGET_TOLERANCE = float(os.environ.get('TRIP_REUSE_BUDGET_TOLERANCE', 0.1))
+TRIP_REUSE_MAX_DATE_SHIFT_DAYS = int(os.environ.get('TRIP_REUSE_MAX_DATE_SHIFT_DAYS', 45))
+
+# LLM client: provider ("auto", "emergent", "openai" for an OpenAI-compatible LLM_BASE_URL, "stub"), deadlines, retries, breaker
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'auto')
+LLM_BASE_URL = os.environ.get('LLM_BASE_URL')
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt-4o')
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', 90))
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 16))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BASE_DELAY = float(os.environ.get('LLM_RETRY_BASE_DELAY', 0.5))
+LLM_RETRY_BUDGET_RATIO = float(os.environ.get('LLM_RETRY_BUDGET_RATIO', 0.1))
+LLM_RETRY_BUDGET_MIN = float(os.environ.get('LLM_RETRY_BUDGET_MIN', 10))
+LLM_BREAKER_THRESHOLD = int(os.environ.get('LLM_BREAKER_THRESHOLD', 5))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', 30))
+
+# Prompts: compact field:type schema instead of example JSON; larger estimated outputs are fanned out
+PROMPT_COMPACT_SCHEMA = os.environ.get('PROMPT_COMPACT_SCHEMA', 'true').lower() == 'true'
+LLM_MAX_OUTPUT_TOKENS = int(os.environ.get('LLM_MAX_OUTPUT_TOKENS', 12000))
+
+# Stub LLM for offline load tests: time-to-first-token distribution, token rate, corruption and failure rates
+LLM_STUB_LATENCY = os.environ.get('LLM_STUB_LATENCY', 'lognormal:2.0:0.5')
+LLM_STUB_TOKENS_PER_SECOND = float(os.environ.get('LLM_STUB_TOKENS_PER_SECOND', 80))
+LLM_STUB_MALFORMED_RATE = float(os.environ.get('LLM_STUB_MALFORMED_RATE', 0))
+LLM_STUB_FAILURE_RATE = float(os.environ.get('LLM_STUB_FAILURE_RATE', 0))
+LLM_STUB_SEED = int(os.environ.get('LLM_STUB_SEED', 0))
+
+# Packing checklist engine: extra JSON rules (PACKING_RULES-shaped) and memoized result count
+PACKING_RULES_FILE = os.environ.get('PACKING_RULES_FILE')
+PACKING_CACHE_MAX_ENTRIES = int(os.environ.get('PACKING_CACHE_MAX_ENTRIES', 4096))
+
+# Schedule the itinerary with the offline planner and have the LLM only add tips and the other sections
+TRIP_SKELETON_ENRICH = os.environ.get('TRIP_SKELETON_ENRICH', 'false').lower() == 'true'
+
+# Fit generated trips to their budget and reconcile total_estimated_cost with the itemized costs
+TRIP_BUDGET_OPTIMIZE = os.environ.get('TRIP_BUDGET_OPTIMIZE', 'true').lower() == 'true'
+
+# Parallel planning for long / multi-city trips
+TRIP_FANOUT_MIN_DAYS = int(os.environ.get('TRIP_FANOUT_MIN_DAYS', 10))
+TRIP_FANOUT_MIN_DESTINATIONS = int(os.environ.get('TRIP_FANOUT_MIN_DESTINATIONS', 3))
+TRIP_FANOUT_DAY_WINDOW = int(os.environ.get('TRIP_FANOUT_DAY_WINDOW', 5))
+TRIP_FANOUT_CONCURRENCY = int(os.environ.get('TRIP_FANOUT_CONCURRENCY', 4))
+
+# Background trip generation jobs
+TRIP_JOB_WORKERS = int(os.environ.get('TRIP_JOB_WORKERS', 4))
+TRIP_JOB_QUEUE_MAX = int(os.environ.get('TRIP_JOB_QUEUE_MAX', 1000))
+# A job "running" longer than this is assumed abandoned by a dead process and re-queued at startup
+TRIP_JOB_STALE_SECONDS = float(os.environ.get('TRIP_JOB_STALE_SECONDS', 900))
+
 # Create the main app
 app = FastAPI(title="Odyssey API", description="AI-Powered Travel Planning by Ajay Reddy Gopu")
 
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", default_response_class=ORJSONResponse if FAST_JSON else JSONResponse)
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -144,14 +272,20 @@ CURRENCIES = [
     {"code": "SAR", "symbol": "﷼", "name": "Saudi Riyal", "rate": 3.75}
 ]
 
+# O(1) rate lookup by currency code
+CURRENCY_RATES = {c["code"]: c["rate"] for c in CURRENCIES}
+
+# Batches at least this large are converted with NumPy
+CURRENCY_VECTORIZE_MIN = 64
+
 # Cities and Airports Database
 CITIES_AIRPORTS = [
-    {"city": "New York", "country": "United States", "code": "US", "airports": [
+    {"city": "New York", "country": "United States", "code": "US", "alternate_names": ["NYC", "New York City", "Manhattan"], "airports": [
         {"code": "JFK", "name": "John F. Kennedy International", "type": "international"},
         {"code": "EWR", "name": "Newark Liberty International", "type": "international"},
         {"code": "LGA", "name": "LaGuardia", "type": "domestic"}
     ]},
-    {"city": "Los Angeles", "country": "United States", "code": "US", "airports": [
+    {"city": "Los Angeles", "country": "United States", "code": "US", "alternate_names": ["LA"], "airports": [
         {"code": "LAX", "name": "Los Angeles International", "type": "international"},
         {"code": "BUR", "name": "Hollywood Burbank", "type": "domestic"},
         {"code": "SNA", "name": "John Wayne Airport", "type": "domestic"}
@@ -177,13 +311,13 @@ CITIES_AIRPORTS = [
     {"city": "Singapore", "country": "Singapore", "code": "SG", "airports": [
         {"code": "SIN", "name": "Changi Airport", "type": "international"}
     ]},
-    {"city": "Mumbai", "country": "India", "code": "IN", "airports": [
+    {"city": "Mumbai", "country": "India", "code": "IN", "alternate_names": ["Bombay"], "airports": [
         {"code": "BOM", "name": "Chhatrapati Shivaji Maharaj International", "type": "international"}
     ]},
-    {"city": "Delhi", "country": "India", "code": "IN", "airports": [
+    {"city": "Delhi", "country": "India", "code": "IN", "alternate_names": ["New Delhi"], "airports": [
         {"code": "DEL", "name": "Indira Gandhi International", "type": "international"}
     ]},
-    {"city": "Bangkok", "country": "Thailand", "code": "TH", "airports": [
+    {"city": "Bangkok", "country": "Thailand", "code": "TH", "alternate_names": ["Krung Thep"], "airports": [
         {"code": "BKK", "name": "Suvarnabhumi", "type": "international"},
         {"code": "DMK", "name": "Don Mueang", "type": "budget"}
     ]},
@@ -193,7 +327,7 @@ CITIES_AIRPORTS = [
     {"city": "Hong Kong", "country": "Hong Kong", "code": "HK", "airports": [
         {"code": "HKG", "name": "Hong Kong International", "type": "international"}
     ]},
-    {"city": "Rome", "country": "Italy", "code": "IT", "airports": [
+    {"city": "Rome", "country": "Italy", "code": "IT", "alternate_names": ["Roma"], "airports": [
         {"code": "FCO", "name": "Leonardo da Vinci–Fiumicino", "type": "international"},
         {"code": "CIA", "name": "Ciampino", "type": "budget"}
     ]},
@@ -210,27 +344,27 @@ CITIES_AIRPORTS = [
         {"code": "YYZ", "name": "Toronto Pearson International", "type": "international"},
         {"code": "YTZ", "name": "Billy Bishop Toronto City", "type": "domestic"}
     ]},
-    {"city": "Seoul", "country": "South Korea", "code": "KR", "airports": [
+    {"city": "Seoul", "country": "South Korea", "code": "KR", "alternate_names": ["Seoul-si"], "airports": [
         {"code": "ICN", "name": "Incheon International", "type": "international"},
         {"code": "GMP", "name": "Gimpo International", "type": "domestic"}
     ]},
-    {"city": "Istanbul", "country": "Turkey", "code": "TR", "airports": [
+    {"city": "Istanbul", "country": "Turkey", "code": "TR", "alternate_names": ["Constantinople"], "airports": [
         {"code": "IST", "name": "Istanbul Airport", "type": "international"},
         {"code": "SAW", "name": "Sabiha Gökçen", "type": "international"}
     ]},
-    {"city": "Bali", "country": "Indonesia", "code": "ID", "airports": [
+    {"city": "Bali", "country": "Indonesia", "code": "ID", "alternate_names": ["Denpasar"], "airports": [
         {"code": "DPS", "name": "Ngurah Rai International", "type": "international"}
     ]},
-    {"city": "Maldives", "country": "Maldives", "code": "MV", "airports": [
+    {"city": "Maldives", "country": "Maldives", "code": "MV", "alternate_names": ["Male", "Malé"], "airports": [
         {"code": "MLE", "name": "Velana International", "type": "international"}
     ]},
-    {"city": "Santorini", "country": "Greece", "code": "GR", "airports": [
+    {"city": "Santorini", "country": "Greece", "code": "GR", "alternate_names": ["Thira"], "airports": [
         {"code": "JTR", "name": "Santorini Airport", "type": "international"}
     ]},
     {"city": "Phuket", "country": "Thailand", "code": "TH", "airports": [
         {"code": "HKT", "name": "Phuket International", "type": "international"}
     ]},
-    {"city": "Cancun", "country": "Mexico", "code": "MX", "airports": [
+    {"city": "Cancun", "country": "Mexico", "code": "MX", "alternate_names": ["Cancún"], "airports": [
         {"code": "CUN", "name": "Cancún International", "type": "international"}
     ]},
     {"city": "Miami", "country": "United States", "code": "US", "airports": [
@@ -239,6 +373,18 @@ CITIES_AIRPORTS = [
     ]}
 ]
 
+# Popular destinations shown on the landing page
+POPULAR_DESTINATIONS = [
+    {"name": "Paris, France", "image": "https://images.unsplash.com/photo-1502602898657-3e91760cbb34?w=800", "tagline": "City of Lights", "rating": 4.9},
+    {"name": "Tokyo, Japan", "image": "https://images.unsplash.com/photo-1540959733332-eab4deabeeaf?w=800", "tagline": "Where tradition meets future", "rating": 4.8},
+    {"name": "Bali, Indonesia", "image": "https://images.unsplash.com/photo-1537996194471-e657df975ab4?w=800", "tagline": "Island of the Gods", "rating": 4.9},
+    {"name": "New York, USA", "image": "https://images.unsplash.com/photo-1496442226666-8d4d0e62e6e9?w=800", "tagline": "The city that never sleeps", "rating": 4.7},
+    {"name": "Santorini, Greece", "image": "https://images.unsplash.com/photo-1570077188670-e3a8d69ac5ff?w=800", "tagline": "Aegean gem", "rating": 4.9},
+    {"name": "Dubai, UAE", "image": "https://images.unsplash.com/photo-1512453979798-5ea266f8880c?w=800", "tagline": "Future reimagined", "rating": 4.8},
+    {"name": "Maldives", "image": "https://images.unsplash.com/photo-1514282401047-d79a71a590e8?w=800", "tagline": "Paradise on Earth", "rating": 4.9},
+    {"name": "Rome, Italy", "image": "https://images.unsplash.com/photo-1552832230-c0197dd311b5?w=800", "tagline": "Eternal City", "rating": 4.8}
+]
+
 # Travel Insurance Providers
 INSURANCE_PROVIDERS = [
     {"name": "World Nomads", "url": "https://www.worldnomads.com", "price_range": "$40-150", "coverage": "Comprehensive", "best_for": "Adventure travelers"},
@@ -269,6 +415,244 @@ BAGGAGE_INFO = {
     }
 }
 
+# Local POI / restaurant dataset for the offline planner, prices in USD per person.
+# POI: (name, area, preferred slot, hours, cost, weight, tags, description)
+# Restaurant: (name, area, cuisine, price range, cost per meal, must try, diet tags)
+POI_DATA = {
+    "Paris": {
+        "cost_index": 1.3, "weight": 10, "transit": ("Metro", 2.2), "humidity": 70,
+        "climate": ([8, 9, 13, 16, 20, 23, 25, 25, 21, 16, 11, 8], [3, 3, 5, 7, 11, 14, 16, 16, 13, 10, 6, 4]),
+        "pois": [
+            ("Louvre Museum", "1st arrondissement", "morning", 3, 22, 10, "art museums history culture", "The world's largest art museum, home of the Mona Lisa"),
+            ("Eiffel Tower", "Champ de Mars", "evening", 2, 30, 10, "architecture photography", "Summit views over Paris and the hourly sparkle after dark"),
+            ("Musée d'Orsay", "7th arrondissement", "afternoon", 2.5, 16, 8, "art museums", "Impressionist masterpieces in a Beaux-Arts railway station"),
+            ("Montmartre & Sacré-Cœur", "18th arrondissement", "morning", 3, 0, 8, "history religious photography local", "Artists' hilltop village crowned by the white basilica"),
+            ("Notre-Dame & Île de la Cité", "4th arrondissement", "morning", 2, 0, 7, "architecture history religious", "Gothic cathedral and the medieval heart of the city"),
+            ("Seine River Cruise", "Port de la Bourdonnais", "evening", 1.5, 18, 7, "photography relaxation", "Landmarks lit up along the river"),
+            ("Le Marais Walk", "3rd arrondissement", "afternoon", 2.5, 0, 6, "local shopping history food", "Mansions, boutiques and falafel in the old Jewish quarter"),
+            ("Palace of Versailles", "Versailles", "morning", 4, 21, 8, "history architecture art", "Royal palace, Hall of Mirrors and formal gardens"),
+            ("Luxembourg Gardens", "6th arrondissement", "afternoon", 1.5, 0, 5, "nature relaxation", "Tree-lined paths, fountains and the Senate palace"),
+            ("Moulin Rouge Show", "Pigalle", "evening", 2.5, 120, 5, "nightlife music", "The original cabaret revue")
+        ],
+        "restaurants": [
+            ("Le Comptoir du Relais", "Saint-Germain", "French bistro", "$$", 45, "Pâté en croûte", ""),
+            ("Breizh Café", "Le Marais", "Crêperie", "$", 20, "Buckwheat galette", "vegetarian"),
+            ("L'As du Fallafel", "Le Marais", "Middle Eastern", "$", 12, "Falafel pita", "vegetarian vegan kosher"),
+            ("Bouillon Chartier", "Grands Boulevards", "French", "$", 22, "Steak frites", "")
+        ]
+    },
+    "London": {
+        "cost_index": 1.4, "weight": 9, "transit": ("Tube", 4), "humidity": 75,
+        "climate": ([8, 9, 12, 15, 18, 21, 23, 23, 20, 16, 11, 9], [3, 3, 4, 6, 9, 12, 14, 14, 12, 9, 5, 3]),
+        "pois": [
+            ("British Museum", "Bloomsbury", "morning", 3, 0, 9, "history museums art culture", "Two million years of history, from the Rosetta Stone to the Parthenon sculptures"),
+            ("Tower of London", "Tower Hill", "morning", 3, 40, 9, "history architecture", "Norman fortress guarding the Crown Jewels"),
+            ("Westminster Abbey & Big Ben", "Westminster", "morning", 2, 35, 8, "history religious architecture", "Coronation church beside the Houses of Parliament"),
+            ("National Gallery", "Trafalgar Square", "afternoon", 2, 0, 7, "art museums", "Western European painting from Van Eyck to Van Gogh"),
+            ("Borough Market", "Southwark", "morning", 1.5, 15, 7, "food local", "London's oldest food market"),
+            ("Tate Modern & South Bank", "Bankside", "afternoon", 2.5, 0, 6, "art architecture", "Modern art in a former power station, then a riverside walk"),
+            ("London Eye", "South Bank", "evening", 1, 40, 6, "photography", "Slow-turning wheel with views across the Thames"),
+            ("West End Show", "Covent Garden", "evening", 3, 90, 7, "music nightlife culture", "A musical or play in Theatreland"),
+            ("Camden Market", "Camden", "afternoon", 2, 0, 5, "shopping local food", "Stalls, street food and canal-side music venues"),
+            ("Hyde Park & Kensington Gardens", "Kensington", "afternoon", 2, 0, 5, "nature relaxation", "Royal parkland, the Serpentine and Kensington Palace")
+        ],
+        "restaurants": [
+            ("Dishoom Covent Garden", "Covent Garden", "Indian", "$$", 35, "House black daal", "vegetarian halal"),
+            ("Rules", "Covent Garden", "British", "$$$", 75, "Steak and kidney pudding", ""),
+            ("Poppies Fish & Chips", "Spitalfields", "Fish and chips", "$", 20, "Cod and chips", "pescatarian"),
+            ("Mildreds Soho", "Soho", "Vegetarian", "$$", 30, "Sri Lankan curry", "vegetarian vegan gluten-free")
+        ]
+    },
+    "Rome": {
+        "cost_index": 1.1, "weight": 9, "transit": ("Metro & bus", 1.5), "humidity": 65,
+        "climate": ([12, 14, 16, 19, 24, 28, 31, 31, 27, 22, 16, 13], [3, 4, 6, 8, 12, 16, 18, 18, 15, 11, 7, 4]),
+        "pois": [
+            ("Colosseum & Roman Forum", "Monti", "morning", 3.5, 20, 10, "history architecture photography", "The amphitheatre and the civic heart of ancient Rome"),
+            ("Vatican Museums & Sistine Chapel", "Vatican City", "morning", 3.5, 25, 10, "art museums religious history", "Papal collections ending under Michelangelo's ceiling"),
+            ("St. Peter's Basilica", "Vatican City", "afternoon", 1.5, 0, 8, "religious architecture", "Renaissance basilica and dome climb"),
+            ("Pantheon", "Centro Storico", "afternoon", 1, 5, 7, "history architecture", "Best-preserved Roman temple with its open oculus"),
+            ("Trevi Fountain & Spanish Steps", "Centro Storico", "evening", 1.5, 0, 7, "photography architecture", "Baroque fountain and the famous staircase at dusk"),
+            ("Borghese Gallery", "Villa Borghese", "afternoon", 2, 17, 7, "art museums nature", "Bernini and Caravaggio in a park villa"),
+            ("Trastevere Evening Stroll", "Trastevere", "evening", 2.5, 0, 6, "local food nightlife", "Cobbled lanes, trattorias and piazza life"),
+            ("Campo de' Fiori Market", "Centro Storico", "morning", 1.5, 0, 5, "food local shopping", "Morning produce market in a lively square")
+        ],
+        "restaurants": [
+            ("Da Enzo al 29", "Trastevere", "Roman trattoria", "$$", 35, "Cacio e pepe", ""),
+            ("Roscioli Salumeria", "Centro Storico", "Italian", "$$$", 60, "Carbonara", ""),
+            ("Pizzarium Bonci", "Prati", "Pizza al taglio", "$", 12, "Potato pizza", "vegetarian"),
+            ("Ba'Ghetto", "Jewish Ghetto", "Roman-Jewish", "$$", 40, "Carciofi alla giudia", "kosher"),
+            ("Margutta RistorArte", "Spanish Steps", "Vegetarian", "$$", 40, "Seasonal tasting menu", "vegetarian vegan")
+        ]
+    },
+    "Tokyo": {
+        "cost_index": 1.1, "weight": 10, "transit": ("Metro", 2), "humidity": 65,
+        "climate": ([10, 10, 14, 19, 23, 26, 30, 31, 27, 22, 17, 12], [1, 2, 5, 10, 15, 19, 23, 24, 21, 15, 9, 4]),
+        "pois": [
+            ("Senso-ji Temple", "Asakusa", "morning", 2, 0, 9, "history religious culture photography", "Tokyo's oldest temple and the Nakamise shopping street"),
+            ("Meiji Shrine & Yoyogi Park", "Harajuku", "morning", 2, 0, 8, "religious nature culture", "Forested Shinto shrine next to the city's liveliest park"),
+            ("Tsukiji Outer Market", "Tsukiji", "morning", 2, 20, 8, "food local", "Breakfast sushi, tamagoyaki and market stalls"),
+            ("teamLab Planets", "Toyosu", "afternoon", 2, 30, 7, "art photography", "Immersive digital art you walk through barefoot"),
+            ("Shibuya Crossing & Shibuya Sky", "Shibuya", "evening", 2, 17, 8, "photography nightlife architecture", "The scramble crossing seen from a rooftop deck"),
+            ("Tokyo National Museum", "Ueno", "afternoon", 2.5, 8, 6, "history art museums", "Japan's largest collection of national treasures"),
+            ("Akihabara", "Akihabara", "afternoon", 2.5, 0, 5, "shopping local", "Electronics, anime and retro game shops"),
+            ("Shinjuku Golden Gai", "Shinjuku", "evening", 2.5, 35, 6, "nightlife food local", "Alleys of tiny bars, each seating a handful of guests")
+        ],
+        "restaurants": [
+            ("Ichiran Shibuya", "Shibuya", "Ramen", "$", 15, "Tonkotsu ramen", ""),
+            ("Sushi Dai", "Toyosu Market", "Sushi", "$$", 45, "Omakase set", "pescatarian gluten-free"),
+            ("T's TanTan", "Tokyo Station", "Vegan ramen", "$", 14, "Vegan tantan ramen", "vegetarian vegan"),
+            ("Naritaya", "Asakusa", "Halal ramen", "$", 12, "Chicken ramen", "halal"),
+            ("Gonpachi Nishi-Azabu", "Nishi-Azabu", "Izakaya", "$$", 40, "Yakitori", "")
+        ]
+    },
+    "New York": {
+        "cost_index": 1.5, "weight": 10, "transit": ("Subway", 2.9), "humidity": 63,
+        "climate": ([4, 6, 10, 17, 22, 27, 29, 29, 25, 18, 12, 6], [-3, -2, 2, 8, 13, 18, 21, 21, 17, 10, 5, 0]),
+        "pois": [
+            ("Metropolitan Museum of Art", "Upper East Side", "morning", 3, 30, 9, "art museums history", "Five thousand years of art on Fifth Avenue"),
+            ("Central Park", "Manhattan", "afternoon", 2, 0, 8, "nature relaxation photography", "Bethesda Terrace, Bow Bridge and Strawberry Fields"),
+            ("Statue of Liberty & Ellis Island", "Battery Park", "morning", 4, 25, 9, "history photography", "Ferry to Lady Liberty and the immigration museum"),
+            ("9/11 Memorial & Museum", "Financial District", "afternoon", 2, 33, 7, "history museums", "Reflecting pools and the story of September 11"),
+            ("Top of the Rock", "Midtown", "evening", 1, 40, 7, "photography architecture", "Skyline views with the Empire State Building in frame"),
+            ("Broadway Show", "Theater District", "evening", 3, 130, 8, "music nightlife culture", "A musical on the Great White Way"),
+            ("High Line & Chelsea Market", "Chelsea", "afternoon", 2, 0, 7, "food nature local shopping", "Elevated park walk ending at a food hall"),
+            ("Brooklyn Bridge & DUMBO", "DUMBO", "morning", 2, 0, 7, "photography architecture local", "Walk the bridge into Brooklyn's waterfront"),
+            ("Museum of Modern Art", "Midtown", "afternoon", 2.5, 30, 6, "art museums", "Van Gogh, Warhol and modern design")
+        ],
+        "restaurants": [
+            ("Katz's Delicatessen", "Lower East Side", "Deli", "$$", 30, "Pastrami on rye", ""),
+            ("Joe's Pizza", "Greenwich Village", "Pizza", "$", 8, "Plain slice", "vegetarian"),
+            ("The Halal Guys", "Midtown", "Halal street food", "$", 12, "Chicken over rice", "halal"),
+            ("Superiority Burger", "East Village", "Vegetarian", "$", 18, "Superiority burger", "vegetarian vegan"),
+            ("Le Bernardin", "Midtown", "Seafood fine dining", "$$$", 200, "Tasting menu", "pescatarian")
+        ]
+    },
+    "Dubai": {
+        "cost_index": 1.2, "weight": 7, "transit": ("Metro", 2), "humidity": 60,
+        "climate": ([24, 25, 29, 33, 37, 39, 41, 41, 38, 35, 30, 26], [14, 15, 18, 21, 25, 27, 30, 30, 27, 23, 19, 16]),
+        "pois": [
+            ("Burj Khalifa At the Top", "Downtown", "evening", 1.5, 45, 9, "architecture photography", "Observation decks on the world's tallest building"),
+            ("Dubai Mall & Fountain Show", "Downtown", "evening", 2, 0, 8, "shopping photography", "Mega-mall, aquarium and the choreographed fountains"),
+            ("Desert Safari", "Al Marmoom Desert", "afternoon", 4, 70, 8, "adventure nature photography", "Dune drive, sunset camp and barbecue"),
+            ("Al Fahidi Historical District", "Bur Dubai", "morning", 2, 0, 6, "history culture", "Wind-tower houses and the Dubai Museum"),
+            ("Gold & Spice Souks by Abra", "Deira", "morning", 2, 1, 7, "shopping local food", "Cross the creek by boat to the traditional markets"),
+            ("Jumeirah Mosque", "Jumeirah", "morning", 1.5, 10, 5, "religious architecture culture", "Guided visit open to non-Muslims"),
+            ("Jumeirah Beach", "Jumeirah", "afternoon", 3, 0, 6, "beach relaxation", "White sand with Burj Al Arab views"),
+            ("Museum of the Future", "Trade Centre", "afternoon", 2, 40, 6, "museums architecture", "Speculative exhibits in a calligraphy-clad torus")
+        ],
+        "restaurants": [
+            ("Al Ustad Special Kebab", "Bur Dubai", "Persian", "$", 12, "Kebab", "halal"),
+            ("Arabian Tea House", "Al Fahidi", "Emirati", "$$", 25, "Emirati breakfast", "halal vegetarian"),
+            ("Ravi Restaurant", "Satwa", "Pakistani", "$", 8, "Chicken karahi", "halal"),
+            ("Pierchic", "Jumeirah", "Seafood", "$$$", 120, "Seafood platter", "halal pescatarian")
+        ]
+    },
+    "Bali": {
+        "cost_index": 0.5, "weight": 8, "transit": ("Private driver", 12), "humidity": 80,
+        "climate": ([30, 30, 31, 31, 31, 30, 29, 30, 30, 31, 31, 30], [24, 24, 24, 24, 24, 23, 23, 23, 23, 24, 24, 24]),
+        "pois": [
+            ("Tegallalang Rice Terraces", "Ubud", "morning", 2, 5, 8, "nature photography", "Emerald terraces irrigated by the subak system"),
+            ("Sacred Monkey Forest Sanctuary", "Ubud", "morning", 1.5, 6, 7, "nature wildlife religious", "Temple forest home to long-tailed macaques"),
+            ("Uluwatu Temple & Kecak Dance", "Uluwatu", "evening", 2.5, 12, 9, "religious culture music photography", "Clifftop temple and fire dance at sunset"),
+            ("Tanah Lot Temple", "Tabanan", "evening", 2, 4, 8, "religious photography", "Sea temple on a rock, best at sunset"),
+            ("Mount Batur Sunrise Trek", "Kintamani", "morning", 4, 45, 7, "adventure nature hiking photography", "Pre-dawn climb to watch sunrise over the caldera"),
+            ("Seminyak Beach", "Seminyak", "afternoon", 3, 0, 6, "beach relaxation nightlife", "Surf, sunbeds and beach clubs"),
+            ("Balinese Spa Treatment", "Ubud", "afternoon", 2, 25, 6, "wellness relaxation", "Traditional massage and flower bath"),
+            ("Ubud Art Market", "Ubud", "afternoon", 1.5, 0, 5, "shopping art local", "Handicrafts, sarongs and woodcarvings"),
+            ("Tirta Empul Water Temple", "Tampaksiring", "morning", 2, 4, 6, "religious culture", "Holy spring purification pools")
+        ],
+        "restaurants": [
+            ("Warung Babi Guling Ibu Oka", "Ubud", "Balinese", "$", 6, "Babi guling", ""),
+            ("Sari Organik", "Ubud", "Organic", "$", 10, "Nasi campur", "vegetarian vegan gluten-free"),
+            ("Jimbaran Bay Seafood", "Jimbaran", "Seafood", "$$", 25, "Grilled fish", "pescatarian halal"),
+            ("Warung Nasi Ayam Ibu Oki", "Nusa Dua", "Indonesian", "$", 4, "Nasi ayam", "halal")
+        ]
+    },
+    "Bangkok": {
+        "cost_index": 0.5, "weight": 8, "transit": ("BTS Skytrain", 1.5), "humidity": 75,
+        "climate": ([32, 33, 34, 35, 34, 33, 33, 32, 32, 32, 32, 31], [22, 24, 25, 26, 26, 26, 25, 25, 25, 25, 24, 22]),
+        "pois": [
+            ("Grand Palace & Wat Phra Kaew", "Rattanakosin", "morning", 2.5, 15, 10, "history religious architecture", "Royal palace and the Emerald Buddha"),
+            ("Wat Pho", "Rattanakosin", "morning", 1.5, 9, 8, "religious history wellness", "Reclining Buddha and the birthplace of Thai massage"),
+            ("Wat Arun", "Thonburi", "afternoon", 1, 3, 7, "religious architecture photography", "Porcelain-studded temple across the river"),
+            ("Chatuchak Weekend Market", "Chatuchak", "morning", 3, 0, 6, "shopping local food", "Over fifteen thousand stalls"),
+            ("Chinatown Street Food", "Yaowarat", "evening", 2.5, 15, 8, "food local nightlife", "Neon-lit street food along Yaowarat Road"),
+            ("Chao Phraya Dinner Cruise", "Riverside", "evening", 2, 40, 5, "photography relaxation", "Temples and palaces lit up from the river"),
+            ("Jim Thompson House", "Pathum Wan", "afternoon", 1.5, 6, 5, "art history architecture", "Teak houses filled with Southeast Asian art"),
+            ("Lumpini Park", "Silom", "afternoon", 1.5, 0, 4, "nature relaxation", "Green lung with monitor lizards and paddle boats")
+        ],
+        "restaurants": [
+            ("Jay Fai", "Old Town", "Thai street food", "$$$", 40, "Crab omelette", "pescatarian"),
+            ("Thipsamai", "Old Town", "Thai", "$", 6, "Pad thai", ""),
+            ("Broccoli Revolution", "Sukhumvit", "Vegetarian", "$$", 12, "Quinoa burger", "vegetarian vegan"),
+            ("Home Cuisine Islamic Restaurant", "Bang Rak", "Thai Muslim", "$", 8, "Massaman curry", "halal")
+        ]
+    }
+}
+
+# Used for destinations without POI data; "{city}" is replaced with the destination name
+GENERIC_POI_PROFILE = {
+    "cost_index": 1.0, "weight": 5, "transit": ("Public transit", 3), "humidity": 60, "climate": None,
+    "pois": [
+        ("{city} Old Town Walk", "Old Town", "morning", 3, 0, 6, "history architecture local photography", "Self-guided walk through the historic center"),
+        ("{city} City Museum", "Museum District", "morning", 2.5, 15, 5, "history art museums culture", "The city's story from its origins to today"),
+        ("Central Market", "Market District", "morning", 2, 0, 5, "food local shopping", "Local produce, snacks and crafts"),
+        ("Parks & Gardens", "City Park", "afternoon", 2, 0, 4, "nature relaxation", "Green space for an unhurried afternoon"),
+        ("Food Tasting Tour", "Downtown", "afternoon", 3, 55, 5, "food local", "Guided tasting of regional specialties"),
+        ("Sunset Viewpoint", "Viewpoint", "evening", 1.5, 10, 5, "photography", "The best panorama in town at golden hour"),
+        ("Art Galleries", "Arts Quarter", "afternoon", 2, 10, 4, "art museums", "Contemporary and local artists"),
+        ("Evening Entertainment", "Downtown", "evening", 2.5, 40, 4, "nightlife music", "Live music or a local show"),
+        ("Countryside Day Trip", "Outskirts", "morning", 4, 60, 4, "nature adventure hiking photography", "Half-day excursion beyond the city"),
+        ("Shopping Streets", "Shopping District", "afternoon", 2, 0, 3, "shopping", "Boutiques and local brands"),
+        ("Spa & Wellness", "Spa District", "afternoon", 2, 70, 3, "wellness relaxation", "Massage and thermal pools"),
+        ("Beach & Waterfront", "Waterfront", "afternoon", 3, 0, 3, "beach relaxation nature", "Time by the water")
+    ],
+    "restaurants": [
+        ("Local Favourite", "Old Town", "Local", "$$", 25, "Regional specialty", ""),
+        ("Street Food Stalls", "Market District", "Street food", "$", 10, "Local snacks", "vegetarian"),
+        ("Garden Café", "City Park", "Vegetarian", "$$", 20, "Seasonal bowl", "vegetarian vegan gluten-free"),
+        ("Waterfront Seafood House", "Waterfront", "Seafood", "$$$", 45, "Catch of the day", "pescatarian gluten-free"),
+        ("Halal Grill House", "Downtown", "Grill", "$$", 22, "Mixed grill", "halal"),
+        ("Kosher Deli", "Downtown", "Deli", "$$", 22, "Salt beef sandwich", "kosher")
+    ]
+}
+
+# Fields needed to render dashboard trip cards
+TRIP_SUMMARY_PROJECTION = {
+    "_id": 0, "id": 1, "title": 1, "destinations": 1, "start_date": 1, "end_date": 1,
+    "total_days": 1, "budget": 1, "currency": 1, "status": 1, "created_at": 1
+}
+
+# Monetary fields of a trip document; "*" steps into every element of a list
+TRIP_MONEY_PATHS = [
+    ("budget",),
+    ("total_estimated_cost",),
+    ("visa_requirements", "*", "cost"),
+    ("flights", "*", "estimated_price"),
+    ("hotels", "*", "price_per_night"),
+    ("insurance_recommendations", "*", "price"),
+    ("itinerary", "*", "estimated_cost"),
+    ("itinerary", "*", "morning_activities", "*", "cost"),
+    ("itinerary", "*", "afternoon_activities", "*", "cost"),
+    ("itinerary", "*", "evening_activities", "*", "cost"),
+    ("itinerary", "*", "transportation", "*", "cost"),
+    ("itinerary", "*", "fitness_activities", "*", "cost")
+]
+
+# Cost fields priced for the whole party; flight fares stay per person and hotel rates per room-night
+PARTY_COST_PATHS = [
+    ("total_estimated_cost",),
+    ("itinerary", "*", "estimated_cost"),
+    ("itinerary", "*", "morning_activities", "*", "cost"),
+    ("itinerary", "*", "afternoon_activities", "*", "cost"),
+    ("itinerary", "*", "evening_activities", "*", "cost"),
+    ("itinerary", "*", "transportation", "*", "cost"),
+    ("itinerary", "*", "fitness_activities", "*", "cost")
+]
+
+# Bumped whenever the rate table changes so cached conversions are never served stale
+CURRENCY_RATES_VERSION = hashlib.sha256(json.dumps(CURRENCY_RATES, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
 # ==================== MODELS ====================
 
 class UserCreate(BaseModel):
@@ -337,6 +721,27 @@ class TripRequest(BaseModel):
     need_insurance: bool = True
     cabin_class: str = "economy"
 
+class CurrencyBatchRequest(BaseModel):
+    to_curr: str
+    from_curr: Optional[str] = None
+    amounts: Optional[List[float]] = None
+    trip: Optional[Dict[str, Any]] = None
+
+class VisaBatchRequest(BaseModel):
+    passport_countries: List[str]
+    destination_countries: List[str]
+
+class TripRebalanceRequest(BaseModel):
+    budget: Optional[float] = None
+    food_preferences: Optional[str] = None
+    accommodation_type: Optional[str] = None
+
+class TripEditRequest(BaseModel):
+    instructions: Optional[str] = None
+    interests: Optional[List[str]] = None
+    food_preferences: Optional[str] = None
+    accommodation_type: Optional[str] = None
+
 class ContactForm(BaseModel):
     name: str
     email: EmailStr
@@ -346,42 +751,305 @@ class ContactForm(BaseModel):
 class NewsletterSubscribe(BaseModel):
     email: EmailStr
 
+# ==================== JSON ====================
+
+def loads_json(text: str) -> Any:
+    return orjson.loads(text) if ORJSON_AVAILABLE else json.loads(text)
+
+def dumps_json(content: Any) -> bytes:
+    """Deterministic (sorted keys) JSON bytes, used for hashing and ETags"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content, option=orjson.OPT_SORT_KEYS, default=str)
+    return json.dumps(content, sort_keys=True, default=str).encode("utf-8")
+
+def trip_response(content: Any, headers: Optional[Dict[str, str]] = None):
+    """Return large trip payloads via orjson directly, skipping jsonable_encoder, when FAST_JSON is on"""
+    if FAST_JSON:
+        return ORJSONResponse(content, headers=headers)
+    if headers:
+        return JSONResponse(jsonable_encoder(content), headers=headers)
+    return content
+
+def repair_llm_json(text: str) -> Tuple[Any, int]:
+    """Leniently parse model output: skip surrounding prose and fences, drop trailing commas and close truncated output.
+
+    Returns the value and how many containers were still open where the text was cut (0 when it was complete).
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError("No JSON value found")
+    out = []
+    stack = []
+    # Length of the output and the open containers at the last point where every value so far was complete
+    safe = None
+    in_string = False
+    escape = False
+    for c in text[min(starts):]:
+        if in_string:
+            out.append(c)
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c in "}]":
+            if not stack:
+                break
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            stack.pop()
+            out.append(c)
+            if not stack:
+                return loads_json("".join(out)), 0
+            safe = (len(out), stack.copy())
+            continue
+        if c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append(c)
+        elif c == ",":
+            safe = (len(out), stack.copy())
+        out.append(c)
+    if safe is None:
+        raise ValueError("No complete JSON value found")
+    length, open_containers = safe
+    closers = "".join("}" if opener == "{" else "]" for opener in reversed(open_containers))
+    return loads_json("".join(out[:length]).rstrip() + closers), len(open_containers)
+
+# ==================== CACHING ====================
+
+class TTLCache:
+    """Small in-process LRU cache with per-entry expiry"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._entries[key] = (time.time() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        for key in [k for k in self._entries if predicate(k)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
 # ==================== AUTH HELPERS ====================
 
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_token(user_id: str, email: str) -> str:
+def password_needs_rehash(hashed: str) -> bool:
+    """True when a stored bcrypt hash was made with a different work factor"""
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated, size-limited thread pool so it never blocks the event loop"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+
+    def _timed(self, fn, submitted_at: float, *args):
+        started = time.perf_counter()
+        wait = started - submitted_at
+        self.queued -= 1
+        self.active += 1
+        try:
+            return fn(*args)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self.total_wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.total_run_seconds += time.perf_counter() - started
+
+    async def run(self, fn, *args):
+        self.queued += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._timed, fn, time.perf_counter(), *args)
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self.run(verify_password, password, hashed)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "rounds": BCRYPT_ROUNDS,
+            "queued": self.queued,
+            "active": self.active,
+            "completed": self.completed,
+            "avg_wait_ms": round(self.total_wait_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+            "avg_run_ms": round(self.total_run_seconds / self.completed * 1000, 2) if self.completed else 0.0
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS)
+
+user_cache = TTLCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+
+def create_token(user_id: str, email: str, name: Optional[str] = None, created_at: Optional[str] = None) -> str:
     payload = {
         "user_id": user_id,
         "email": email,
         "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS),
         "iat": datetime.now(timezone.utc)
     }
+    # Profile claims let read-only endpoints skip the user lookup when TRUST_JWT_CLAIMS is on
+    if name is not None:
+        payload["name"] = name
+    if created_at is not None:
+        payload["created_at"] = created_at
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def decode_token(credentials: HTTPAuthorizationCredentials) -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        return jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def load_user(user_id: str) -> dict:
+    """Fetch a user (without password hash) through the short-TTL user cache"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        user_cache.set(user_id, user)
+    return user
+
+def invalidate_user(user_id: str):
+    """Call after any write to a user document"""
+    user_cache.delete(user_id)
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = decode_token(credentials)
+    return await load_user(payload["user_id"])
+
+async def get_current_user_readonly(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Like get_current_user, but may trust signed token claims instead of reading the user"""
+    payload = decode_token(credentials)
+    if TRUST_JWT_CLAIMS and "name" in payload and "created_at" in payload:
+        return {
+            "id": payload["user_id"],
+            "email": payload["email"],
+            "name": payload["name"],
+            "created_at": payload["created_at"]
+        }
+    return await load_user(payload["user_id"])
+
+async def get_optional_user_id(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> Optional[str]:
+    """User id from the bearer token when one is sent; anonymous callers get None"""
+    return decode_token(credentials)["user_id"] if credentials else None
+
 def convert_currency(amount: float, from_currency: str, to_currency: str) -> float:
     """Convert amount between currencies"""
-    from_rate = next((c["rate"] for c in CURRENCIES if c["code"] == from_currency), 1.0)
-    to_rate = next((c["rate"] for c in CURRENCIES if c["code"] == to_currency), 1.0)
+    from_rate = CURRENCY_RATES.get(from_currency, 1.0)
+    to_rate = CURRENCY_RATES.get(to_currency, 1.0)
     usd_amount = amount / from_rate
     return round(usd_amount * to_rate, 2)
 
+def convert_amounts(amounts: List[float], from_currency: str, to_currency: str) -> List[float]:
+    """Convert many amounts at once, vectorized with NumPy for large batches"""
+    from_rate = CURRENCY_RATES.get(from_currency, 1.0)
+    to_rate = CURRENCY_RATES.get(to_currency, 1.0)
+    if len(amounts) < CURRENCY_VECTORIZE_MIN:
+        return [round(amount / from_rate * to_rate, 2) for amount in amounts]
+    values = np.asarray(amounts, dtype=np.float64)
+    return np.round(values / from_rate * to_rate, 2).tolist()
+
+def compile_field_paths(paths: List[tuple]) -> dict:
+    """Merge field paths into a tree so shared prefixes are walked only once"""
+    tree: Dict[str, Any] = {}
+    for path in paths:
+        node = tree
+        for step in path[:-1]:
+            node = node.setdefault(step, {})
+        node.setdefault(None, []).append(path[-1])
+    return tree
+
+def collect_money_fields(trip: dict, tree: Optional[dict] = None) -> List[tuple]:
+    """Return (container, key) references for every numeric cost field in a trip document"""
+    refs = []
+
+    def walk(node, tree: dict):
+        if isinstance(node, list):
+            if "*" in tree:
+                for item in node:
+                    walk(item, tree["*"])
+            return
+        if not isinstance(node, dict):
+            return
+        for key in tree.get(None, ()):
+            value = node.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                refs.append((node, key))
+        for step, subtree in tree.items():
+            if step not in (None, "*") and step in node:
+                walk(node[step], subtree)
+
+    walk(trip, tree or TRIP_MONEY_TREE)
+    return refs
+
+TRIP_MONEY_TREE = compile_field_paths(TRIP_MONEY_PATHS)
+PARTY_COST_TREE = compile_field_paths(PARTY_COST_PATHS)
+
+def convert_trip_currency(trip: dict, to_currency: str, from_currency: Optional[str] = None) -> dict:
+    """Return a copy of a trip document with every cost field converted to another currency"""
+    trip = copy.deepcopy(trip)
+    from_currency = from_currency or trip.get("currency") or "USD"
+    refs = collect_money_fields(trip)
+    converted = convert_amounts([node[key] for node, key in refs], from_currency, to_currency)
+    for (node, key), value in zip(refs, converted):
+        node[key] = value
+    trip["currency"] = to_currency
+    return trip
+
 # ==================== AUTH ROUTES ====================
 
 @api_router.post("/auth/register", response_model=TokenResponse)
@@ -395,12 +1063,12 @@ async def register(user_data: UserCreate):
         "id": user_id,
         "email": user_data.email,
         "name": user_data.name,
-        "password": hash_password(user_data.password),
+        "password": await password_hasher.hash(user_data.password),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.users.insert_one(user_doc)
     
-    token = create_token(user_id, user_data.email)
+    token = create_token(user_id, user_data.email, user_data.name, user_doc["created_at"])
     return TokenResponse(
         token=token,
         user=UserResponse(id=user_id, email=user_data.email, name=user_data.name, created_at=user_doc["created_at"])
@@ -409,30 +1077,331 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await password_hasher.verify(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    token = create_token(user["id"], user["email"])
+    if password_needs_rehash(user["password"]):
+        new_hash = await password_hasher.hash(credentials.password)
+        await db.users.update_one({"id": user["id"]}, {"$set": {"password": new_hash}})
+        invalidate_user(user["id"])
+    
+    token = create_token(user["id"], user["email"], user["name"], user["created_at"])
     return TokenResponse(
         token=token,
         user=UserResponse(id=user["id"], email=user["email"], name=user["name"], created_at=user["created_at"])
     )
 
 @api_router.get("/auth/me", response_model=UserResponse)
-async def get_me(current_user: dict = Depends(get_current_user)):
+async def get_me(current_user: dict = Depends(get_current_user_readonly)):
     return UserResponse(**{k: current_user[k] for k in ["id", "email", "name", "created_at"]})
 
+# ==================== CITY SEARCH INDEX ====================
+
+def fold_text(value: str) -> str:
+    """Lowercase, strip accents and collapse whitespace for search matching"""
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.lower().replace("-", " ").replace("–", " ").split())
+
+class CityIndex:
+    """Prefix trie plus trigram index over cities, alternate names, countries and airports"""
+
+    # Match tiers, lower ranks first
+    CITY_PREFIX, AIRPORT_CODE, ALTERNATE_PREFIX, WORD_PREFIX = range(4)
+
+    def __init__(self, cities: List[dict], top_k: int = 50):
+        self.cities = cities
+        self.top_k = top_k
+        self.trie: Dict[str, Any] = {}
+        self.trigrams: Dict[str, set] = {}
+        self.by_name: Dict[str, dict] = {}
+        self.haystacks: List[str] = []
+        self._build()
+
+    def _popularity(self, idx: int) -> float:
+        # Curated lists are ordered by popularity; explicit scores win when present
+        return self.cities[idx].get("popularity", -idx)
+
+    def _insert(self, term: str, idx: int, tier: int):
+        # Every node keeps the best rank key per city below it under the "" slot
+        node = self.trie
+        key = (tier, -self._popularity(idx), idx)
+        for ch in term:
+            node = node.setdefault(ch, {})
+            best = node.setdefault("", {})
+            if idx not in best or key < best[idx]:
+                best[idx] = key
+
+    def _build(self):
+        for idx, city in enumerate(self.cities):
+            name = fold_text(city["city"])
+            alternates = [fold_text(a) for a in city.get("alternate_names", [])]
+            country = fold_text(city["country"])
+            airports = city.get("airports", [])
+
+            self.by_name.setdefault(name, city)
+            for alternate in alternates:
+                self.by_name.setdefault(alternate, city)
+
+            self._insert(name, idx, self.CITY_PREFIX)
+            for airport in airports:
+                self._insert(airport["code"].lower(), idx, self.AIRPORT_CODE)
+            for term in alternates + [country] + [fold_text(a["name"]) for a in airports]:
+                self._insert(term, idx, self.ALTERNATE_PREFIX)
+            for term in [name, country] + alternates:
+                words = term.split()
+                for pos in range(1, len(words)):
+                    self._insert(" ".join(words[pos:]), idx, self.WORD_PREFIX)
+
+            haystack = " | ".join([name, country] + alternates)
+            self.haystacks.append(haystack)
+            for pos in range(len(haystack) - 2):
+                self.trigrams.setdefault(haystack[pos:pos + 3], set()).add(idx)
+
+        self._finalize(self.trie)
+
+    def _finalize(self, node: dict):
+        # Collapse each node to its precomputed, ranked top-k city list
+        for ch, child in node.items():
+            if ch == "":
+                continue
+            ranked = sorted(child[""].values())[:self.top_k]
+            child[""] = [idx for _, _, idx in ranked]
+            self._finalize(child)
+
+    def search(self, query: str, limit: int = 15) -> List[dict]:
+        q = fold_text(query)
+        node = self.trie
+        for ch in q:
+            node = node.get(ch)
+            if node is None:
+                break
+        results = list(node[""]) if node is not None and node is not self.trie else []
+
+        if len(results) < limit and len(q) >= 3:
+            grams = [q[pos:pos + 3] for pos in range(len(q) - 2)]
+            candidate_sets = sorted((self.trigrams.get(g, set()) for g in grams), key=len)
+            candidates = set.intersection(*candidate_sets) if candidate_sets else set()
+            seen = set(results)
+            extra = [idx for idx in candidates if idx not in seen and q in self.haystacks[idx]]
+            extra.sort(key=lambda idx: (-self._popularity(idx), idx))
+            results.extend(extra)
+
+        return [self.cities[idx] for idx in results[:limit]]
+
+    def get(self, name: str) -> Optional[dict]:
+        return self.by_name.get(fold_text(name))
+
+if CITY_DATA_FILE:
+    with open(CITY_DATA_FILE, encoding="utf-8") as f:
+        CITIES_AIRPORTS.extend(json.load(f))
+
+city_index = CityIndex(CITIES_AIRPORTS)
+
+# ==================== STATIC PAYLOADS ====================
+
+class StaticPayload:
+    """JSON body serialized and compressed once, with a strong ETag per encoding"""
+
+    def __init__(self, content: Any):
+        body = json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {"identity": (body, f'"{digest}"')}
+        self.variants["gzip"] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gz"')
+        if BROTLI_AVAILABLE:
+            self.variants["br"] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+        self.etags = {etag for _, etag in self.variants.values()}
+
+def accepted_encodings(header: str) -> set:
+    """Content codings from an Accept-Encoding header, minus any refused with q=0"""
+    encodings = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip() and quality > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+def etag_matches(if_none_match: str, etags: set) -> bool:
+    """If-None-Match check: "*" or any listed tag, compared weakly (W/ prefixes ignored)"""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in etags:
+            return True
+    return False
+
+def static_response(request: Request, payload: StaticPayload) -> Response:
+    """Serve a precomputed payload: 304 on a matching ETag, otherwise the best precompressed variant"""
+    accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+    encoding = next((e for e in ("br", "gzip") if e in accepted and e in payload.variants), "identity")
+    body, etag = payload.variants[encoding]
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={STATIC_CACHE_MAX_AGE}",
+        "Vary": "Accept-Encoding"
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), payload.etags):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+STATIC_PAYLOADS = {
+    "countries": StaticPayload(COUNTRIES),
+    "currencies": StaticPayload(CURRENCIES),
+    "insurance_providers": StaticPayload(INSURANCE_PROVIDERS),
+    "destinations": StaticPayload(POPULAR_DESTINATIONS)
+}
+BAGGAGE_PAYLOADS = {cabin: StaticPayload(info) for cabin, info in BAGGAGE_INFO.items()}
+
+# ==================== VISA RULES ====================
+
+# Passports with visa-free access to most places
+STRONG_PASSPORTS = frozenset(["US", "GB", "DE", "FR", "JP", "KR", "SG", "AU", "CA", "NZ", "IE", "NL", "CH", "SE", "NO", "DK", "FI"])
+SCHENGEN_COUNTRIES = frozenset(["DE", "FR", "IT", "ES", "NL", "BE", "AT", "CH", "PT", "GR", "SE", "NO", "DK", "FI", "CZ", "HU", "PL"])
+# Non-Schengen destinations open to strong passports
+EASY_ENTRY_COUNTRIES = frozenset(["JP", "KR", "SG", "TH", "MY", "ID", "MX", "BR", "AR"])
+
+STRONG_PASSPORT_LINK = "https://www.google.com/search?q={destination}+visa+for+{passport}+passport"
+VISA_APPLICATION_LINK = "https://www.google.com/search?q={destination}+visa+application+{passport}"
+
+# Rule templates, indexed by the codes stored in the visa matrix
+VISA_RULES = [
+    {"visa_required": False, "type": "citizen", "notes": "No visa required - you are a citizen"},
+    {"visa_required": False, "type": "schengen_free", "notes": "Free movement within Schengen Area"},
+    {"visa_required": False, "type": "visa_free", "notes": "Strong passport - check specific requirements", "processing_time": "Varies", "apply_link": STRONG_PASSPORT_LINK},
+    {"visa_required": False, "type": "check_required", "notes": "Strong passport - check specific requirements", "processing_time": "Varies", "apply_link": STRONG_PASSPORT_LINK},
+    {"visa_required": True, "type": "check_required", "notes": "Strong passport - check specific requirements", "processing_time": "Varies", "apply_link": STRONG_PASSPORT_LINK},
+    {"visa_required": True, "type": "visa_required", "notes": "Visa likely required - check embassy website", "processing_time": "5-15 business days", "apply_link": VISA_APPLICATION_LINK},
+    {"visa_required": False, "type": "visa_free", "notes": "No visa required for short stays", "processing_time": "None"},
+    {"visa_required": True, "type": "visa_on_arrival", "notes": "Visa issued on arrival", "processing_time": "On arrival", "apply_link": VISA_APPLICATION_LINK},
+    {"visa_required": True, "type": "e_visa", "notes": "Apply online for an e-visa before travel", "processing_time": "1-5 business days", "apply_link": VISA_APPLICATION_LINK}
+]
+(VISA_CITIZEN, VISA_SCHENGEN_FREE, VISA_STRONG_FREE, VISA_STRONG_CHECK, VISA_STRONG_REQUIRED,
+ VISA_REQUIRED, VISA_FREE, VISA_ON_ARRIVAL, VISA_E_VISA) = range(len(VISA_RULES))
+
+# Rule names accepted in VISA_DATA_FILE
+VISA_DATA_RULES = {"visa_free": VISA_FREE, "visa_on_arrival": VISA_ON_ARRIVAL, "e_visa": VISA_E_VISA, "visa_required": VISA_REQUIRED}
+
+class VisaMatrix:
+    """Passport x destination rule codes compiled once into a uint8 matrix for O(1) lookups"""
+
+    def __init__(self, countries: List[str], overrides: Dict[str, Dict[str, str]]):
+        codes = set(countries) | STRONG_PASSPORTS | SCHENGEN_COUNTRIES | EASY_ENTRY_COUNTRIES | set(overrides)
+        for destinations in overrides.values():
+            codes.update(destinations)
+        self.codes = sorted(codes)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+
+        strong = np.array([code in STRONG_PASSPORTS for code in self.codes])
+        schengen = np.array([code in SCHENGEN_COUNTRIES for code in self.codes])
+        easy = np.array([code in EASY_ENTRY_COUNTRIES for code in self.codes])
+
+        # Built-in defaults, later rules taking precedence
+        strong_rule = np.where(schengen, VISA_STRONG_FREE, np.where(easy, VISA_STRONG_CHECK, VISA_STRONG_REQUIRED))
+        rules = np.where(strong[:, None], strong_rule[None, :], VISA_REQUIRED)
+        rules = np.where(schengen[:, None] & schengen[None, :], VISA_SCHENGEN_FREE, rules)
+        for passport, destinations in overrides.items():
+            for destination, rule in destinations.items():
+                rules[self.index[passport], self.index[destination]] = VISA_DATA_RULES[rule]
+        np.fill_diagonal(rules, VISA_CITIZEN)
+        self.rules = rules.astype(np.uint8)
+        # Destinations outside the matrix: strong passports still get the "check" rule
+        self.unknown_destination = np.where(strong, VISA_STRONG_REQUIRED, VISA_REQUIRED).astype(np.uint8)
+
+    def rule(self, passport: str, destination: str) -> int:
+        if passport == destination:
+            return VISA_CITIZEN
+        row = self.index.get(passport)
+        if row is None:
+            return VISA_REQUIRED
+        column = self.index.get(destination)
+        if column is None:
+            return int(self.unknown_destination[row])
+        return int(self.rules[row, column])
+
+    def describe(self, passport: str, destination: str) -> dict:
+        result = dict(VISA_RULES[self.rule(passport, destination)])
+        if "apply_link" in result:
+            result["apply_link"] = result["apply_link"].format(destination=destination, passport=passport)
+        return result
+
+    def batch(self, passports: List[str], destinations: List[str]) -> List[dict]:
+        return [
+            {"passport_country": passport, "destination_country": destination, **self.describe(passport, destination)}
+            for passport in passports
+            for destination in destinations
+        ]
+
+def load_visa_overrides() -> Dict[str, Dict[str, str]]:
+    """Optional VISA_DATA_FILE: {"IN": {"TH": "visa_on_arrival", ...}, ...} keyed by ISO country codes"""
+    if not VISA_DATA_FILE:
+        return {}
+    with open(VISA_DATA_FILE, encoding="utf-8") as f:
+        data = json.load(f)
+    for destinations in data.values():
+        for rule in destinations.values():
+            if rule not in VISA_DATA_RULES:
+                raise ValueError(f"Unknown visa rule in {VISA_DATA_FILE}: {rule}")
+    return {passport.upper(): {d.upper(): rule for d, rule in destinations.items()} for passport, destinations in data.items()}
+
+visa_matrix = VisaMatrix([c["code"] for c in COUNTRIES], load_visa_overrides())
+
+def destination_country_codes(destinations: List[str]) -> Optional[List[str]]:
+    """Country codes for trip destinations, or None if any city is unknown"""
+    codes = []
+    for name in destinations:
+        city = city_index.get(name)
+        if not city:
+            return None
+        if city["code"] not in codes:
+            codes.append(city["code"])
+    return codes
+
+def trip_visa_requirements(trip_request: TripRequest) -> Optional[List[dict]]:
+    """Visa section of a trip answered from the matrix, or None when a destination cannot be resolved"""
+    countries = destination_country_codes(trip_request.destinations)
+    if countries is None:
+        return None
+    names = {c["code"]: c["name"] for c in COUNTRIES}
+    requirements = []
+    for passport in trip_request.passport_countries:
+        for destination in countries:
+            rule = visa_matrix.describe(passport.upper(), destination)
+            requirements.append({
+                "country": names.get(destination, destination),
+                "passport_country": passport.upper(),
+                "visa_required": rule["visa_required"],
+                "type": rule["type"],
+                "processing_time": rule.get("processing_time", ""),
+                "cost": 0,
+                "notes": rule["notes"],
+                "apply_link": rule.get("apply_link", "")
+            })
+    return requirements
+
 # ==================== DATA ENDPOINTS ====================
 
 @api_router.get("/countries")
-async def get_countries():
+async def get_countries(request: Request):
     """Get all countries for passport selection"""
-    return COUNTRIES
+    return static_response(request, STATIC_PAYLOADS["countries"])
 
 @api_router.get("/currencies")
-async def get_currencies():
+async def get_currencies(request: Request):
     """Get all supported currencies with exchange rates"""
-    return CURRENCIES
+    return static_response(request, STATIC_PAYLOADS["currencies"])
 
 @api_router.get("/convert-currency")
 async def convert_currency_endpoint(amount: float, from_curr: str, to_curr: str):
@@ -440,76 +1409,306 @@ async def convert_currency_endpoint(amount: float, from_curr: str, to_curr: str)
     converted = convert_currency(amount, from_curr, to_curr)
     return {"original": amount, "from": from_curr, "to": to_curr, "converted": converted}
 
+@api_router.post("/convert-currency/batch")
+async def convert_currency_batch(batch: CurrencyBatchRequest):
+    """Convert a list of amounts and/or every cost field of a trip document in one call"""
+    if batch.amounts is None and batch.trip is None:
+        raise HTTPException(status_code=400, detail="Provide amounts or trip")
+    # Same check as GET /trips/{id}?currency=: unknown codes must not silently convert at 1.0
+    source = batch.from_curr or (batch.trip or {}).get("currency") or "USD"
+    if batch.to_curr not in CURRENCY_RATES or source not in CURRENCY_RATES:
+        raise HTTPException(status_code=400, detail="Unsupported currency")
+    result = {"to": batch.to_curr}
+    if batch.amounts is not None:
+        if not batch.from_curr:
+            raise HTTPException(status_code=400, detail="from_curr is required for amounts")
+        result["from"] = batch.from_curr
+        result["converted"] = convert_amounts(batch.amounts, batch.from_curr, batch.to_curr)
+    if batch.trip is not None:
+        result["trip"] = convert_trip_currency(batch.trip, batch.to_curr, batch.from_curr)
+    return result
+
 @api_router.get("/autocomplete/cities")
 async def autocomplete_cities(q: str = ""):
     """Autocomplete for cities with airports"""
     if len(q) < 2:
         return CITIES_AIRPORTS[:15]
-    
-    q_lower = q.lower()
-    matches = [
-        city for city in CITIES_AIRPORTS 
-        if q_lower in city["city"].lower() or q_lower in city["country"].lower()
-    ]
-    return matches[:15]
+    return city_index.search(q, limit=15)
 
 @api_router.get("/airports/{city}")
 async def get_city_airports(city: str):
     """Get all airports for a city"""
-    city_data = next((c for c in CITIES_AIRPORTS if c["city"].lower() == city.lower()), None)
+    city_data = city_index.get(city)
     if city_data:
         return city_data["airports"]
     return []
 
 @api_router.get("/insurance-providers")
-async def get_insurance_providers():
+async def get_insurance_providers(request: Request):
     """Get travel insurance providers"""
-    return INSURANCE_PROVIDERS
+    return static_response(request, STATIC_PAYLOADS["insurance_providers"])
 
 @api_router.get("/baggage-info/{cabin_class}")
-async def get_baggage_info(cabin_class: str):
+async def get_baggage_info(cabin_class: str, request: Request):
     """Get baggage allowance by cabin class"""
-    return BAGGAGE_INFO.get(cabin_class, BAGGAGE_INFO["economy"])
+    return static_response(request, BAGGAGE_PAYLOADS.get(cabin_class, BAGGAGE_PAYLOADS["economy"]))
 
 @api_router.get("/visa-requirements")
 async def get_visa_requirements(passport_country: str, destination_country: str):
     """Get visa requirements based on passport and destination"""
-    # This would ideally connect to a visa API, for now return smart defaults
-    # Strong passports (visa-free to most places)
-    strong_passports = ["US", "GB", "DE", "FR", "JP", "KR", "SG", "AU", "CA", "NZ", "IE", "NL", "CH", "SE", "NO", "DK", "FI"]
-    
-    # Schengen countries
-    schengen = ["DE", "FR", "IT", "ES", "NL", "BE", "AT", "CH", "PT", "GR", "SE", "NO", "DK", "FI", "CZ", "HU", "PL"]
-    
-    passport_strong = passport_country in strong_passports
-    dest_schengen = destination_country in schengen
-    passport_schengen = passport_country in schengen
-    
-    if passport_country == destination_country:
-        return {"visa_required": False, "type": "citizen", "notes": "No visa required - you are a citizen"}
-    
-    if passport_schengen and dest_schengen:
-        return {"visa_required": False, "type": "schengen_free", "notes": "Free movement within Schengen Area"}
-    
-    if passport_strong:
-        return {
-            "visa_required": False if destination_country in ["JP", "KR", "SG", "TH", "MY", "ID", "MX", "BR", "AR"] + schengen else True,
-            "type": "visa_free" if destination_country in schengen else "check_required",
-            "notes": "Strong passport - check specific requirements",
-            "processing_time": "Varies",
-            "apply_link": f"https://www.google.com/search?q={destination_country}+visa+for+{passport_country}+passport"
-        }
-    
-    return {
-        "visa_required": True,
-        "type": "visa_required",
-        "notes": "Visa likely required - check embassy website",
-        "processing_time": "5-15 business days",
-        "apply_link": f"https://www.google.com/search?q={destination_country}+visa+application+{passport_country}"
-    }
+    return visa_matrix.describe(passport_country, destination_country)
+
+@api_router.post("/visa-requirements/batch")
+async def get_visa_requirements_batch(batch: VisaBatchRequest):
+    """Visa requirements for every passport x destination pair of a trip in one call"""
+    if not batch.passport_countries or not batch.destination_countries:
+        raise HTTPException(status_code=400, detail="Provide passport_countries and destination_countries")
+    passports = [code.upper() for code in batch.passport_countries]
+    destinations = [code.upper() for code in batch.destination_countries]
+    return {"results": visa_matrix.batch(passports, destinations)}
 
 # ==================== PACKING LIST GENERATOR ====================
 
+# Declarative packing rules. A rule applies when every condition it lists matches:
+#   weather    - any keyword appears in the weather description ("cold", "hot", ...)
+#   unless_weather - none of these keywords appears (cold-weather gear wins over hot-weather gear)
+#   activities - any keyword is a word of the requested activities/interests ("hiking", "beach", ...)
+#   travelers  - the party includes that kind of traveler ("infants", "children", "seniors")
+# Item quantity is a number or {"base", "per_day", "max", "per"}: base + floor(per_day * days), capped at max,
+# then multiplied by the number of "per" travelers. base defaults to 1 without per_day ({"per": "seniors"} is one each).
+PACKING_RULES = [
+    {"category": "documents", "items": [
+        ("Passport (valid 6+ months)", True, 1),
+        ("Visa documents (if required)", True, 1),
+        ("Flight tickets/confirmations", True, 1),
+        ("Hotel reservations", True, 1),
+        ("Travel insurance documents", True, 1),
+        ("Driver's license / International driving permit", False, 1),
+        ("Credit/Debit cards", True, 2),
+        ("Emergency contact list", True, 1),
+        ("Copies of all documents (physical + digital)", True, 1),
+        ("Vaccination certificates", False, 1)
+    ]},
+    {"category": "clothing", "items": [
+        ("Underwear", True, {"base": 2, "per_day": 1}),
+        ("Socks", True, {"base": 2, "per_day": 1}),
+        ("T-shirts/Tops", True, {"per_day": 1, "max": 7}),
+        ("Pants/Trousers", True, {"base": 1, "per_day": 0.5, "max": 4}),
+        ("Comfortable walking shoes", True, 1),
+        ("Sleepwear", True, 2),
+        ("Belt", False, 1)
+    ]},
+    {"category": "toiletries", "items": [
+        ("Toothbrush & toothpaste", True, 1),
+        ("Deodorant", True, 1),
+        ("Shampoo & conditioner (travel size)", True, 1),
+        ("Soap/Body wash", True, 1),
+        ("Razor & shaving cream", False, 1),
+        ("Sunscreen SPF 30+", True, 1),
+        ("Lip balm with SPF", False, 1),
+        ("Hand sanitizer", True, 1),
+        ("Wet wipes", False, 1)
+    ]},
+    {"category": "electronics", "items": [
+        ("Phone + charger", True, 1),
+        ("Power bank", True, 1),
+        ("Universal power adapter", True, 1),
+        ("Camera + charger", False, 1),
+        ("Headphones/Earbuds", False, 1),
+        ("E-reader/Tablet", False, 1)
+    ]},
+    {"category": "health", "items": [
+        ("Prescription medications", True, {"base": 7, "per_day": 1}),
+        ("Pain relievers (Ibuprofen/Paracetamol)", True, 1),
+        ("Antihistamines", False, 1),
+        ("Motion sickness medication", False, 1),
+        ("Antidiarrheal medication", True, 1),
+        ("First aid kit", True, 1),
+        ("Insect repellent", False, 1)
+    ]},
+    {"category": "accessories", "items": [
+        ("Daypack/Small backpack", True, 1),
+        ("Reusable water bottle", True, 1),
+        ("Sunglasses", True, 1),
+        ("Travel pillow", False, 1),
+        ("Eye mask & earplugs", False, 1),
+        ("Packing cubes", False, 3),
+        ("Laundry bag", False, 1),
+        ("Umbrella (compact)", False, 1)
+    ]},
+    {"category": "clothing", "weather": ["cold", "winter", "snow"], "items": [
+        ("Warm jacket/Coat", True, 1),
+        ("Sweaters/Fleece", True, 2),
+        ("Thermal underwear", True, 2),
+        ("Gloves", True, 1),
+        ("Warm hat/Beanie", True, 1),
+        ("Scarf", True, 1),
+        ("Warm boots", True, 1)
+    ]},
+    {"category": "clothing", "weather": ["hot", "tropical"], "unless_weather": ["cold", "winter", "snow"], "items": [
+        ("Swimsuit", True, 2),
+        ("Flip-flops/Sandals", True, 1),
+        ("Sun hat", True, 1),
+        ("Light coverup/Sarong", False, 1),
+        ("Reef-safe sunscreen", True, 1)
+    ]},
+    {"category": "health", "weather": ["hot", "tropical"], "unless_weather": ["cold", "winter", "snow"], "items": [("Insect repellent (DEET)", True, 1)]},
+    {"category": "clothing", "weather": ["rain", "humid", "monsoon", "wet"], "items": [
+        ("Waterproof rain jacket", True, 1),
+        ("Quick-dry clothing", False, {"per_day": 0.5, "max": 3})
+    ]},
+    {"category": "clothing", "weather": ["mild", "cool"], "items": [("Light layers/Cardigan", True, 2)]},
+    {"category": "accessories", "activities": ["hiking", "trekking", "outdoors"], "items": [
+        ("Hiking boots", True, 1),
+        ("Hiking backpack", True, 1),
+        ("Trekking poles", False, 1),
+        ("Headlamp/Flashlight", True, 1)
+    ]},
+    {"category": "accessories", "activities": ["beach", "swimming"], "items": [
+        ("Beach towel", True, 1),
+        ("Snorkeling gear", False, 1),
+        ("Waterproof phone pouch", True, 1)
+    ]},
+    {"category": "accessories", "activities": ["water", "diving", "snorkeling", "surfing"], "items": [
+        ("Rash guard", False, 1),
+        ("Dry bag", True, 1)
+    ]},
+    {"category": "clothing", "activities": ["fitness", "gym", "running", "jogging", "crossfit", "marathons"], "items": [
+        ("Workout clothes", True, 3),
+        ("Running shoes", True, 1),
+        ("Resistance bands", False, 1)
+    ]},
+    {"category": "accessories", "activities": ["yoga", "wellness"], "items": [("Travel yoga mat", False, 1)]},
+    {"category": "accessories", "activities": ["cycling"], "items": [("Padded cycling shorts", False, 1), ("Bike lights", False, 1)]},
+    {"category": "clothing", "activities": ["nightlife", "music", "concerts"], "items": [("Smart evening outfit", True, 1)]},
+    {"category": "clothing", "activities": ["religious"], "items": [("Modest clothing covering shoulders and knees", True, 1), ("Light scarf", True, 1)]},
+    {"category": "electronics", "activities": ["photography"], "items": [("Spare memory cards", True, 2), ("Spare camera battery", True, 1)]},
+    {"category": "accessories", "activities": ["wildlife", "safari"], "items": [("Binoculars", True, 1), ("Neutral-coloured clothing", True, 2)]},
+    {"category": "family", "travelers": ["infants"], "items": [
+        ("Diapers", True, {"per_day": 6, "per": "infants"}),
+        ("Baby wipes", True, {"base": 1, "per_day": 0.25, "per": "infants"}),
+        ("Baby formula/food", True, {"per_day": 1, "per": "infants"}),
+        ("Portable changing mat", False, 1),
+        ("Travel stroller or carrier", True, 1)
+    ]},
+    {"category": "family", "travelers": ["children"], "items": [
+        ("Kids' snacks", True, {"per_day": 1, "max": 7}),
+        ("Games/Activity books", False, {"per": "children"}),
+        ("Children's medication", True, 1)
+    ]},
+    {"category": "health", "travelers": ["seniors"], "items": [
+        ("Medication organizer", True, {"per": "seniors"}),
+        ("Compression socks for flights", False, {"per": "seniors"})
+    ]}
+]
+
+PACKING_CATEGORIES = ["documents", "clothing", "toiletries", "electronics", "health", "accessories", "family"]
+
+def compile_packing_rules(rules: List[dict]) -> List[tuple]:
+    """Pre-process the rule table into (category, weather, unless_weather, activities, travelers, items) tuples"""
+    compiled = []
+    for rule in rules:
+        items = []
+        for name, essential, quantity in rule["items"]:
+            spec = quantity if isinstance(quantity, dict) else {"base": quantity}
+            base = spec.get("base", 0 if "per_day" in spec else 1)
+            items.append((name, essential, base, spec.get("per_day", 0), spec.get("max"), spec.get("per")))
+        compiled.append((
+            rule["category"],
+            tuple(keyword.lower() for keyword in rule.get("weather", ())),
+            tuple(keyword.lower() for keyword in rule.get("unless_weather", ())),
+            frozenset(keyword.lower() for keyword in rule.get("activities", ())),
+            tuple(rule.get("travelers", ())),
+            tuple(items)
+        ))
+    return compiled
+
+if PACKING_RULES_FILE:
+    with open(PACKING_RULES_FILE, encoding="utf-8") as f:
+        PACKING_RULES.extend(json.load(f))
+
+COMPILED_PACKING_RULES = compile_packing_rules(PACKING_RULES)
+PACKING_WEATHER_KEYWORDS = sorted({keyword for rule in COMPILED_PACKING_RULES for keyword in rule[1] + rule[2]})
+PACKING_ACTIVITY_KEYWORDS = frozenset().union(*(rule[3] for rule in COMPILED_PACKING_RULES))
+packing_cache = TTLCache(PACKING_CACHE_MAX_ENTRIES, float("inf"))
+
+def packing_key(duration: int, weather: str, activities: Optional[List[str]], travelers: Optional[TravelerDetails]) -> tuple:
+    """Reduce a request to the facts the rules look at, so equivalent requests share a cache entry"""
+    weather = (weather or "").lower()
+    words = set()
+    for activity in activities or []:
+        words.update(re.split(r"[^a-z]+", activity.lower()))
+    party = travelers or TravelerDetails()
+    return (
+        duration,
+        tuple(keyword for keyword in PACKING_WEATHER_KEYWORDS if keyword in weather),
+        tuple(sorted(words & PACKING_ACTIVITY_KEYWORDS)),
+        (party.infants, party.children_above_10 + party.children_below_10, party.seniors)
+    )
+
+def build_packing_items(key: tuple) -> Tuple[tuple, ...]:
+    """Evaluate every rule for a packing key: (category, rule kind, item, essential, quantity) in rule order"""
+    duration, weather, activities, (infants, children, seniors) = key
+    counts = {"infants": infants, "children": children, "seniors": seniors}
+    items = []
+    for category, rule_weather, unless_weather, rule_activities, rule_travelers, rule_items in COMPILED_PACKING_RULES:
+        if rule_weather and not set(rule_weather) & set(weather):
+            continue
+        if set(unless_weather) & set(weather):
+            continue
+        if rule_activities and not rule_activities.intersection(activities):
+            continue
+        if rule_travelers and not any(counts[kind] for kind in rule_travelers):
+            continue
+        kind = "weather" if rule_weather else "activity" if rule_activities or rule_travelers else "base"
+        for name, essential, base, per_day, cap, per in rule_items:
+            quantity = base + math.floor(per_day * duration)
+            if cap is not None:
+                quantity = min(quantity, cap)
+            if per:
+                quantity *= counts[per]
+            items.append((category, kind, name, essential, quantity))
+    return tuple(items)
+
+def packing_items(duration: int, weather: str, activities: Optional[List[str]], travelers: Optional[TravelerDetails]) -> Tuple[tuple, ...]:
+    key = packing_key(duration, weather, activities, travelers)
+    items = packing_cache.get(key)
+    if items is None:
+        items = build_packing_items(key)
+        packing_cache.set(key, items)
+    return items
+
+def trip_weather(trip_request: TripRequest) -> str:
+    """Weather keywords for the trip from the planner's monthly climate data"""
+    from datetime import datetime as dt
+    start = dt.strptime(trip_request.start_date, "%Y-%m-%d")
+    conditions = set()
+    for idx, location in enumerate(day_locations(trip_request, trip_total_days(trip_request))):
+        weather = planned_weather(city_profile(location), start + timedelta(days=idx))
+        conditions.add(weather["condition"].lower())
+        if weather["temp_high"] >= 28:
+            conditions.add("hot")
+        if weather["temp_low"] <= 5:
+            conditions.add("cold")
+        if weather["humidity"] >= 80:
+            conditions.add("humid")
+    return " ".join(sorted(conditions))
+
+def trip_packing_suggestions(trip_request: TripRequest) -> dict:
+    """The packing_suggestions trip section, computed in-process instead of by the LLM"""
+    items = packing_items(
+        trip_total_days(trip_request),
+        trip_weather(trip_request),
+        (trip_request.interests or []) + (trip_request.fitness_interests or []),
+        trip_request.travelers
+    )
+    label = lambda name, quantity: f"{name} x{quantity}" if quantity > 1 else name
+    return {
+        "weather_based": [label(name, quantity) for _, kind, name, _, quantity in items if kind == "weather"],
+        "activity_based": [label(name, quantity) for _, kind, name, _, quantity in items if kind == "activity"],
+        "legal_documents": [name for category, _, name, essential, _ in items if category == "documents" and essential]
+    }
+
 @api_router.post("/generate-packing-list")
 async def generate_packing_list(
     destination: str,
@@ -519,147 +1718,1471 @@ async def generate_packing_list(
     travelers: TravelerDetails = None
 ):
     """Generate comprehensive packing checklist"""
-    checklist = {
-        "documents": [
-            {"item": "Passport (valid 6+ months)", "essential": True, "quantity": 1},
-            {"item": "Visa documents (if required)", "essential": True, "quantity": 1},
-            {"item": "Flight tickets/confirmations", "essential": True, "quantity": 1},
-            {"item": "Hotel reservations", "essential": True, "quantity": 1},
-            {"item": "Travel insurance documents", "essential": True, "quantity": 1},
-            {"item": "Driver's license / International driving permit", "essential": False, "quantity": 1},
-            {"item": "Credit/Debit cards", "essential": True, "quantity": 2},
-            {"item": "Emergency contact list", "essential": True, "quantity": 1},
-            {"item": "Copies of all documents (physical + digital)", "essential": True, "quantity": 1},
-            {"item": "Vaccination certificates", "essential": False, "quantity": 1}
-        ],
-        "clothing": [
-            {"item": "Underwear", "essential": True, "quantity": duration + 2},
-            {"item": "Socks", "essential": True, "quantity": duration + 2},
-            {"item": "T-shirts/Tops", "essential": True, "quantity": min(duration, 7)},
-            {"item": "Pants/Trousers", "essential": True, "quantity": min(duration // 2 + 1, 4)},
-            {"item": "Comfortable walking shoes", "essential": True, "quantity": 1},
-            {"item": "Sleepwear", "essential": True, "quantity": 2},
-            {"item": "Belt", "essential": False, "quantity": 1}
-        ],
-        "toiletries": [
-            {"item": "Toothbrush & toothpaste", "essential": True, "quantity": 1},
-            {"item": "Deodorant", "essential": True, "quantity": 1},
-            {"item": "Shampoo & conditioner (travel size)", "essential": True, "quantity": 1},
-            {"item": "Soap/Body wash", "essential": True, "quantity": 1},
-            {"item": "Razor & shaving cream", "essential": False, "quantity": 1},
-            {"item": "Sunscreen SPF 30+", "essential": True, "quantity": 1},
-            {"item": "Lip balm with SPF", "essential": False, "quantity": 1},
-            {"item": "Hand sanitizer", "essential": True, "quantity": 1},
-            {"item": "Wet wipes", "essential": False, "quantity": 1}
-        ],
-        "electronics": [
-            {"item": "Phone + charger", "essential": True, "quantity": 1},
-            {"item": "Power bank", "essential": True, "quantity": 1},
-            {"item": "Universal power adapter", "essential": True, "quantity": 1},
-            {"item": "Camera + charger", "essential": False, "quantity": 1},
-            {"item": "Headphones/Earbuds", "essential": False, "quantity": 1},
-            {"item": "E-reader/Tablet", "essential": False, "quantity": 1}
-        ],
-        "health": [
-            {"item": "Prescription medications", "essential": True, "quantity": duration + 7},
-            {"item": "Pain relievers (Ibuprofen/Paracetamol)", "essential": True, "quantity": 1},
-            {"item": "Antihistamines", "essential": False, "quantity": 1},
-            {"item": "Motion sickness medication", "essential": False, "quantity": 1},
-            {"item": "Antidiarrheal medication", "essential": True, "quantity": 1},
-            {"item": "First aid kit", "essential": True, "quantity": 1},
-            {"item": "Insect repellent", "essential": False, "quantity": 1}
-        ],
-        "accessories": [
-            {"item": "Daypack/Small backpack", "essential": True, "quantity": 1},
-            {"item": "Reusable water bottle", "essential": True, "quantity": 1},
-            {"item": "Sunglasses", "essential": True, "quantity": 1},
-            {"item": "Travel pillow", "essential": False, "quantity": 1},
-            {"item": "Eye mask & earplugs", "essential": False, "quantity": 1},
-            {"item": "Packing cubes", "essential": False, "quantity": 3},
-            {"item": "Laundry bag", "essential": False, "quantity": 1},
-            {"item": "Umbrella (compact)", "essential": False, "quantity": 1}
-        ]
-    }
-    
-    # Add weather-specific items
-    if "cold" in weather.lower() or "winter" in weather.lower():
-        checklist["clothing"].extend([
-            {"item": "Warm jacket/Coat", "essential": True, "quantity": 1},
-            {"item": "Sweaters/Fleece", "essential": True, "quantity": 2},
-            {"item": "Thermal underwear", "essential": True, "quantity": 2},
-            {"item": "Gloves", "essential": True, "quantity": 1},
-            {"item": "Warm hat/Beanie", "essential": True, "quantity": 1},
-            {"item": "Scarf", "essential": True, "quantity": 1},
-            {"item": "Warm boots", "essential": True, "quantity": 1}
-        ])
-    elif "hot" in weather.lower() or "tropical" in weather.lower():
-        checklist["clothing"].extend([
-            {"item": "Swimsuit", "essential": True, "quantity": 2},
-            {"item": "Flip-flops/Sandals", "essential": True, "quantity": 1},
-            {"item": "Sun hat", "essential": True, "quantity": 1},
-            {"item": "Light coverup/Sarong", "essential": False, "quantity": 1},
-            {"item": "Reef-safe sunscreen", "essential": True, "quantity": 1}
-        ])
-        checklist["health"].append({"item": "Insect repellent (DEET)", "essential": True, "quantity": 1})
-    
-    # Add activity-specific items
-    if "hiking" in [a.lower() for a in activities] or "trekking" in [a.lower() for a in activities]:
-        checklist["accessories"].extend([
-            {"item": "Hiking boots", "essential": True, "quantity": 1},
-            {"item": "Hiking backpack", "essential": True, "quantity": 1},
-            {"item": "Trekking poles", "essential": False, "quantity": 1},
-            {"item": "Headlamp/Flashlight", "essential": True, "quantity": 1}
-        ])
-    
-    if "beach" in [a.lower() for a in activities]:
-        checklist["accessories"].extend([
-            {"item": "Beach towel", "essential": True, "quantity": 1},
-            {"item": "Snorkeling gear", "essential": False, "quantity": 1},
-            {"item": "Waterproof phone pouch", "essential": True, "quantity": 1}
-        ])
-    
-    if "fitness" in [a.lower() for a in activities] or "gym" in [a.lower() for a in activities]:
-        checklist["clothing"].extend([
-            {"item": "Workout clothes", "essential": True, "quantity": 3},
-            {"item": "Running shoes", "essential": True, "quantity": 1},
-            {"item": "Resistance bands", "essential": False, "quantity": 1}
-        ])
-    
+    checklist = {category: [] for category in PACKING_CATEGORIES}
+    for category, _, name, essential, quantity in packing_items(duration, weather, activities, travelers):
+        checklist[category].append({"item": name, "essential": essential, "quantity": quantity})
+    if not checklist["family"]:
+        del checklist["family"]
     return checklist
 
-# ==================== TRIP GENERATION ====================
+# ==================== TRIP CACHE ====================
 
-async def generate_trip_with_ai(trip_request: TripRequest) -> dict:
-    """Generate comprehensive trip plan"""
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    
-    from datetime import datetime as dt
-    start = dt.strptime(trip_request.start_date, "%Y-%m-%d")
-    end = dt.strptime(trip_request.end_date, "%Y-%m-%d")
-    total_days = (end - start).days + 1
-    
-    total_travelers = (
-        trip_request.travelers.adults + 
-        trip_request.travelers.children_above_10 + 
-        trip_request.travelers.children_below_10 + 
-        trip_request.travelers.seniors +
-        trip_request.travelers.infants
-    )
-    
-    customer_type_desc = {
-        "plan_only": "Customer has already booked flights and hotels. Only generate day-wise itinerary.",
-        "partial": "Customer has partial bookings. Check existing_bookings for details.",
-        "fresh": "Customer needs everything - flights, hotels, and itinerary."
-    }.get(trip_request.customer_type, "Full planning needed")
-    
-    fitness_interests = ", ".join(trip_request.fitness_interests) if trip_request.fitness_interests else "None specified"
-    
-    prompt = f"""You are an expert travel planner. Create a comprehensive travel plan in JSON format.
+def _normalize_text(value: Optional[str]) -> str:
+    return " ".join((value or "").lower().split())
 
-CUSTOMER TYPE: {trip_request.customer_type}
-{customer_type_desc}
+def _normalize_list(values: Optional[List[str]]) -> List[str]:
+    return sorted({_normalize_text(v) for v in (values or []) if v and v.strip()})
 
-TRIP DETAILS:
+def budget_bucket(budget: float) -> int:
+    """Geometric budget bucket so budgets within ~TRIP_CACHE_BUDGET_STEP share a key"""
+    return round(math.log(max(budget, 1.0)) / math.log(1 + TRIP_CACHE_BUDGET_STEP))
+
+def trip_cache_key(trip_request: TripRequest) -> str:
+    """Canonical hash of the fields that influence the generated plan"""
+    bookings = trip_request.existing_bookings.model_dump() if trip_request.existing_bookings else None
+    canonical = {
+        "customer_type": _normalize_text(trip_request.customer_type),
+        "existing_bookings": bookings,
+        "passport_countries": sorted(c.upper() for c in trip_request.passport_countries),
+        "departure_location": _normalize_text(trip_request.departure_location),
+        # Destination order matters for routing, so it is preserved
+        "destinations": [_normalize_text(d) for d in trip_request.destinations],
+        "start_date": trip_request.start_date,
+        "end_date": trip_request.end_date,
+        "budget_bucket": budget_bucket(trip_request.budget),
+        "currency": trip_request.currency.upper(),
+        "travelers": trip_request.travelers.model_dump(),
+        "food_preferences": _normalize_text(trip_request.food_preferences),
+        "accommodation_type": _normalize_text(trip_request.accommodation_type),
+        "interests": _normalize_list(trip_request.interests),
+        "fitness_interests": _normalize_list(trip_request.fitness_interests),
+        "need_insurance": trip_request.need_insurance,
+        "cabin_class": _normalize_text(trip_request.cabin_class),
+    }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class TripCache:
+    """Two-tier cache for generated trips: in-process LRU plus optional shared MongoDB tier"""
+
+    def __init__(self, max_entries: int, ttl_seconds: int, shared: bool = False):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.shared = shared
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _remember(self, key: str, trip: dict, expires_at: float):
+        self._entries[key] = (expires_at, trip)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry:
+            expires_at, trip = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return copy.deepcopy(trip)
+            del self._entries[key]
+
+        if self.shared:
+            try:
+                doc = await db.trip_cache.find_one(
+                    {"key": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+                    {"_id": 0}
+                )
+            except Exception as e:
+                logger.warning(f"Trip cache lookup failed: {str(e)}")
+                doc = None
+            if doc:
+                expires_at = doc["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+                self._remember(key, doc["trip"], expires_at)
+                self.shared_hits += 1
+                return copy.deepcopy(doc["trip"])
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, trip: dict):
+        trip = copy.deepcopy(trip)
+        trip.pop("_id", None)
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, trip, expires_at)
+        self.stores += 1
+
+        if self.shared:
+            try:
+                await db.trip_cache.update_one(
+                    {"key": key},
+                    {"$set": {
+                        "key": key,
+                        "trip": trip,
+                        "expires_at": datetime.fromtimestamp(expires_at, timezone.utc)
+                    }},
+                    upsert=True
+                )
+            except Exception as e:
+                logger.warning(f"Trip cache store failed: {str(e)}")
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.shared_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "shared_tier": self.shared,
+            "memory_hits": self.memory_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.memory_hits + self.shared_hits) / lookups, 4) if lookups else 0.0
+        }
+
+trip_cache = TripCache(TRIP_CACHE_MAX_ENTRIES, TRIP_CACHE_TTL_SECONDS, shared=TRIP_CACHE_SHARED)
+
+# Converted copies of saved trips keyed on (trip_id, currency, rates_version)
+converted_trip_cache = TTLCache(CONVERTED_TRIP_CACHE_MAX_ENTRIES, CONVERTED_TRIP_CACHE_TTL_SECONDS)
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one shared task"""
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, factory):
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        # Shield so a disconnecting caller does not cancel the work for everyone else
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced
+        }
+
+trip_singleflight = SingleFlight()
+
+# ==================== TRIP REUSE ====================
+
+def _feature_slot(feature: str, dim: int) -> int:
+    return int(hashlib.md5(feature.encode("utf-8")).hexdigest()[:8], 16) % dim
+
+def shift_iso_date(value: Any, shift: timedelta) -> Any:
+    try:
+        return (datetime.strptime(value, "%Y-%m-%d") + shift).strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return value
+
+class TripSimilarityIndex:
+    """NumPy index of past generations, used to adapt a near-duplicate trip instead of calling the LLM.
+
+    Fields that change the plan's content (route, duration, requested sections, passports, and the departure
+    city when flights are planned) must match exactly. Budget per traveler-day must be within tolerance and
+    the season close. Among those candidates the preference vectors are compared by cosine similarity.
+    """
+
+    DIM = 128
+    # Weight of each preference group in the combined vector
+    GROUP_WEIGHTS = {"interests": 1.0, "fitness": 0.5, "accommodation": 0.7, "food": 0.5, "cabin": 0.3, "party": 0.7}
+
+    def __init__(self, max_entries: int, min_similarity: float, budget_tolerance: float, max_date_shift_days: int):
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity
+        self.budget_tolerance = budget_tolerance
+        self.max_date_shift_days = max_date_shift_days
+        self.vectors = np.zeros((max_entries, self.DIM), dtype=np.float32)
+        self.buckets = np.zeros(max_entries, dtype=np.int64)
+        self.daily_budgets = np.zeros(max_entries, dtype=np.float64)
+        self.days_of_year = np.zeros(max_entries, dtype=np.int16)
+        self.entries: List[Optional[dict]] = [None] * max_entries
+        self.size = 0
+        self.next_slot = 0
+        self.lookups = 0
+        self.reuses = 0
+
+    def bucket(self, trip_request: TripRequest) -> int:
+        sections = trip_sections(trip_request)
+        hard = {
+            "destinations": [_normalize_text(d) for d in trip_request.destinations],
+            "total_days": trip_total_days(trip_request),
+            "sections": sections,
+            "passport_countries": sorted(c.upper() for c in trip_request.passport_countries),
+            "departure_location": _normalize_text(trip_request.departure_location) if "flights" in sections else None
+        }
+        digest = hashlib.sha256(json.dumps(hard, sort_keys=True).encode("utf-8")).hexdigest()
+        return int(digest[:15], 16)
+
+    def vector(self, trip_request: TripRequest) -> np.ndarray:
+        travelers = trip_request.travelers
+        groups = {
+            "interests": _normalize_list(trip_request.interests),
+            "fitness": _normalize_list(trip_request.fitness_interests),
+            "accommodation": [_normalize_text(trip_request.accommodation_type)],
+            "food": [_normalize_text(trip_request.food_preferences)],
+            "cabin": [_normalize_text(trip_request.cabin_class)],
+            "party": [
+                f"adults:{min(travelers.adults, 3)}",
+                f"children:{travelers.children_above_10 + travelers.children_below_10 > 0}",
+                f"infants:{travelers.infants > 0}",
+                f"seniors:{travelers.seniors > 0}"
+            ]
+        }
+        vector = np.zeros(self.DIM, dtype=np.float32)
+        for group, features in groups.items():
+            part = np.zeros(self.DIM, dtype=np.float32)
+            for feature in features or ["none"]:
+                part[_feature_slot(f"{group}:{feature}", self.DIM)] += 1.0
+            vector += self.GROUP_WEIGHTS[group] * part / np.linalg.norm(part)
+        return vector / np.linalg.norm(vector)
+
+    def daily_budget(self, trip_request: TripRequest) -> float:
+        usd = max(convert_currency(trip_request.budget, trip_request.currency.upper(), "USD"), 1.0)
+        return usd / max(trip_total_days(trip_request), 1) / max(count_travelers(trip_request), 1)
+
+    def day_of_year(self, trip_request: TripRequest) -> int:
+        return datetime.strptime(trip_request.start_date, "%Y-%m-%d").timetuple().tm_yday
+
+    def add(self, trip_request: TripRequest, trip_data: dict):
+        slot = self.next_slot
+        self.vectors[slot] = self.vector(trip_request)
+        self.buckets[slot] = self.bucket(trip_request)
+        self.daily_budgets[slot] = self.daily_budget(trip_request)
+        self.days_of_year[slot] = self.day_of_year(trip_request)
+        self.entries[slot] = {
+            "trip": copy.deepcopy(trip_data),
+            "start_date": trip_request.start_date,
+            "currency": trip_request.currency.upper(),
+            "travelers": count_travelers(trip_request)
+        }
+        # Ring buffer: the oldest generation is overwritten once full
+        self.next_slot = (slot + 1) % self.max_entries
+        self.size = min(self.size + 1, self.max_entries)
+
+    def find(self, trip_request: TripRequest) -> Optional[dict]:
+        """Return the closest past generation within tolerance, adapted to this request"""
+        self.lookups += 1
+        if not self.size:
+            return None
+        candidates = np.flatnonzero(self.buckets[:self.size] == self.bucket(trip_request))
+        if not len(candidates):
+            return None
+        budget_ratio = self.daily_budgets[candidates] / self.daily_budget(trip_request)
+        shift = np.abs(self.days_of_year[candidates].astype(np.int32) - self.day_of_year(trip_request))
+        shift = np.minimum(shift, 365 - shift)
+        candidates = candidates[(np.abs(budget_ratio - 1) <= self.budget_tolerance) & (shift <= self.max_date_shift_days)]
+        if not len(candidates):
+            return None
+        scores = self.vectors[candidates] @ self.vector(trip_request)
+        best = int(np.argmax(scores))
+        if scores[best] < self.min_similarity:
+            return None
+        self.reuses += 1
+        return adapt_reused_trip(self.entries[candidates[best]], trip_request)
+
+    def clear(self):
+        self.entries = [None] * self.max_entries
+        self.size = 0
+        self.next_slot = 0
+
+    def stats(self) -> dict:
+        return {
+            "enabled": TRIP_REUSE_ENABLED,
+            "entries": self.size,
+            "max_entries": self.max_entries,
+            "lookups": self.lookups,
+            "reuses": self.reuses,
+            "reuse_ratio": round(self.reuses / self.lookups, 4) if self.lookups else 0.0
+        }
+
+def adapt_reused_trip(entry: dict, trip_request: TripRequest) -> dict:
+    """Shift dates, convert currency and rescale party totals of a past generation to fit a new request"""
+    trip = copy.deepcopy(entry["trip"])
+    shift = datetime.strptime(trip_request.start_date, "%Y-%m-%d") - datetime.strptime(entry["start_date"], "%Y-%m-%d")
+    if shift:
+        for section in ("itinerary", "flights"):
+            for item in trip.get(section) or []:
+                if isinstance(item, dict) and "date" in item:
+                    item["date"] = shift_iso_date(item["date"], shift)
+
+    currency = trip_request.currency.upper()
+    if currency != entry["currency"]:
+        trip = convert_trip_currency(trip, currency, from_currency=entry["currency"])
+
+    # Itinerary costs cover the whole party, so they follow the traveler count
+    ratio = max(count_travelers(trip_request), 1) / max(entry["travelers"], 1)
+    if ratio != 1:
+        for node, key in collect_money_fields(trip, PARTY_COST_TREE):
+            node[key] = round(node[key] * ratio, 2)
+    return trip
+
+trip_reuse_index = TripSimilarityIndex(
+    TRIP_REUSE_MAX_ENTRIES,
+    TRIP_REUSE_MIN_SIMILARITY,
+    TRIP_REUSE_BUDGET_TOLERANCE,
+    TRIP_REUSE_MAX_DATE_SHIFT_DAYS
+)
+
+async def remember_trip(cache_key: str, trip_request: TripRequest, trip_data: dict):
+    """Cache a fully generated trip and index it for near-duplicate reuse"""
+    await trip_cache.set(cache_key, trip_data)
+    if TRIP_REUSE_ENABLED:
+        trip_reuse_index.add(trip_request, trip_data)
+
+def find_reusable_trip(trip_request: TripRequest) -> Optional[dict]:
+    if not TRIP_REUSE_ENABLED:
+        return None
+    return trip_reuse_index.find(trip_request)
+
+# ==================== LLM CLIENT ====================
+
+class LLMUnavailableError(Exception):
+    """Raised when the LLM cannot be called, so callers fall back to the offline planner"""
+
+class CircuitOpenError(LLMUnavailableError):
+    pass
+
+class RetryBudget:
+    """Token bucket capping retries to a fraction of overall traffic"""
+
+    def __init__(self, ratio: float, min_tokens: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+
+    def record_request(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets a single trial call through after the cooldown"""
+
+    def __init__(self, threshold: int, cooldown_seconds: float):
+        self.threshold = threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.short_circuited = 0
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown_seconds:
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.short_circuited += 1
+        return False
+
+    def release(self):
+        # A trial abandoned by its caller (cancelled, client gone) says nothing about the upstream
+        self.trial_in_flight = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logger.warning(f"LLM circuit opened after {self.failures} consecutive failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+class LLMProvider:
+    """Backend that turns a prompt into completion text"""
+
+    name = "none"
+    streaming = False
+    SYSTEM_MESSAGE = "Expert travel planner. Return valid JSON only."
+
+    @property
+    def available(self) -> bool:
+        return False
+
+    async def complete(self, prompt: str) -> str:
+        raise LLMUnavailableError("No LLM configured")
+
+    async def stream(self, prompt: str):
+        yield await self.complete(prompt)
+
+    async def close(self):
+        pass
+
+class EmergentProvider(LLMProvider):
+    """GPT-4o through emergentintegrations; a new LlmChat session per call, no streaming"""
+
+    name = "emergent"
+
+    @property
+    def api_key(self) -> Optional[str]:
+        return os.environ.get('EMERGENT_LLM_KEY')
+
+    @property
+    def available(self) -> bool:
+        return LLM_AVAILABLE and bool(self.api_key)
+
+    async def complete(self, prompt: str) -> str:
+        chat = LlmChat(
+            api_key=self.api_key,
+            session_id=str(uuid.uuid4()),
+            system_message=self.SYSTEM_MESSAGE
+        ).with_model("openai", LLM_MODEL)
+        return await chat.send_message(UserMessage(text=prompt))
+
+class OpenAICompatibleProvider(LLMProvider):
+    """Any OpenAI-compatible /chat/completions endpoint over one pooled HTTP client"""
+
+    name = "openai"
+    streaming = True
+
+    def __init__(self, base_url: str, model: str):
+        self.base_url = base_url
+        self.model = model
+        self._http: Optional[httpx.AsyncClient] = None
+
+    @property
+    def api_key(self) -> Optional[str]:
+        return os.environ.get('LLM_API_KEY') or os.environ.get('EMERGENT_LLM_KEY')
+
+    @property
+    def available(self) -> bool:
+        return bool(self.base_url)
+
+    def http(self) -> httpx.AsyncClient:
+        # One pooled client for the process so connections are reused across generations
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS),
+                limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY)
+            )
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def _chat_payload(self, prompt: str, stream: bool = False) -> dict:
+        return {
+            "model": self.model,
+            "stream": stream,
+            "messages": [
+                {"role": "system", "content": self.SYSTEM_MESSAGE},
+                {"role": "user", "content": prompt}
+            ]
+        }
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    async def complete(self, prompt: str) -> str:
+        response = await self.http().post("/chat/completions", json=self._chat_payload(prompt), headers=self._headers())
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    async def stream(self, prompt: str):
+        async with self.http().stream(
+            "POST", "/chat/completions", json=self._chat_payload(prompt, stream=True), headers=self._headers()
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                delta = loads_json(data)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+def parse_latency_spec(spec: str):
+    """Parse "fixed:s", "uniform:lo:hi", "normal:mean:sd" or "lognormal:median:sigma" into a sampler"""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    samplers = {
+        "fixed": (1, lambda rng: values[0]),
+        "uniform": (2, lambda rng: rng.uniform(values[0], values[1])),
+        "normal": (2, lambda rng: max(0.0, rng.gauss(values[0], values[1]))),
+        "lognormal": (2, lambda rng: values[0] * math.exp(rng.gauss(0, values[1])))
+    }
+    if kind not in samplers or len(values) != samplers[kind][0]:
+        raise ValueError(f"Invalid latency spec: {spec}")
+    return samplers[kind][1]
+
+class StubProvider(LLMProvider):
+    """Deterministic offline LLM for load testing.
+
+    Answers with schema-shaped JSON built from the prompt, after a sampled time-to-first-token,
+    streams it at a fixed token rate and corrupts or fails a configurable share of responses.
+    """
+
+    name = "stub"
+    streaming = True
+    CHARS_PER_TOKEN = 4
+    CHUNK_TOKENS = 8
+
+    def __init__(self, latency: str, tokens_per_second: float, malformed_rate: float, failure_rate: float, seed: int):
+        self.sample_latency = parse_latency_spec(latency)
+        self.tokens_per_second = tokens_per_second
+        self.malformed_rate = malformed_rate
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.counter = 0
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    def _rng(self, prompt: str) -> random.Random:
+        # Seeded per prompt and call so a run replays identically regardless of scheduling
+        self.counter += 1
+        digest = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+        return random.Random(f"{self.seed}:{digest}:{self.counter}")
+
+    def _render(self, prompt: str, rng: random.Random) -> str:
+        if rng.random() < self.failure_rate:
+            raise RuntimeError("Stub LLM simulated failure")
+        text = json.dumps(stub_trip_response(prompt), indent=2)
+        if rng.random() < self.malformed_rate:
+            text = self._corrupt(text, rng)
+        return text
+
+    def _corrupt(self, text: str, rng: random.Random) -> str:
+        mode = rng.choice(["truncate", "trailing_comma", "prose"])
+        if mode == "truncate":
+            return text[:int(len(text) * rng.uniform(0.5, 0.95))]
+        if mode == "trailing_comma":
+            return text[:text.rfind("}")].rstrip() + ",\n}"
+        return f"Here is your travel plan:\n```json\n{text}\n```\nLet me know if you want changes!"
+
+    def _generation_seconds(self, text: str) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return len(text) / self.CHARS_PER_TOKEN / self.tokens_per_second
+
+    async def complete(self, prompt: str) -> str:
+        rng = self._rng(prompt)
+        await asyncio.sleep(self.sample_latency(rng))
+        text = self._render(prompt, rng)
+        await asyncio.sleep(self._generation_seconds(text))
+        return text
+
+    async def stream(self, prompt: str):
+        rng = self._rng(prompt)
+        await asyncio.sleep(self.sample_latency(rng))
+        text = self._render(prompt, rng)
+        step = self.CHUNK_TOKENS * self.CHARS_PER_TOKEN
+        for start in range(0, len(text), step):
+            chunk = text[start:start + step]
+            await asyncio.sleep(self._generation_seconds(chunk))
+            yield chunk
+
+def stub_trip_response(prompt: str) -> dict:
+    """Fill the sections a planning prompt asks for with offline-planner content"""
+    schema = prompt.rsplit("Return valid JSON with:", 1)[-1]
+    sections = [name for name in re.findall(r'^  "(\w+)":', schema, re.MULTILINE) if name in TRIP_SCHEMA_SECTIONS]
+    destinations = re.search(r"Destinations: (.*)", prompt)
+    dates = re.search(r"Dates: (\d{4}-\d{2}-\d{2}) to (\d{4}-\d{2}-\d{2})", prompt)
+    budget = re.search(r"Budget: ([\d.]+) (\w+)", prompt)
+    start_date, end_date = dates.groups() if dates else ("2026-01-01", "2026-01-03")
+    trip_request = TripRequest(
+        departure_location="Unknown",
+        destinations=[d.strip() for d in destinations.group(1).split(",")] if destinations else ["Unknown"],
+        start_date=start_date,
+        end_date=end_date,
+        budget=float(budget.group(1)) if budget else 1000,
+        currency=budget.group(2) if budget else "USD",
+        travelers=TravelerDetails()
+    )
+    total_days = trip_total_days(trip_request)
+    trip = generate_fallback_trip(trip_request, total_days, 1)
+
+    if "hotels" in sections and not trip["hotels"]:
+        trip["hotels"] = [
+            {"name": f"{city_profile(city)['city']} Central Hotel", "location": city, "rating": 4, "price_per_night": round(convert_currency(LODGING_RATES_USD["mid-range"] * city_profile(city)["cost_index"], "USD", trip_request.currency)), "amenities": ["WiFi", "Breakfast"], "booking_link": "https://booking.com"}
+            for city in trip_request.destinations
+        ]
+    if '"day_notes"' in schema:
+        trip["day_notes"] = [
+            {"day_number": day["day_number"], "tips": {item["name"]: f"Allow extra time around {item['location']}" for item in day["morning_activities"]}}
+            for day in trip["itinerary"]
+        ]
+        sections.append("day_notes")
+
+    window = re.search(r"Plan ONLY days? (\d+)(?: to (\d+))? .*?, spent in (.*)\.", prompt)
+    if window:
+        first, location = int(window.group(1)), window.group(3)
+        last = int(window.group(2) or first)
+        trip["itinerary"] = [dict(day, location=location) for day in trip["itinerary"][first - 1:last]]
+    return {name: trip[name] for name in sections}
+
+def build_llm_provider(name: str) -> LLMProvider:
+    if name == "auto":
+        name = "openai" if LLM_BASE_URL else "emergent"
+    if name == "openai":
+        return OpenAICompatibleProvider(LLM_BASE_URL, LLM_MODEL)
+    if name == "emergent":
+        return EmergentProvider()
+    if name == "stub":
+        return StubProvider(
+            LLM_STUB_LATENCY,
+            LLM_STUB_TOKENS_PER_SECOND,
+            LLM_STUB_MALFORMED_RATE,
+            LLM_STUB_FAILURE_RATE,
+            LLM_STUB_SEED
+        )
+    raise ValueError(f"Unknown LLM provider: {name}")
+
+class LLMClient:
+    """Long-lived LLM client with bounded concurrency, per-call deadlines, budgeted retries and a circuit breaker"""
+
+    def __init__(self, provider: LLMProvider):
+        self.provider = provider
+        self.semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        self.retry_budget = RetryBudget(LLM_RETRY_BUDGET_RATIO, LLM_RETRY_BUDGET_MIN, max(LLM_RETRY_BUDGET_MIN, 100))
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS)
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.prompt_tokens = 0
+
+    @property
+    def available(self) -> bool:
+        return self.provider.available
+
+    async def close(self):
+        await self.provider.close()
+
+    async def complete(self, prompt: str) -> str:
+        """Send one prompt and return the raw completion text"""
+        if not self.available:
+            raise LLMUnavailableError("No LLM configured")
+        self.retry_budget.record_request()
+        self.prompt_tokens += estimate_tokens(prompt)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("LLM circuit is open")
+            self.calls += 1
+            try:
+                async with self.semaphore:
+                    text = await asyncio.wait_for(self.provider.complete(prompt), timeout=LLM_TIMEOUT_SECONDS)
+                self.breaker.record_success()
+                return text
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                self.failures += 1
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                self.breaker.record_failure()
+                if attempt >= LLM_MAX_RETRIES or not self.retry_budget.try_spend():
+                    raise
+                attempt += 1
+                self.retries += 1
+                # Full jitter exponential backoff
+                await asyncio.sleep(random.uniform(0, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+
+    async def stream(self, prompt: str):
+        """Yield completion text chunks; providers without streaming yield the whole text once.
+
+        The whole stream shares one LLM_TIMEOUT_SECONDS deadline. Failures before the first chunk
+        are retried like complete(); once text has been yielded the error goes to the caller.
+        """
+        if not self.provider.streaming:
+            yield await self.complete(prompt)
+            return
+        if not self.available:
+            raise LLMUnavailableError("No LLM configured")
+        self.retry_budget.record_request()
+        self.prompt_tokens += estimate_tokens(prompt)
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("LLM circuit is open")
+            self.calls += 1
+            chunks = self.provider.stream(prompt)
+            deadline = loop.time() + LLM_TIMEOUT_SECONDS
+            started = False
+            try:
+                async with self.semaphore:
+                    while True:
+                        # Deadline per chunk rather than around the generator, so it never spans our own yields
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=deadline - loop.time())
+                        except StopAsyncIteration:
+                            break
+                        started = True
+                        yield chunk
+                self.breaker.record_success()
+                return
+            except Exception as e:
+                self.failures += 1
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                self.breaker.record_failure()
+                if started or attempt >= LLM_MAX_RETRIES or not self.retry_budget.try_spend():
+                    raise
+            except BaseException:
+                # Cancelled or closed by the consumer (client disconnect, aclose)
+                self.breaker.release()
+                raise
+            finally:
+                await chunks.aclose()
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(random.uniform(0, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider.name,
+            "available": self.available,
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "prompt_tokens_estimated": self.prompt_tokens,
+            "retry_budget": round(self.retry_budget.tokens, 2),
+            "circuit_state": self.breaker.state,
+            "short_circuited": self.breaker.short_circuited
+        }
+
+llm_client = LLMClient(build_llm_provider(LLM_PROVIDER))
+
+# ==================== OFFLINE PLANNER ====================
+
+SLOT_HOURS = {"morning": 4, "afternoon": 4, "evening": 3}
+MAX_ACTIVITIES_PER_SLOT = 2
+# Interest matches multiply a POI's base weight; a POI outside its preferred slot is discounted
+INTEREST_BOOST = 0.6
+OFF_SLOT_FACTOR = 0.7
+# Share of the per-person daily budget (after lodging) available for paid activities; unspent money rolls over
+ACTIVITY_BUDGET_SHARE = 0.35
+ACTIVITY_BUDGET_CARRY_DAYS = 2
+# Nightly room rate in USD before the city cost index, and the highest meal price each style will pick
+LODGING_RATES_USD = {"budget": 60, "mid-range": 140, "boutique": 200, "vacation-rental": 150, "luxury": 380}
+MEAL_PRICE_LIMITS_USD = {"budget": 25, "mid-range": 60, "vacation-rental": 60, "boutique": 90}
+INTERCITY_TRANSFER_USD = 80
+DIET_TAGS = {
+    "vegetarian": {"vegetarian", "vegan"},
+    "vegan": {"vegan"},
+    "pescatarian": {"pescatarian", "vegetarian", "vegan"},
+    "halal": {"halal"},
+    "kosher": {"kosher"},
+    "gluten-free": {"gluten-free"}
+}
+FREE_TIME_ACTIVITIES = {
+    "morning": ("Neighbourhood Walk", "Explore a new neighbourhood at your own pace"),
+    "afternoon": ("Free Afternoon", "Time to revisit a favourite spot or rest"),
+    "evening": ("Evening Stroll", "Walk the lit-up streets before dinner")
+}
+FITNESS_ACTIVITIES = {
+    "Gym Access": ("Gym day pass", "Gym", "6-8 AM", 15),
+    "Running/Jogging": ("Morning run", "Running", "6-7 AM", 0),
+    "Marathons": ("Long training run", "Running", "6-8 AM", 0),
+    "Yoga Classes": ("Drop-in yoga class", "Yoga", "7-8 AM", 20),
+    "Swimming": ("Lap swim", "Swimming", "7-8 AM", 10),
+    "Cycling": ("Bike rental ride", "Cycling", "7-9 AM", 20),
+    "CrossFit": ("CrossFit drop-in", "CrossFit", "7-8 AM", 25),
+    "Zumba/Dance": ("Dance class", "Dance", "6-7 PM", 15),
+    "Hiking": ("Trail hike", "Hiking", "7-10 AM", 0),
+    "Water Sports": ("Kayak or paddleboard rental", "Water Sports", "8-10 AM", 35)
+}
+
+def interest_keywords(labels: Optional[List[str]]) -> frozenset:
+    """'Art & Museums' -> {'art', 'museums'}, matched against POI tags"""
+    words = set()
+    for label in labels or []:
+        words.update(word for word in re.split(r"[^a-z]+", label.lower()) if len(word) > 2 and word != "and")
+    return frozenset(words)
+
+def compile_city_profile(name: str, data: dict) -> dict:
+    """Turn a POI_DATA entry into lookup-friendly dicts with the city name filled in.
+
+    Generic POIs are appended at a lower weight so long stays still have something to schedule.
+    """
+    pois = list(data["pois"])
+    if data is not GENERIC_POI_PROFILE:
+        pois.extend(poi[:5] + (poi[5] * 0.5,) + poi[6:] for poi in GENERIC_POI_PROFILE["pois"])
+    highs, lows = data.get("climate") or ([24] * 12, [16] * 12)
+    transit_name, transit_cost = data["transit"]
+    return {
+        "city": name,
+        "cost_index": data.get("cost_index", 1.0),
+        "weight": data.get("weight", 5),
+        "humidity": data.get("humidity", 60),
+        "highs": highs,
+        "lows": lows,
+        "transit": transit_name,
+        "transit_cost": transit_cost,
+        "pois": [
+            {
+                "name": poi_name.format(city=name), "area": area, "slot": slot, "hours": hours,
+                "cost": cost, "weight": weight, "tags": frozenset(tags.split()), "description": description
+            }
+            for poi_name, area, slot, hours, cost, weight, tags, description in pois
+        ],
+        "restaurants": [
+            {
+                "name": rest_name, "area": area, "cuisine": cuisine, "price_range": price_range,
+                "cost": cost, "must_try": must_try, "diets": frozenset(diets.split())
+            }
+            for rest_name, area, cuisine, price_range, cost, must_try, diets in data["restaurants"]
+        ]
+    }
+
+if POI_DATA_FILE:
+    with open(POI_DATA_FILE, encoding="utf-8") as f:
+        POI_DATA.update(json.load(f))
+
+POI_DATA_BY_NAME = {fold_text(name): (name, data) for name, data in POI_DATA.items()}
+_city_profiles: Dict[str, dict] = {}
+
+def city_profile(destination: str) -> dict:
+    """Compiled planner data for a destination, falling back to the generic city template"""
+    key = fold_text(destination)
+    profile = _city_profiles.get(key)
+    if profile is None:
+        name = destination.split(",")[0].strip() or "Unknown"
+        city = city_index.get(name)
+        if city:
+            name = city["city"]
+        name, data = POI_DATA_BY_NAME.get(fold_text(name), (name, GENERIC_POI_PROFILE))
+        profile = compile_city_profile(name, data)
+        if len(_city_profiles) >= 4096:
+            _city_profiles.clear()
+        _city_profiles[key] = profile
+    return profile
+
+def allocate_days(destinations: List[str], total_days: int) -> List[int]:
+    """Split the trip across destinations by weight (largest remainder), at least one day each while days last"""
+    count = len(destinations)
+    if total_days <= count:
+        return [1 if idx < total_days else 0 for idx in range(count)]
+    weights = [city_profile(destination)["weight"] for destination in destinations]
+    spare = total_days - count
+    quotas = [spare * weight / sum(weights) for weight in weights]
+    stays = [1 + int(quota) for quota in quotas]
+    by_remainder = sorted(range(count), key=lambda idx: (-(quotas[idx] - int(quotas[idx])), idx))
+    for idx in by_remainder[:total_days - sum(stays)]:
+        stays[idx] += 1
+    return stays
+
+def day_locations(trip_request: TripRequest, total_days: int) -> List[str]:
+    destinations = trip_request.destinations or ["Unknown"]
+    locations = []
+    for destination, stay in zip(destinations, allocate_days(destinations, total_days)):
+        locations.extend([destination] * stay)
+    return locations
+
+def maps_link(place: str, city: Optional[str] = None) -> str:
+    return f"https://maps.google.com/?q={quote_plus(f'{place}, {city}' if city else place)}"
+
+def describe_hours(hours: float) -> str:
+    return "1 hour" if hours == 1 else f"{hours:g} hours"
+
+def planned_weather(profile: dict, date: datetime) -> dict:
+    high, low = profile["highs"][date.month - 1], profile["lows"][date.month - 1]
+    if high >= 32:
+        condition = "Hot"
+    elif high >= 24:
+        condition = "Warm"
+    elif high >= 16:
+        condition = "Mild"
+    elif high >= 8:
+        condition = "Cool"
+    else:
+        condition = "Cold"
+    return {"temp_high": high, "temp_low": low, "condition": condition, "humidity": profile["humidity"]}
+
+def activity_tip(poi: dict, slot: str) -> str:
+    if poi["cost"] and slot == "morning":
+        return "Book a timed ticket online and arrive at opening to beat the crowds"
+    if poi["cost"]:
+        return "Book ahead online; queues build up at peak times"
+    return "Free to visit" if slot != "evening" else "Free; best after sunset"
+
+def slot_accepts(poi: dict, slot: str) -> bool:
+    # Daytime sights can swap between morning and afternoon; evening plans stay in the evening
+    return poi["slot"] == slot or "evening" not in (poi["slot"], slot)
+
+def planned_activity(poi: dict, slot: str, city: str, travelers: int, currency: str) -> dict:
+    return {
+        "name": poi["name"], "description": poi["description"], "duration": describe_hours(poi["hours"]),
+        "cost": round(convert_currency(poi["cost"] * travelers, "USD", currency)), "location": poi["area"],
+        "maps_link": maps_link(poi["name"], city), "tips": activity_tip(poi, slot)
+    }
+
+def free_time_activity(slot: str, city: str) -> dict:
+    name, description = FREE_TIME_ACTIVITIES[slot]
+    return {"name": name, "description": description, "duration": describe_hours(SLOT_HOURS[slot] - 1), "cost": 0, "location": city, "maps_link": maps_link(city), "tips": ""}
+
+def planned_restaurant(restaurant: dict, city: str) -> dict:
+    return {
+        "name": restaurant["name"], "cuisine": restaurant["cuisine"], "price_range": restaurant["price_range"],
+        "must_try": [restaurant["must_try"]], "location": restaurant["area"],
+        "maps_link": maps_link(restaurant["name"], city), "booking_link": ""
+    }
+
+def transit_leg(profile: dict, to: str, travelers: int, currency: str) -> dict:
+    cost = convert_currency(profile["transit_cost"] * 2 * travelers, "USD", currency)
+    return {"type": profile["transit"], "from": "Hotel", "to": to, "duration": "20-30 min", "cost": round(cost), "booking_link": ""}
+
+class DayScheduler:
+    """Greedy slot filler for one trip: best-scoring unvisited POIs that fit each slot's hours and the running budget"""
+
+    def __init__(self, trip_request: TripRequest, daily_allowance_usd: float, exclude: Optional[set] = None):
+        self.interests = interest_keywords((trip_request.interests or []) + (trip_request.fitness_interests or []))
+        self.allowance = daily_allowance_usd
+        self.carry = 0.0
+        self.visited = set(exclude or ())
+
+    def score(self, poi: dict, slot: str) -> float:
+        score = poi["weight"] * (1 + INTEREST_BOOST * len(poi["tags"] & self.interests))
+        return score if poi["slot"] == slot else score * OFF_SLOT_FACTOR
+
+    def fits(self, poi: dict, slot: str, hours_left: float, money_left: float) -> bool:
+        return slot_accepts(poi, slot) and poi["name"] not in self.visited and poi["hours"] <= hours_left and poi["cost"] <= money_left
+
+    def plan_day(self, profile: dict) -> Dict[str, List[dict]]:
+        money_left = self.allowance + self.carry
+        slots = {}
+        for slot, hours in SLOT_HOURS.items():
+            chosen = []
+            hours_left = hours
+            while len(chosen) < MAX_ACTIVITIES_PER_SLOT:
+                candidates = [poi for poi in profile["pois"] if self.fits(poi, slot, hours_left, money_left)]
+                if not candidates:
+                    break
+                poi = max(candidates, key=lambda item: self.score(item, slot))
+                self.visited.add(poi["name"])
+                chosen.append(poi)
+                hours_left -= poi["hours"]
+                money_left -= poi["cost"]
+            slots[slot] = chosen
+        self.carry = min(money_left, self.allowance * ACTIVITY_BUDGET_CARRY_DAYS)
+        return slots
+
+def pick_restaurants(profile: dict, trip_request: TripRequest, day_index: int, count: int = 2) -> List[dict]:
+    """Rotate through restaurants that suit the diet and accommodation style, generic picks if none do"""
+    diet = DIET_TAGS.get((trip_request.food_preferences or "").strip().lower())
+    limit = MEAL_PRICE_LIMITS_USD.get(trip_request.accommodation_type or "mid-range")
+
+    def eligible(restaurants: List[dict]) -> List[dict]:
+        return [
+            restaurant for restaurant in restaurants
+            if (not diet or restaurant["diets"] & diet) and (limit is None or restaurant["cost"] <= limit)
+        ]
+
+    choices = eligible(profile["restaurants"]) or eligible(compile_city_profile(profile["city"], GENERIC_POI_PROFILE)["restaurants"])
+    choices = choices or profile["restaurants"]
+    start = day_index * count
+    return [choices[(start + offset) % len(choices)] for offset in range(min(count, len(choices)))]
+
+def lodging_required(customer_type: str, existing_bookings: Optional[dict]) -> bool:
+    """Lodging is costed for every customer except plan-only ones and those who already booked a hotel"""
+    return customer_type != "plan_only" and not (existing_bookings or {}).get("has_hotel")
+
+def trip_needs_lodging(trip_request: TripRequest) -> bool:
+    bookings = trip_request.existing_bookings
+    return lodging_required(trip_request.customer_type, bookings.model_dump() if bookings else None)
+
+def estimate_lodging_usd(locations: List[str], accommodation_type: Optional[str], travelers: int) -> float:
+    """Room cost for the nights between the given day locations, two travelers per room"""
+    nightly_rate = LODGING_RATES_USD.get(accommodation_type or "mid-range", LODGING_RATES_USD["mid-range"])
+    rooms = math.ceil(max(travelers, 1) / 2)
+    return sum(nightly_rate * city_profile(location)["cost_index"] * rooms for location in locations[:-1])
+
+def plan_offline_itinerary(trip_request: TripRequest, total_days: int, total_travelers: int, exclude: Optional[set] = None) -> Tuple[List[dict], float]:
+    """Rule-based day-by-day itinerary from the local POI data, skipping POIs named in exclude.
+
+    Returns the itinerary (costs in the trip currency, for the whole party) and the lodging estimate.
+    """
+    from datetime import datetime as dt
+    currency = trip_request.currency
+    to_trip_currency = lambda usd: round(convert_currency(usd, "USD", currency))
+    travelers = max(total_travelers, 1)
+    start = dt.strptime(trip_request.start_date, "%Y-%m-%d")
+    locations = day_locations(trip_request, total_days)
+    profiles = {location: city_profile(location) for location in set(locations)}
+
+    lodging_usd = estimate_lodging_usd(locations, trip_request.accommodation_type, travelers) if trip_needs_lodging(trip_request) else 0.0
+
+    budget_usd = convert_currency(trip_request.budget, currency, "USD")
+    per_person_day = max(budget_usd - lodging_usd, 0) / total_days / travelers
+    scheduler = DayScheduler(trip_request, per_person_day * ACTIVITY_BUDGET_SHARE, exclude)
+    fitness = [FITNESS_ACTIVITIES[name] for name in trip_request.fitness_interests or [] if name in FITNESS_ACTIVITIES]
+
+    itinerary = []
+    for idx, location in enumerate(locations):
+        profile = profiles[location]
+        city = profile["city"]
+        date = start + timedelta(days=idx)
+        slots = scheduler.plan_day(profile)
+        day_usd = 0.0
+        day = {"day_number": idx + 1, "date": date.strftime("%Y-%m-%d"), "location": location, "weather": planned_weather(profile, date)}
+
+        for slot, pois in slots.items():
+            activities = [planned_activity(poi, slot, city, travelers, currency) for poi in pois]
+            day[f"{slot}_activities"] = activities or [free_time_activity(slot, city)]
+            day_usd += sum(poi["cost"] for poi in pois) * travelers
+
+        restaurants = pick_restaurants(profile, trip_request, idx)
+        day["restaurants"] = [planned_restaurant(restaurant, city) for restaurant in restaurants]
+        day_usd += sum(restaurant["cost"] for restaurant in restaurants) * travelers
+
+        first_area = next((pois[0]["area"] for pois in slots.values() if pois), city)
+        transportation = []
+        if idx and locations[idx - 1] != location:
+            previous = profiles[locations[idx - 1]]["city"]
+            transportation.append({"type": "Train/Flight", "from": previous, "to": city, "duration": "Varies", "cost": to_trip_currency(INTERCITY_TRANSFER_USD * travelers), "booking_link": "https://rome2rio.com"})
+            day_usd += INTERCITY_TRANSFER_USD * travelers
+        transportation.append(transit_leg(profile, first_area, travelers, currency))
+        day_usd += profile["transit_cost"] * 2 * travelers
+        day["transportation"] = transportation
+
+        day["fitness_activities"] = []
+        if fitness:
+            name, kind, time_of_day, cost = fitness[idx % len(fitness)]
+            day["fitness_activities"] = [{"name": name, "type": kind, "location": f"Near hotel, {city}", "time": time_of_day, "cost": to_trip_currency(cost * travelers), "booking_link": ""}]
+            day_usd += cost * travelers
+
+        day["estimated_cost"] = to_trip_currency(day_usd)
+        itinerary.append(day)
+
+    return itinerary, convert_currency(lodging_usd, "USD", currency)
+
+# ==================== BUDGET OPTIMIZER ====================
+
+# Typical per-person meal price for each restaurant price band, in USD
+PRICE_RANGE_MEAL_USD = {"$": 15, "$$": 35, "$$$": 80, "$$$$": 150}
+# Option values share the POI weight scale
+UNKNOWN_ACTIVITY_VALUE = 6.0
+FREE_TIME_VALUE = 1.0
+PLANNED_MEALS_VALUE = 3.0
+BUDGET_MEALS_VALUE = 2.0
+PLANNED_TRANSPORT_VALUE = 2.0
+PUBLIC_TRANSIT_VALUE = 1.5
+FITNESS_VALUE = 1.5
+HOTEL_VALUE_PER_STAR_NIGHT = 1.0
+# Substitutes are worth slightly less than what the plan already has, so a trip within budget is left alone
+SUBSTITUTE_VALUE_FACTOR = 0.9
+SUBSTITUTES_PER_ACTIVITY = 3
+BUDGET_SOLVER_ITERATIONS = 50
+INTERCITY_TRANSPORT_TYPES = ("flight", "train", "ferry")
+
+def money(value: Any) -> float:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else 0.0
+
+def solve_budget(values: np.ndarray, costs: np.ndarray, budget: float) -> np.ndarray:
+    """Multiple-choice knapsack: pick one option per row, maximizing value with total cost <= budget.
+
+    Bisects a Lagrange multiplier on cost (the LP relaxation), then spends what is left on the
+    best value-per-cost upgrades. Padding options have value -inf. Returns the chosen column per row.
+    """
+    rows = np.arange(len(values))
+    if not len(rows):
+        return rows
+    pick = lambda lam: np.argmax(values - lam * costs, axis=1)
+    total = lambda choice: costs[rows, choice].sum()
+
+    choice = pick(0.0)
+    if total(choice) <= budget:
+        return choice
+    cheapest = np.argmin(np.where(np.isfinite(values), costs, np.inf), axis=1)
+    if total(cheapest) > budget:
+        return cheapest
+
+    low, high = 0.0, 1.0
+    while total(pick(high)) > budget:
+        high *= 2
+    for _ in range(BUDGET_SOLVER_ITERATIONS):
+        mid = (low + high) / 2
+        if total(pick(mid)) > budget:
+            low = mid
+        else:
+            high = mid
+    choice = pick(high)
+
+    spare = budget - total(choice)
+    for _ in range(len(rows)):
+        gain = values - values[rows, choice][:, None]
+        extra = costs - costs[rows, choice][:, None]
+        ratio = np.where((gain > 0) & (extra <= spare), gain / np.maximum(extra, 1e-9), -np.inf)
+        row, col = np.unravel_index(np.argmax(ratio), ratio.shape)
+        if not np.isfinite(ratio[row, col]):
+            break
+        spare -= extra[row, col]
+        choice[row] = col
+    return choice
+
+class TripBudget:
+    """Cost model of a trip: fixed costs plus groups of interchangeable options for every adjustable part.
+
+    Each option is (cost, value, replacement); option 0 is what the trip has now and has no replacement.
+    Costs are in the trip currency for the whole party.
+    """
+
+    def __init__(self, trip: dict, food_preferences: Optional[str] = None, accommodation_type: Optional[str] = None, needs_lodging: Optional[bool] = None):
+        self.trip = trip
+        self.currency = trip.get("currency") or "USD"
+        self.travelers = max(sum(money(count) for count in (trip.get("travelers") or {}).values()), 1)
+        self.diet = DIET_TAGS.get((food_preferences or trip.get("food_preferences") or "").strip().lower())
+        self.fixed_cost = 0.0
+        self.groups: List[Tuple[List[tuple], Any]] = []
+
+        itinerary = trip.get("itinerary") or []
+        used = {item.get("name") for day in itinerary for slot in SLOT_HOURS for item in day.get(f"{slot}_activities") or []}
+        offered = set()
+        for day in itinerary:
+            profile = city_profile(day.get("location") or "")
+            self.add_activities(day, profile, used | offered, offered)
+            self.add_meals(day, profile)
+            self.add_transport(day, profile)
+            self.add_fitness(day)
+        if needs_lodging is None:
+            needs_lodging = lodging_required(trip.get("customer_type") or "fresh", trip.get("existing_bookings"))
+        self.add_lodging(itinerary, accommodation_type or trip.get("accommodation_type"), needs_lodging)
+        self.fixed_cost += sum(money(flight.get("estimated_price")) for flight in trip.get("flights") or [] if isinstance(flight, dict)) * self.travelers
+
+    def usd(self, amount: float) -> float:
+        return convert_currency(amount, "USD", self.currency)
+
+    def add_group(self, options: List[tuple], apply) -> None:
+        if len(options) == 1:
+            self.fixed_cost += options[0][0]
+        else:
+            self.groups.append((options, apply))
+
+    def add_activities(self, day: dict, profile: dict, taken: set, offered: set) -> None:
+        pois = {poi["name"]: poi for poi in profile["pois"]}
+        free_time = {name for name, _ in FREE_TIME_ACTIVITIES.values()}
+        for slot in SLOT_HOURS:
+            items = day.get(f"{slot}_activities") or []
+            for idx, item in enumerate(items):
+                cost = money(item.get("cost"))
+                name = item.get("name")
+                value = FREE_TIME_VALUE if name in free_time else pois[name]["weight"] if name in pois else UNKNOWN_ACTIVITY_VALUE
+                options = [(cost, value, None)]
+                if cost > 0:
+                    options.append((0.0, FREE_TIME_VALUE, free_time_activity(slot, profile["city"])))
+                    substitutes = [
+                        poi for poi in profile["pois"]
+                        if poi["name"] not in taken and slot_accepts(poi, slot) and poi["hours"] <= SLOT_HOURS[slot]
+                        and self.usd(poi["cost"] * self.travelers) < cost
+                    ]
+                    substitutes.sort(key=lambda poi: (-poi["weight"], poi["cost"]))
+                    for poi in substitutes[:SUBSTITUTES_PER_ACTIVITY]:
+                        # Offer each substitute to one activity only so the plan never repeats a POI
+                        taken.add(poi["name"])
+                        offered.add(poi["name"])
+                        replacement = planned_activity(poi, slot, profile["city"], self.travelers, self.currency)
+                        options.append((replacement["cost"], min(poi["weight"], value) * SUBSTITUTE_VALUE_FACTOR, replacement))
+                self.add_group(options, lambda choice, items=items, idx=idx: items.__setitem__(idx, choice))
+
+    def meal_cost(self, restaurant: dict, profile: dict) -> float:
+        known = next((item for item in profile["restaurants"] if item["name"] == restaurant.get("name")), None)
+        per_person = known["cost"] if known else PRICE_RANGE_MEAL_USD.get(restaurant.get("price_range"), PRICE_RANGE_MEAL_USD["$$"])
+        return self.usd(per_person * self.travelers)
+
+    def add_meals(self, day: dict, profile: dict) -> None:
+        restaurants = day.get("restaurants") or []
+        if not restaurants:
+            return
+        options = [(sum(self.meal_cost(restaurant, profile) for restaurant in restaurants), PLANNED_MEALS_VALUE, None)]
+        affordable = sorted(
+            (item for item in profile["restaurants"] if not self.diet or item["diets"] & self.diet),
+            key=lambda item: (item["cost"], item["name"])
+        )[:len(restaurants)]
+        cheaper = [planned_restaurant(item, profile["city"]) for item in affordable]
+        cheaper_cost = sum(self.usd(item["cost"] * self.travelers) for item in affordable)
+        if cheaper and cheaper_cost < options[0][0]:
+            options.append((cheaper_cost, BUDGET_MEALS_VALUE, cheaper))
+        self.add_group(options, lambda choice, day=day: day.__setitem__("restaurants", choice))
+
+    def add_transport(self, day: dict, profile: dict) -> None:
+        entries = [entry for entry in day.get("transportation") or [] if isinstance(entry, dict)]
+        intercity = [entry for entry in entries if any(kind in str(entry.get("type", "")).lower() for kind in INTERCITY_TRANSPORT_TYPES)]
+        local = [entry for entry in entries if entry not in intercity]
+        self.fixed_cost += sum(money(entry.get("cost")) for entry in intercity)
+        if not local:
+            return
+        options = [(sum(money(entry.get("cost")) for entry in local), PLANNED_TRANSPORT_VALUE, None)]
+        transit = transit_leg(profile, local[0].get("to") or profile["city"], self.travelers, self.currency)
+        if transit["cost"] < options[0][0]:
+            options.append((transit["cost"], PUBLIC_TRANSIT_VALUE, intercity + [transit]))
+        self.add_group(options, lambda choice, day=day: day.__setitem__("transportation", choice))
+
+    def add_fitness(self, day: dict) -> None:
+        cost = sum(money(entry.get("cost")) for entry in day.get("fitness_activities") or [] if isinstance(entry, dict))
+        if cost > 0:
+            self.add_group([(cost, FITNESS_VALUE, None), (0.0, 0.0, [])], lambda choice, day=day: day.__setitem__("fitness_activities", choice))
+
+    def add_lodging(self, itinerary: List[dict], accommodation_type: Optional[str], needs_lodging: bool) -> None:
+        """One group of alternative hotels per city; an estimate when the trip lists no hotels"""
+        locations = [day.get("location") or "" for day in itinerary]
+        hotels = [hotel for hotel in self.trip.get("hotels") or [] if isinstance(hotel, dict)]
+        if not hotels:
+            if needs_lodging and locations:
+                self.fixed_cost += self.usd(estimate_lodging_usd(locations, accommodation_type, self.travelers))
+            return
+
+        nights: Dict[str, int] = {}
+        for location in locations[:-1]:
+            nights[location] = nights.get(location, 0) + 1
+        by_city: Dict[str, List[dict]] = {}
+        for hotel in hotels:
+            place = fold_text(f"{hotel.get('location', '')} {hotel.get('name', '')}")
+            city = next((location for location in nights if fold_text(location.split(",")[0]) in place), "")
+            by_city.setdefault(city, []).append(hotel)
+
+        rooms = math.ceil(self.travelers / 2)
+        for city, members in by_city.items():
+            stay = nights[city] if city else max(len(locations) - 1, 0)
+            current = next((hotel for hotel in members if hotel.get("selected")), members[0])
+            members.sort(key=lambda hotel: hotel is not current)
+            options = [
+                (money(hotel.get("price_per_night")) * stay * rooms, money(hotel.get("rating")) * stay * HOTEL_VALUE_PER_STAR_NIGHT, hotel)
+                for hotel in members
+            ]
+            options[0] = options[0][:2] + (None,)
+            self.add_group(options, lambda choice, members=members: [hotel.update(selected=hotel is choice) for hotel in members])
+
+    def current_total(self) -> float:
+        return self.fixed_cost + sum(options[0][0] for options, _ in self.groups)
+
+    def matrices(self) -> Tuple[np.ndarray, np.ndarray]:
+        width = max((len(options) for options, _ in self.groups), default=1)
+        values = np.full((len(self.groups), width), -np.inf)
+        costs = np.zeros((len(self.groups), width))
+        for row, (options, _) in enumerate(self.groups):
+            costs[row, :len(options)] = [option[0] for option in options]
+            values[row, :len(options)] = [option[1] for option in options]
+        return values, costs
+
+    def apply(self, choice: np.ndarray) -> Tuple[float, int]:
+        """Write the chosen options into the trip; returns the new total and how many parts changed"""
+        total = self.fixed_cost
+        for (options, apply), col in zip(self.groups, choice):
+            cost, _, replacement = options[col]
+            total += cost
+            if replacement is not None:
+                apply(replacement)
+        return total, int(np.count_nonzero(choice))
+
+    def day_cost(self, day: dict) -> float:
+        profile = city_profile(day.get("location") or "")
+        activities = sum(money(item.get("cost")) for slot in SLOT_HOURS for item in day.get(f"{slot}_activities") or [])
+        meals = sum(self.meal_cost(restaurant, profile) for restaurant in day.get("restaurants") or [])
+        extras = sum(
+            money(entry.get("cost")) for key in ("transportation", "fitness_activities")
+            for entry in day.get(key) or [] if isinstance(entry, dict)
+        )
+        return activities + meals + extras
+
+def rebalance_trip(
+    trip: dict,
+    budget: Optional[float] = None,
+    food_preferences: Optional[str] = None,
+    accommodation_type: Optional[str] = None,
+    needs_lodging: Optional[bool] = None
+) -> dict:
+    """Fit a trip to its budget in place, re-deriving day and total costs from the cost model"""
+    budget = money(trip.get("budget")) if budget is None else budget
+    model = TripBudget(trip, food_preferences, accommodation_type, needs_lodging)
+    values, costs = model.matrices()
+    choice = solve_budget(values, costs, budget - model.fixed_cost)
+    total, changes = model.apply(choice)
+    for day in trip.get("itinerary") or []:
+        day["estimated_cost"] = round(model.day_cost(day))
+
+    previous_total = trip.get("total_estimated_cost")
+    trip["total_estimated_cost"] = round(total)
+    return {
+        "budget": budget,
+        "previous_total": previous_total,
+        "total_estimated_cost": trip["total_estimated_cost"],
+        "within_budget": total <= budget,
+        "changes": changes
+    }
+
+# ==================== TRIP GENERATION ====================
+
+def trip_total_days(trip_request: TripRequest) -> int:
+    from datetime import datetime as dt
+    start = dt.strptime(trip_request.start_date, "%Y-%m-%d")
+    end = dt.strptime(trip_request.end_date, "%Y-%m-%d")
+    return (end - start).days + 1
+
+def count_travelers(trip_request: TripRequest) -> int:
+    return (
+        trip_request.travelers.adults + 
+        trip_request.travelers.children_above_10 + 
+        trip_request.travelers.children_below_10 + 
+        trip_request.travelers.seniors +
+        trip_request.travelers.infants
+    )
+
+# JSON schema fragment for each top-level section of a generated trip
+TRIP_SCHEMA_SECTIONS = {
+    "title": '"Trip title"',
+    "visa_requirements": '[{"country": "", "visa_required": bool, "type": "", "processing_time": "", "cost": 0, "notes": "", "apply_link": ""}]',
+    "flights": '[{"from": "", "from_airport": "", "to": "", "to_airport": "", "date": "", "estimated_price": 0, "cabin_class": "", "baggage": {"cabin": {"weight": "", "dimensions": ""}, "checked": {"weight": "", "dimensions": ""}}, "airlines": [], "booking_links": {}}]',
+    "hotels": '[{"name": "", "location": "", "rating": 0, "price_per_night": 0, "amenities": [], "booking_link": ""}]',
+    "itinerary": """[{
+    "day_number": 1,
+    "date": "",
+    "location": "",
+    "weather": {"temp_high": 0, "temp_low": 0, "condition": "", "humidity": 0},
+    "morning_activities": [{"name": "", "description": "", "duration": "", "cost": 0, "location": "", "maps_link": "", "tips": ""}],
+    "afternoon_activities": [],
+    "evening_activities": [],
+    "restaurants": [{"name": "", "cuisine": "", "price_range": "", "must_try": [], "location": "", "maps_link": "", "booking_link": ""}],
+    "transportation": [{"type": "", "from": "", "to": "", "duration": "", "cost": 0, "booking_link": ""}],
+    "fitness_activities": [{"name": "", "type": "", "location": "", "time": "", "cost": 0, "booking_link": ""}],
+    "estimated_cost": 0
+  }]""",
+    "packing_suggestions": '{"weather_based": [], "activity_based": [], "legal_documents": []}',
+    "local_tips": '{"emergency_numbers": [], "customs": [], "tipping_guide": "", "local_apps": [], "sim_options": []}',
+    "insurance_recommendations": '[{"provider": "", "price": 0, "coverage": "", "link": ""}]',
+    "booking_links": '{}',
+    "total_estimated_cost": '0'
+}
+
+def compact_schema(value: Any) -> str:
+    """Render an example-valued schema fragment as field:type notation"""
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{key}:{compact_schema(item)}" for key, item in value.items()) + "}"
+    if isinstance(value, list):
+        return "[" + compact_schema(value[0]) + "]" if value else "[]"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "num"
+    return "str"
+
+TRIP_SCHEMA_COMPACT = {
+    name: compact_schema(json.loads(fragment.replace("bool", "true")))
+    for name, fragment in TRIP_SCHEMA_SECTIONS.items()
+}
+
+# Rough output size of each section, used to estimate completion tokens before sending
+TRIP_SECTION_OUTPUT_TOKENS = {
+    "title": 15,
+    "visa_requirements": 120,
+    "flights": 300,
+    "hotels": 250,
+    "packing_suggestions": 120,
+    "local_tips": 150,
+    "insurance_recommendations": 120,
+    "booking_links": 100,
+    "total_estimated_cost": 10
+}
+ITINERARY_DAY_OUTPUT_TOKENS = 450
+
+# Sections an existing booking makes redundant, and what they default to when not requested
+BOOKED_SECTIONS = {"has_flight": "flights", "has_hotel": "hotels", "has_insurance": "insurance_recommendations"}
+OMITTED_SECTION_DEFAULTS = {"flights": [], "hotels": [], "visa_requirements": [], "insurance_recommendations": []}
+
+def trip_schema(sections: List[str], compact: Optional[bool] = None, extra: Optional[Dict[str, str]] = None) -> str:
+    """Render the JSON schema for the given trip sections, plus any extra non-trip fields"""
+    compact = PROMPT_COMPACT_SCHEMA if compact is None else compact
+    schemas = TRIP_SCHEMA_COMPACT if compact else TRIP_SCHEMA_SECTIONS
+    lines = [f'  "{name}": {schemas[name]}' for name in sections]
+    lines.extend(f'  "{name}": {compact_schema(json.loads(fragment)) if compact else fragment}' for name, fragment in (extra or {}).items())
+    fields = ",\n".join(lines)
+    schema = "{\n" + fields + "\n}"
+    if compact:
+        schema += "\nField types: str, num, bool; [x] is a list of x. Use real values, not type names."
+    return schema
+
+def trip_sections(trip_request: TripRequest) -> List[str]:
+    """Top-level sections worth generating for this customer type and existing bookings"""
+    # The packing checklist comes from the rule engine, not the LLM
+    skip = {"packing_suggestions"}
+    if trip_request.customer_type == "plan_only":
+        skip.update(["flights", "hotels"])
+    if trip_request.existing_bookings:
+        skip.update(name for flag, name in BOOKED_SECTIONS.items() if getattr(trip_request.existing_bookings, flag))
+    if not trip_request.need_insurance:
+        skip.add("insurance_recommendations")
+    if not trip_request.passport_countries or (VISA_MATRIX_FOR_TRIPS and trip_visa_requirements(trip_request) is not None):
+        skip.add("visa_requirements")
+    return [name for name in TRIP_SCHEMA_SECTIONS if name not in skip]
+
+def fill_omitted_sections(trip_data: dict, sections: List[str]) -> dict:
+    """Give sections that were deliberately not requested their empty value so the trip shape stays stable"""
+    for name, default in OMITTED_SECTION_DEFAULTS.items():
+        if name not in sections:
+            trip_data.setdefault(name, copy.deepcopy(default))
+    return trip_data
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose and JSON
+    return math.ceil(len(text) / 4)
+
+def estimate_output_tokens(sections: List[str], total_days: int) -> int:
+    tokens = sum(TRIP_SECTION_OUTPUT_TOKENS.get(name, 0) for name in sections)
+    if "itinerary" in sections:
+        tokens += ITINERARY_DAY_OUTPUT_TOKENS * total_days
+    return tokens
+
+def describe_trip(trip_request: TripRequest, total_days: int, total_travelers: int) -> str:
+    """Customer type and trip details block shared by all planning prompts"""
+    customer_type_desc = {
+        "plan_only": "Customer has already booked flights and hotels. Only generate day-wise itinerary.",
+        "partial": "Customer has partial bookings. Check existing_bookings for details.",
+        "fresh": "Customer needs everything - flights, hotels, and itinerary."
+    }.get(trip_request.customer_type, "Full planning needed")
+    
+    fitness_interests = ", ".join(trip_request.fitness_interests) if trip_request.fitness_interests else "None specified"
+    bookings = trip_request.existing_bookings
+    booked = [name for flag, name in BOOKED_SECTIONS.items() if bookings and getattr(bookings, flag)]
+    if booked:
+        customer_type_desc += f" Already booked: {', '.join(booked)}."
+    
+    return f"""CUSTOMER TYPE: {trip_request.customer_type}
+{customer_type_desc}
+
+TRIP DETAILS:
 - Passport Countries: {', '.join(trip_request.passport_countries)}
 - Departure: {trip_request.departure_location}
 - Destinations: {', '.join(trip_request.destinations)}
@@ -671,109 +3194,193 @@ TRIP DETAILS:
 - Accommodation: {trip_request.accommodation_type}
 - Interests: {', '.join(trip_request.interests) if trip_request.interests else 'General'}
 - Fitness Interests: {fitness_interests}
-- Needs Insurance: {trip_request.need_insurance}
+- Needs Insurance: {trip_request.need_insurance}"""
+
+def build_trip_prompt(trip_request: TripRequest, total_days: int, total_travelers: int) -> str:
+    """Build the full trip planning prompt"""
+    return f"""You are an expert travel planner. Create a comprehensive travel plan in JSON format.
+
+{describe_trip(trip_request, total_days, total_travelers)}
 
 Return valid JSON with:
-{{
-  "title": "Trip title",
-  "visa_requirements": [{{"country": "", "visa_required": bool, "type": "", "processing_time": "", "cost": 0, "notes": "", "apply_link": ""}}],
-  "flights": [{{"from": "", "from_airport": "", "to": "", "to_airport": "", "date": "", "estimated_price": 0, "cabin_class": "", "baggage": {{"cabin": {{"weight": "", "dimensions": ""}}, "checked": {{"weight": "", "dimensions": ""}}}}, "airlines": [], "booking_links": {{}}}}],
-  "hotels": [{{"name": "", "location": "", "rating": 0, "price_per_night": 0, "amenities": [], "booking_link": ""}}],
-  "itinerary": [{{
-    "day_number": 1,
-    "date": "",
-    "location": "",
-    "weather": {{"temp_high": 0, "temp_low": 0, "condition": "", "humidity": 0}},
-    "morning_activities": [{{"name": "", "description": "", "duration": "", "cost": 0, "location": "", "maps_link": "", "tips": ""}}],
-    "afternoon_activities": [],
-    "evening_activities": [],
-    "restaurants": [{{"name": "", "cuisine": "", "price_range": "", "must_try": [], "location": "", "maps_link": "", "booking_link": ""}}],
-    "transportation": [{{"type": "", "from": "", "to": "", "duration": "", "cost": 0, "booking_link": ""}}],
-    "fitness_activities": [{{"name": "", "type": "", "location": "", "time": "", "cost": 0, "booking_link": ""}}],
-    "estimated_cost": 0
-  }}],
-  "packing_suggestions": {{"weather_based": [], "activity_based": [], "legal_documents": []}},
-  "local_tips": {{"emergency_numbers": [], "customs": [], "tipping_guide": "", "local_apps": [], "sim_options": []}},
-  "insurance_recommendations": [{{"provider": "", "price": 0, "coverage": "", "link": ""}}],
-  "booking_links": {{}},
-  "total_estimated_cost": 0
-}}"""
-
-    if LLM_AVAILABLE and api_key:
+{trip_schema(trip_sections(trip_request))}"""
+
+# Per-day tips the model adds to an itinerary scheduled by the offline planner
+DAY_NOTES_SCHEMA = '[{"day_number": 1, "tips": {"<activity or restaurant name>": ""}}]'
+
+def describe_planned_day(day: dict) -> str:
+    activities = [item["name"] for slot in ("morning", "afternoon", "evening") for item in day.get(f"{slot}_activities", [])]
+    restaurants = [item["name"] for item in day.get("restaurants", [])]
+    return f"Day {day['day_number']} ({day['date']}, {day['location']}): {'; '.join(activities)}. Meals: {'; '.join(restaurants)}."
+
+def build_enrich_prompt(trip_request: TripRequest, total_days: int, total_travelers: int, skeleton: dict) -> str:
+    """Prompt that sends the offline day plan and asks only for tips and the non-itinerary sections"""
+    sections = [name for name in trip_sections(trip_request) if name != "itinerary"]
+    plan = "\n".join(describe_planned_day(day) for day in skeleton["itinerary"])
+    return f"""You are an expert travel planner. Complete this already scheduled trip in JSON format.
+
+{describe_trip(trip_request, total_days, total_travelers)}
+
+DAY PLAN (fixed, do not repeat it):
+{plan}
+
+In day_notes give one short practical tip per activity and restaurant, keyed by its exact name.
+
+Return valid JSON with:
+{trip_schema(sections, extra={"day_notes": DAY_NOTES_SCHEMA})}"""
+
+def merge_day_notes(itinerary: List[dict], day_notes: Any) -> None:
+    """Copy model tips onto the matching scheduled activities and restaurants"""
+    days = {day["day_number"]: day for day in itinerary}
+    for note in day_notes if isinstance(day_notes, list) else []:
+        day = days.get(note.get("day_number")) if isinstance(note, dict) else None
+        tips = note.get("tips") if day else None
+        if not isinstance(tips, dict):
+            continue
+        for key in ("morning_activities", "afternoon_activities", "evening_activities", "restaurants"):
+            for item in day.get(key, []):
+                tip = tips.get(item["name"])
+                if isinstance(tip, str) and tip:
+                    item["tips"] = tip
+
+async def request_trip_enrichment(trip_request: TripRequest, cache_key: str) -> dict:
+    """Schedule the itinerary offline and let the LLM fill in tips and the remaining sections"""
+    total_days = trip_total_days(trip_request)
+    total_travelers = count_travelers(trip_request)
+    skeleton = generate_fallback_trip(trip_request, total_days, total_travelers)
+    response = await llm_client.complete(build_enrich_prompt(trip_request, total_days, total_travelers, skeleton))
+    enrichment = parse_llm_json(response)
+    merge_day_notes(skeleton["itinerary"], enrichment.pop("day_notes", None))
+
+    sections = trip_sections(trip_request)
+    trip_data = {name: enrichment[name] for name in sections if name in enrichment and name != "itinerary"}
+    trip_data["itinerary"] = skeleton["itinerary"]
+    trip_data, complete = await complete_partial_trip(trip_request, trip_data, sections)
+    fill_omitted_sections(trip_data, sections)
+    if complete:
+        await remember_trip(cache_key, trip_request, trip_data)
+    return trip_data
+
+async def generate_trip_with_ai(trip_request: TripRequest) -> dict:
+    """Generate comprehensive trip plan"""
+    total_days = trip_total_days(trip_request)
+    total_travelers = count_travelers(trip_request)
+
+    cache_key = trip_cache_key(trip_request)
+    cached_trip = await trip_cache.get(cache_key)
+    if cached_trip:
+        return finalize_trip(cached_trip, trip_request, total_days)
+
+    reused_trip = find_reusable_trip(trip_request)
+    if reused_trip:
+        return finalize_trip(reused_trip, trip_request, total_days)
+
+    if llm_client.available:
+        if TRIP_SKELETON_ENRICH:
+            factory = lambda: request_trip_enrichment(trip_request, cache_key)
+        elif should_fan_out(trip_request, total_days):
+            factory = lambda: request_trip_fanout(trip_request, cache_key)
+        else:
+            prompt = build_trip_prompt(trip_request, total_days, total_travelers)
+            factory = lambda: request_trip_from_llm(trip_request, prompt, cache_key)
         try:
-            chat = LlmChat(
-                api_key=api_key,
-                session_id=str(uuid.uuid4()),
-                system_message="Expert travel planner. Return valid JSON only."
-            ).with_model("openai", "gpt-4o")
-            
-            response = await chat.send_message(UserMessage(text=prompt))
-            
-            import json
-            response_text = response.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            trip_data = json.loads(response_text.strip())
-            trip_data["id"] = str(uuid.uuid4())
-            trip_data["customer_type"] = trip_request.customer_type
-            trip_data["passport_countries"] = trip_request.passport_countries
-            trip_data["departure_location"] = trip_request.departure_location
-            trip_data["destinations"] = trip_request.destinations
-            trip_data["start_date"] = trip_request.start_date
-            trip_data["end_date"] = trip_request.end_date
-            trip_data["budget"] = trip_request.budget
-            trip_data["currency"] = trip_request.currency
-            trip_data["travelers"] = trip_request.travelers.model_dump()
-            trip_data["total_days"] = total_days
-            trip_data["created_at"] = datetime.now(timezone.utc).isoformat()
-            
-            return trip_data
+            trip_data = await trip_singleflight.run(cache_key, factory)
+            return finalize_trip(copy.deepcopy(trip_data), trip_request, total_days)
         except Exception as e:
             logger.error(f"AI Error: {str(e)}")
     
     # Fallback generation
-    return generate_fallback_trip(trip_request, total_days, total_travelers)
+    return fit_trip_budget(generate_fallback_trip(trip_request, total_days, total_travelers), trip_request)
+
+async def request_trip_from_llm(trip_request: TripRequest, prompt: str, cache_key: str) -> dict:
+    """Run one LLM generation, parse the JSON payload, re-request anything missing and cache it"""
+    response = await llm_client.complete(prompt)
+    trip_data = parse_llm_json(response)
+    sections = trip_sections(trip_request)
+    trip_data, complete = await complete_partial_trip(trip_request, trip_data, sections)
+    fill_omitted_sections(trip_data, sections)
+    if complete:
+        await remember_trip(cache_key, trip_request, trip_data)
+    return trip_data
+
+def parse_llm_json(response: str) -> dict:
+    """Strip markdown fences from an LLM response and parse the JSON body, repairing it if needed"""
+    response_text = response.strip()
+    if response_text.startswith("```json"):
+        response_text = response_text[7:]
+    if response_text.startswith("```"):
+        response_text = response_text[3:]
+    if response_text.endswith("```"):
+        response_text = response_text[:-3]
+    try:
+        return loads_json(response_text.strip())
+    except ValueError:
+        return salvage_trip_json(response)
+
+def salvage_trip_json(response: str) -> dict:
+    """Parse a malformed or truncated trip response, keeping only the sections and days that arrived complete"""
+    trip_data, open_containers = repair_llm_json(response)
+    if not isinstance(trip_data, dict):
+        raise ValueError("Trip response is not a JSON object")
+    if open_containers > 1 and trip_data:
+        last = next(reversed(trip_data))
+        if last == "itinerary" and isinstance(trip_data[last], list):
+            # Cut inside a day rather than between two days: that day is incomplete
+            if open_containers > 2 and trip_data[last]:
+                trip_data[last].pop()
+        else:
+            del trip_data[last]
+    logger.warning(f"Repaired malformed LLM response, kept sections: {', '.join(trip_data)}")
+    return trip_data
+
+def finalize_trip(trip_data: dict, trip_request: TripRequest, total_days: int) -> dict:
+    """Stamp request metadata and a fresh identity onto a generated trip"""
+    trip_data["id"] = str(uuid.uuid4())
+    trip_data["customer_type"] = trip_request.customer_type
+    trip_data["existing_bookings"] = trip_request.existing_bookings.model_dump() if trip_request.existing_bookings else None
+    trip_data["passport_countries"] = trip_request.passport_countries
+    trip_data["departure_location"] = trip_request.departure_location
+    trip_data["destinations"] = trip_request.destinations
+    trip_data["start_date"] = trip_request.start_date
+    trip_data["end_date"] = trip_request.end_date
+    trip_data["budget"] = trip_request.budget
+    trip_data["currency"] = trip_request.currency
+    trip_data["travelers"] = trip_request.travelers.model_dump()
+    trip_data["interests"] = trip_request.interests
+    trip_data["fitness_interests"] = trip_request.fitness_interests
+    trip_data["food_preferences"] = trip_request.food_preferences
+    trip_data["accommodation_type"] = trip_request.accommodation_type
+    trip_data["total_days"] = total_days
+    trip_data["created_at"] = datetime.now(timezone.utc).isoformat()
+    if VISA_MATRIX_FOR_TRIPS:
+        visa_requirements = trip_visa_requirements(trip_request)
+        if visa_requirements is not None:
+            trip_data["visa_requirements"] = visa_requirements
+    trip_data["packing_suggestions"] = trip_packing_suggestions(trip_request)
+    if trip_data.get("itinerary"):
+        fit_trip_budget(trip_data, trip_request)
+    return trip_data
+
+def fit_trip_budget(trip_data: dict, trip_request: TripRequest) -> dict:
+    if TRIP_BUDGET_OPTIMIZE:
+        rebalance_trip(
+            trip_data,
+            trip_request.budget,
+            trip_request.food_preferences,
+            trip_request.accommodation_type,
+            trip_needs_lodging(trip_request)
+        )
+    return trip_data
 
 def generate_fallback_trip(trip_request: TripRequest, total_days: int, total_travelers: int) -> dict:
-    """Generate fallback trip when AI unavailable"""
-    from datetime import datetime as dt, timedelta
-    
-    start = dt.strptime(trip_request.start_date, "%Y-%m-%d")
-    daily_budget = trip_request.budget / total_days / max(total_travelers, 1)
-    
-    itinerary = []
-    for i in range(total_days):
-        current_date = start + timedelta(days=i)
-        dest_idx = min(i, len(trip_request.destinations) - 1)
-        destination = trip_request.destinations[dest_idx] if trip_request.destinations else "Unknown"
-        
-        itinerary.append({
-            "day_number": i + 1,
-            "date": current_date.strftime("%Y-%m-%d"),
-            "location": destination,
-            "weather": {"temp_high": 25, "temp_low": 18, "condition": "Pleasant", "humidity": 60},
-            "morning_activities": [{"name": f"Explore {destination}", "description": "Morning sightseeing", "duration": "3 hours", "cost": int(daily_budget * 0.1), "location": "City Center", "maps_link": f"https://maps.google.com/?q={destination}", "tips": "Start early"}],
-            "afternoon_activities": [{"name": "Cultural Experience", "description": "Museums and galleries", "duration": "3 hours", "cost": int(daily_budget * 0.1), "location": "Downtown", "maps_link": "", "tips": ""}],
-            "evening_activities": [{"name": "Local Dining", "description": "Try local cuisine", "duration": "2 hours", "cost": int(daily_budget * 0.15), "location": "Restaurant District", "maps_link": "", "tips": ""}],
-            "restaurants": [{"name": "Local Restaurant", "cuisine": "Local", "price_range": "$$", "must_try": ["Local specialty"], "location": "", "maps_link": "", "booking_link": ""}],
-            "transportation": [
-                {"type": "Metro", "from": "Hotel", "to": "Center", "duration": "20 min", "cost": 3, "booking_link": ""},
-                {"type": "Walking", "from": "Center", "to": "Attractions", "duration": "15 min", "cost": 0, "booking_link": ""},
-                {"type": "Uber/Taxi", "from": "Various", "to": "Various", "duration": "Varies", "cost": 15, "booking_link": "https://uber.com"}
-            ],
-            "fitness_activities": [{"name": "Local Gym", "type": "Gym", "location": "Near hotel", "time": "6-8 AM", "cost": 15, "booking_link": ""}] if trip_request.fitness_interests else [],
-            "estimated_cost": int(daily_budget * 0.8)
-        })
+    """Generate a complete trip offline from the local POI data, used when AI is unavailable and as the LLM skeleton"""
+    itinerary, lodging_cost = plan_offline_itinerary(trip_request, total_days, total_travelers)
     
     return {
         "id": str(uuid.uuid4()),
         "title": f"Trip to {', '.join(trip_request.destinations)}",
         "customer_type": trip_request.customer_type,
+        "existing_bookings": trip_request.existing_bookings.model_dump() if trip_request.existing_bookings else None,
         "passport_countries": trip_request.passport_countries,
         "departure_location": trip_request.departure_location,
         "destinations": trip_request.destinations,
@@ -782,12 +3389,16 @@ def generate_fallback_trip(trip_request: TripRequest, total_days: int, total_tra
         "budget": trip_request.budget,
         "currency": trip_request.currency,
         "travelers": trip_request.travelers.model_dump(),
+        "interests": trip_request.interests,
+        "fitness_interests": trip_request.fitness_interests,
+        "food_preferences": trip_request.food_preferences,
+        "accommodation_type": trip_request.accommodation_type,
         "total_days": total_days,
-        "visa_requirements": [],
+        "visa_requirements": trip_visa_requirements(trip_request) or [],
         "flights": [],
         "hotels": [],
         "itinerary": itinerary,
-        "packing_suggestions": {"weather_based": [], "activity_based": [], "legal_documents": ["Passport", "Visa", "Insurance"]},
+        "packing_suggestions": trip_packing_suggestions(trip_request),
         "local_tips": {"emergency_numbers": ["Police: 911", "Ambulance: 911"], "customs": [], "tipping_guide": "10-20%", "local_apps": ["Uber", "Google Maps"], "sim_options": []},
         "insurance_recommendations": INSURANCE_PROVIDERS[:3],
         "booking_links": {
@@ -795,43 +3406,1005 @@ def generate_fallback_trip(trip_request: TripRequest, total_days: int, total_tra
             "hotels": {"booking": "https://booking.com", "airbnb": "https://airbnb.com", "agoda": "https://agoda.com"},
             "transportation": {"uber": "https://uber.com", "rome2rio": "https://rome2rio.com"}
         },
-        "total_estimated_cost": int(trip_request.budget * 0.85),
+        "total_estimated_cost": round(lodging_cost + sum(day["estimated_cost"] for day in itinerary)),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
 
+# ==================== PARALLEL TRIP PLANNING ====================
+
+def should_fan_out(trip_request: TripRequest, total_days: int) -> bool:
+    """Long, multi-city or over-sized trips are split into parallel sub-requests"""
+    return (
+        total_days >= TRIP_FANOUT_MIN_DAYS or
+        len(trip_request.destinations) >= TRIP_FANOUT_MIN_DESTINATIONS or
+        estimate_output_tokens(trip_sections(trip_request), total_days) > LLM_MAX_OUTPUT_TOKENS
+    )
+
+def plan_day_windows(trip_request: TripRequest, total_days: int) -> List[dict]:
+    """Allocate days across destinations by weight and split each stay into bounded windows"""
+    from datetime import datetime as dt
+    start = dt.strptime(trip_request.start_date, "%Y-%m-%d")
+    destinations = trip_request.destinations or ["Unknown"]
+
+    windows = []
+    day = 1
+    for destination, stay in zip(destinations, allocate_days(destinations, total_days)):
+        stay_end = day + stay - 1
+        while day <= stay_end:
+            last = min(day + TRIP_FANOUT_DAY_WINDOW - 1, stay_end)
+            windows.append({
+                "location": destination,
+                "first_day": day,
+                "last_day": last,
+                "start_date": (start + timedelta(days=day - 1)).strftime("%Y-%m-%d"),
+                "end_date": (start + timedelta(days=last - 1)).strftime("%Y-%m-%d")
+            })
+            day = last + 1
+    return windows
+
+def describe_route(windows: List[dict]) -> str:
+    stays: Dict[str, List[int]] = {}
+    for window in windows:
+        days = stays.setdefault(window["location"], [window["first_day"], window["last_day"]])
+        days[1] = window["last_day"]
+    return ", ".join(f"{location} (days {days[0]}-{days[1]})" for location, days in stays.items())
+
+SKELETON_SECTIONS = ["title", "flights", "hotels", "packing_suggestions", "local_tips", "booking_links", "total_estimated_cost"]
+
+def build_skeleton_prompt(trip_request: TripRequest, total_days: int, total_travelers: int, route: str) -> str:
+    return f"""You are an expert travel planner. Plan the logistics for this trip in JSON format.
+
+{describe_trip(trip_request, total_days, total_travelers)}
+- Route: {route}
+
+Do not include the day-by-day itinerary, visa requirements or insurance; they are planned separately.
+
+Return valid JSON with:
+{trip_schema([name for name in SKELETON_SECTIONS if name in trip_sections(trip_request)])}"""
+
+def build_window_prompt(trip_request: TripRequest, total_days: int, total_travelers: int, window: dict) -> str:
+    return f"""You are an expert travel planner. Create part of a day-wise itinerary in JSON format.
+
+{describe_trip(trip_request, total_days, total_travelers)}
+
+Plan ONLY days {window['first_day']} to {window['last_day']} ({window['start_date']} to {window['end_date']}), spent in {window['location']}.
+Number the days {window['first_day']} to {window['last_day']}.
+
+Return valid JSON with:
+{trip_schema(["itinerary"])}"""
+
+def build_visa_prompt(trip_request: TripRequest) -> str:
+    return f"""You are an expert travel planner. List visa requirements in JSON format.
+
+- Passport Countries: {', '.join(trip_request.passport_countries)}
+- Destinations: {', '.join(trip_request.destinations)}
+- Dates: {trip_request.start_date} to {trip_request.end_date}
+
+Return valid JSON with:
+{trip_schema(["visa_requirements"])}"""
+
+def build_insurance_prompt(trip_request: TripRequest, total_days: int, total_travelers: int) -> str:
+    return f"""You are an expert travel planner. Recommend travel insurance in JSON format.
+
+- Passport Countries: {', '.join(trip_request.passport_countries)}
+- Destinations: {', '.join(trip_request.destinations)}
+- Duration: {total_days} days, {total_travelers} travelers
+- Budget: {trip_request.budget} {trip_request.currency}
+
+Return valid JSON with:
+{trip_schema(["insurance_recommendations"])}"""
+
+async def request_trip_fanout(trip_request: TripRequest, cache_key: str) -> dict:
+    """Plan a long trip as concurrent sub-requests and merge them into the trip schema"""
+    total_days = trip_total_days(trip_request)
+    total_travelers = count_travelers(trip_request)
+    windows = plan_day_windows(trip_request, total_days)
+    semaphore = asyncio.Semaphore(TRIP_FANOUT_CONCURRENCY)
+
+    async def call(prompt: str) -> dict:
+        async with semaphore:
+            response = await llm_client.complete(prompt)
+        return parse_llm_json(response)
+
+    sections = trip_sections(trip_request)
+    prompts = {"skeleton": build_skeleton_prompt(trip_request, total_days, total_travelers, describe_route(windows))}
+    if "visa_requirements" in sections:
+        prompts["visa"] = build_visa_prompt(trip_request)
+    if "insurance_recommendations" in sections:
+        prompts["insurance"] = build_insurance_prompt(trip_request, total_days, total_travelers)
+
+    names = list(prompts)
+    window_days, *results = await asyncio.gather(
+        request_window_days(trip_request, total_days, total_travelers, windows, call),
+        *(call(prompts[name]) for name in names),
+        return_exceptions=True
+    )
+    if isinstance(window_days, Exception):
+        logger.error(f"AI fan-out itinerary failed: {str(window_days)}")
+        window_days = [[] for _ in windows]
+    parts = {}
+    for name, result in zip(names, results):
+        if isinstance(result, Exception) or not isinstance(result, dict):
+            logger.error(f"AI fan-out part {name} failed: {str(result)}")
+        else:
+            parts[name] = result
+    if not parts and not any(window_days):
+        raise RuntimeError("All fan-out sub-requests failed")
+
+    # Failed parts are filled from the offline plan so the schema stays complete
+    fallback = generate_fallback_trip(trip_request, total_days, total_travelers)
+    trip_data = fill_omitted_sections({key: fallback[key] for key in sections}, sections)
+    trip_data.update(parts.get("skeleton", {}))
+    trip_data["itinerary"], days_complete = fill_window_days(trip_request, windows, window_days, fallback)
+
+    if "visa" in parts:
+        trip_data["visa_requirements"] = parts["visa"].get("visa_requirements", [])
+    if "insurance" in parts:
+        trip_data["insurance_recommendations"] = parts["insurance"].get("insurance_recommendations", [])
+    if "skeleton" not in parts or not trip_data.get("total_estimated_cost"):
+        trip_data["total_estimated_cost"] = sum(day.get("estimated_cost", 0) or 0 for day in trip_data["itinerary"])
+
+    if len(parts) == len(prompts) and days_complete:
+        await remember_trip(cache_key, trip_request, trip_data)
+    return trip_data
+
+# ==================== PARTIAL TRIP RECOVERY ====================
+
+def window_span(window: dict) -> int:
+    return window["last_day"] - window["first_day"] + 1
+
+def remaining_window(window: dict, received: int) -> dict:
+    """The tail of a day window that a response did not cover"""
+    from datetime import datetime as dt
+    start = dt.strptime(window["start_date"], "%Y-%m-%d") + timedelta(days=received)
+    return dict(window, first_day=window["first_day"] + received, start_date=start.strftime("%Y-%m-%d"))
+
+def plan_remaining_windows(trip_request: TripRequest, total_days: int, first_day: int) -> List[dict]:
+    """Day windows covering the itinerary from first_day to the end of the trip"""
+    windows = []
+    for window in plan_day_windows(trip_request, total_days):
+        if window["last_day"] < first_day:
+            continue
+        if window["first_day"] < first_day:
+            window = remaining_window(window, first_day - window["first_day"])
+        windows.append(window)
+    return windows
+
+async def request_window_days(trip_request: TripRequest, total_days: int, total_travelers: int, windows: List[dict], call) -> List[List[dict]]:
+    """Request each day window; windows that come back short get one follow-up for only their missing days"""
+    async def request(window: dict) -> List[dict]:
+        try:
+            part = await call(build_window_prompt(trip_request, total_days, total_travelers, window))
+            return (part.get("itinerary") or [])[:window_span(window)]
+        except Exception as e:
+            logger.error(f"AI days {window['first_day']}-{window['last_day']} failed: {str(e)}")
+            return []
+
+    window_days = list(await asyncio.gather(*(request(window) for window in windows)))
+    short = [idx for idx, days in enumerate(window_days) if days and len(days) < window_span(windows[idx])]
+    if short:
+        followups = await asyncio.gather(*(request(remaining_window(windows[idx], len(window_days[idx]))) for idx in short))
+        for idx, days in zip(short, followups):
+            window_days[idx] = window_days[idx] + days
+    return window_days
+
+def fill_window_days(trip_request: TripRequest, windows: List[dict], window_days: List[List[dict]], fallback: dict) -> Tuple[List[dict], bool]:
+    """Number the days of each window, padding gaps from the offline plan; also reports whether no padding was needed"""
+    from datetime import datetime as dt
+    start = dt.strptime(trip_request.start_date, "%Y-%m-%d")
+    itinerary = []
+    complete = True
+    for window, days in zip(windows, window_days):
+        expected = window_span(window)
+        if len(days) < expected:
+            complete = False
+            days = days + fallback["itinerary"][window["first_day"] - 1 + len(days):window["last_day"]]
+        for offset, day in enumerate(days[:expected]):
+            day["day_number"] = window["first_day"] + offset
+            day["date"] = day.get("date") or (start + timedelta(days=day["day_number"] - 1)).strftime("%Y-%m-%d")
+            day["location"] = day.get("location") or window["location"]
+            itinerary.append(day)
+    return itinerary, complete
+
+def build_sections_prompt(trip_request: TripRequest, total_days: int, total_travelers: int, sections: List[str]) -> str:
+    return f"""You are an expert travel planner. Complete part of a travel plan in JSON format.
+
+{describe_trip(trip_request, total_days, total_travelers)}
+
+Return valid JSON with:
+{trip_schema(sections)}"""
+
+async def complete_partial_trip(trip_request: TripRequest, trip_data: dict, sections: List[str]) -> Tuple[dict, bool]:
+    """Re-request only the sections and itinerary days missing from a salvaged trip.
+
+    Returns the merged trip and whether it is entirely model-generated (nothing filled from the offline plan).
+    """
+    total_days = trip_total_days(trip_request)
+    total_travelers = count_travelers(trip_request)
+    missing = [name for name in sections if name != "itinerary" and name not in trip_data]
+    days = (trip_data.get("itinerary") or [])[:total_days] if "itinerary" in sections else []
+    windows = plan_remaining_windows(trip_request, total_days, len(days) + 1) if "itinerary" in sections else []
+    if not missing and not windows:
+        return trip_data, True
+
+    logger.info(f"Re-requesting {len(missing)} missing sections and days {len(days) + 1}-{total_days}")
+
+    async def call(prompt: str) -> dict:
+        return parse_llm_json(await llm_client.complete(prompt))
+
+    async def request_sections() -> dict:
+        if not missing:
+            return {}
+        try:
+            return await call(build_sections_prompt(trip_request, total_days, total_travelers, missing))
+        except Exception as e:
+            logger.error(f"AI sections {', '.join(missing)} failed: {str(e)}")
+            return {}
+
+    recovered, window_days = await asyncio.gather(
+        request_sections(),
+        request_window_days(trip_request, total_days, total_travelers, windows, call)
+    )
+    fallback = generate_fallback_trip(trip_request, total_days, total_travelers)
+    complete = True
+    for name in missing:
+        if name in recovered:
+            trip_data[name] = recovered[name]
+        else:
+            trip_data[name] = fallback[name]
+            complete = False
+    if "itinerary" in sections:
+        remaining, days_complete = fill_window_days(trip_request, windows, window_days, fallback)
+        trip_data["itinerary"] = days + remaining
+        complete = complete and days_complete
+    return trip_data, complete
+
+# ==================== TRIP STREAMING ====================
+
+# Array sections whose elements are emitted one by one as soon as they close
+STREAMED_TRIP_SECTIONS = ("itinerary", "hotels", "flights", "visa_requirements")
+
+class IncrementalTripParser:
+    """Incrementally scans streamed trip JSON and emits sections and array items as they complete"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.finished = False
+        self.key = None
+        self.key_start = None
+        self.last_key = None
+        self.value_start = None
+        self.item_start = None
+        self.trip: Dict[str, Any] = {}
+        self.closed: List[str] = []
+
+    def _parse(self, text: str):
+        try:
+            return True, loads_json(text)
+        except ValueError:
+            return False, None
+
+    def _close_value(self, end: int) -> List[dict]:
+        events = []
+        key, self.key, start, self.value_start = self.key, None, self.value_start, None
+        if key is None or start is None:
+            return events
+        if key in STREAMED_TRIP_SECTIONS:
+            self.trip.setdefault(key, [])
+            self.closed.append(key)
+            events.append({"event": "section_end", "section": key, "count": len(self.trip[key])})
+            return events
+        ok, value = self._parse(self.buffer[start:end])
+        if ok:
+            self.trip[key] = value
+            self.closed.append(key)
+            events.append({"event": "section", "section": key, "data": value})
+        return events
+
+    def salvage(self) -> dict:
+        """Sections that closed before the stream ended, plus any complete itinerary days"""
+        trip = {key: self.trip[key] for key in self.closed}
+        if "itinerary" not in trip and self.trip.get("itinerary"):
+            trip["itinerary"] = list(self.trip["itinerary"])
+        return trip
+
+    def feed(self, chunk: str) -> List[dict]:
+        events = []
+        self.buffer += chunk
+        buffer = self.buffer
+        for i in range(self.pos, len(buffer)):
+            if self.finished:
+                break
+            c = buffer[i]
+            if not self.started:
+                # Skip markdown fences or prose before the top-level object
+                if c == "{":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.key_start is not None:
+                        self.last_key = buffer[self.key_start:i + 1]
+                        self.key_start = None
+                continue
+            if c == '"':
+                self.in_string = True
+                if self.depth == 1 and self.value_start is None:
+                    self.key_start = i
+            elif c == ":" and self.depth == 1 and self.value_start is None:
+                ok, key = self._parse(self.last_key or "")
+                self.key = key if ok else None
+                self.value_start = i + 1
+            elif c in "{[":
+                self.depth += 1
+                if self.depth == 3 and c == "{" and self.key in STREAMED_TRIP_SECTIONS:
+                    self.item_start = i
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 2 and self.item_start is not None:
+                    ok, item = self._parse(buffer[self.item_start:i + 1])
+                    self.item_start = None
+                    if ok:
+                        items = self.trip.setdefault(self.key, [])
+                        events.append({"event": "item", "section": self.key, "index": len(items), "data": item})
+                        items.append(item)
+                elif self.depth == 0:
+                    events.extend(self._close_value(i))
+                    self.finished = True
+            elif c == "," and self.depth == 1:
+                events.extend(self._close_value(i))
+        self.pos = len(buffer)
+        return events
+
+def trip_events_from_dict(trip_data: dict):
+    """Replay an already-complete trip as the same events the incremental parser emits"""
+    for key, value in trip_data.items():
+        if key in STREAMED_TRIP_SECTIONS and isinstance(value, list):
+            for index, item in enumerate(value):
+                yield {"event": "item", "section": key, "index": index, "data": item}
+            yield {"event": "section_end", "section": key, "count": len(value)}
+        else:
+            yield {"event": "section", "section": key, "data": value}
+
+async def stream_trip_events(trip_request: TripRequest):
+    """Generate a trip and yield events as each section becomes available"""
+    total_days = trip_total_days(trip_request)
+    total_travelers = count_travelers(trip_request)
+    metadata = finalize_trip({}, trip_request, total_days)
+    yield {"event": "meta", "data": metadata}
+
+    def final_trip(trip_data: dict) -> dict:
+        # Same budget fit /trips/generate applies, on a copy so cached trips stay as generated
+        return fit_trip_budget({**copy.deepcopy(trip_data), **metadata}, trip_request)
+
+    cache_key = trip_cache_key(trip_request)
+    cached_trip = await trip_cache.get(cache_key)
+    if cached_trip:
+        for event in trip_events_from_dict(cached_trip):
+            yield event
+        yield {"event": "complete", "source": "cache", "trip": final_trip(cached_trip)}
+        return
+
+    reused_trip = find_reusable_trip(trip_request)
+    if reused_trip:
+        for event in trip_events_from_dict(reused_trip):
+            yield event
+        yield {"event": "complete", "source": "reuse", "trip": final_trip(reused_trip)}
+        return
+
+    if llm_client.available:
+        parser = IncrementalTripParser()
+        try:
+            prompt = build_trip_prompt(trip_request, total_days, total_travelers)
+            async for chunk in llm_client.stream(prompt):
+                for event in parser.feed(chunk):
+                    yield event
+        except Exception as e:
+            logger.error(f"AI Stream Error: {str(e)}")
+        parsed = parser.finished and bool(parser.trip.get("itinerary"))
+        streamed = parser.trip if parsed else parser.salvage()
+        if streamed.get("itinerary"):
+            # Keep what already streamed and only re-request the missing days and sections
+            streamed_days = len(streamed["itinerary"])
+            try:
+                sections = trip_sections(trip_request)
+                trip_data, complete = await complete_partial_trip(trip_request, streamed, sections)
+                fill_omitted_sections(trip_data, sections)
+            except Exception as e:
+                logger.error(f"AI Stream Recovery Error: {str(e)}")
+            else:
+                for key, value in trip_data.items():
+                    if key == "itinerary":
+                        if len(value) > streamed_days or key not in parser.closed:
+                            for index in range(streamed_days, len(value)):
+                                yield {"event": "item", "section": key, "index": index, "data": value[index]}
+                            yield {"event": "section_end", "section": key, "count": len(value)}
+                    elif key not in parser.closed and key not in metadata:
+                        for event in trip_events_from_dict({key: value}):
+                            yield event
+                if complete:
+                    await remember_trip(cache_key, trip_request, trip_data)
+                yield {"event": "complete", "source": "ai" if parsed else "ai_repaired", "trip": final_trip(trip_data)}
+                return
+        yield {"event": "error", "detail": "AI response incomplete, falling back to offline plan"}
+
+    fallback = generate_fallback_trip(trip_request, total_days, total_travelers)
+    fallback.update(metadata)
+    for event in trip_events_from_dict(fallback):
+        yield event
+    yield {"event": "complete", "source": "fallback", "trip": fit_trip_budget(fallback, trip_request)}
+
+def encode_stream_event(event: dict, fmt: str) -> str:
+    payload = json.dumps(event, default=str)
+    if fmt == "sse":
+        return f"event: {event['event']}\ndata: {payload}\n\n"
+    return payload + "\n"
+
 @api_router.post("/trips/generate")
 async def generate_trip(trip_request: TripRequest):
     """Generate trip plan"""
-    return await generate_trip_with_ai(trip_request)
+    return trip_response(await generate_trip_with_ai(trip_request))
+
+@api_router.post("/trips/generate/stream")
+async def generate_trip_stream(trip_request: TripRequest, format: str = "ndjson"):
+    """Stream trip plan sections as NDJSON (default) or server-sent events"""
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'")
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+
+    async def body():
+        async for event in stream_trip_events(trip_request):
+            yield encode_stream_event(event, format)
+
+    return StreamingResponse(body(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+# ==================== TRIP JOBS ====================
+
+class TripJobQueue:
+    """Bounded pool of async workers processing trip generation jobs persisted in MongoDB"""
+
+    def __init__(self, workers: int, max_queued: int):
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        # Slots promised to jobs not yet in the queue (awaiting their insert, or recovered at startup)
+        self.reserved = 0
+        self._tasks: List[asyncio.Task] = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def start(self):
+        # Re-queue jobs a dead process left running; live workers elsewhere keep theirs. Queued jobs may
+        # also be picked up by other processes, which is safe because _process claims each job atomically.
+        stale = (datetime.now(timezone.utc) - timedelta(seconds=TRIP_JOB_STALE_SECONDS)).isoformat()
+        await db.trip_jobs.update_many(
+            {"status": "running", "started_at": {"$lt": stale}},
+            {"$set": {"status": "queued"}}
+        )
+        pending = await db.trip_jobs.find({"status": "queued"}, {"_id": 0, "id": 1}).sort("created_at", 1).to_list(None)
+        if pending:
+            logger.info(f"Recovered {len(pending)} unfinished trip jobs")
+        self.reserved += len(pending)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        # The backlog may exceed the queue bound, so feed it in as workers free up
+        self._tasks.append(asyncio.create_task(self._requeue([job["id"] for job in pending])))
+
+    async def _requeue(self, job_ids: List[str]):
+        for job_id in job_ids:
+            await self.queue.put((job_id, time.time()))
+            self.reserved -= 1
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, trip_request: TripRequest, user_id: Optional[str] = None) -> dict:
+        # Reserve the slot before awaiting the insert so concurrent submits cannot overfill the queue
+        if self.queue.qsize() + self.reserved >= self.queue.maxsize:
+            raise HTTPException(status_code=503, detail="Trip job queue is full, try again later")
+        self.reserved += 1
+        job = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "status": "queued",
+            "request": trip_request.model_dump(),
+            "partial": {},
+            "result": None,
+            "error": None,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "started_at": None,
+            "finished_at": None
+        }
+        try:
+            await db.trip_jobs.insert_one(job)
+        finally:
+            self.reserved -= 1
+        self.queue.put_nowait((job["id"], time.time()))
+        return {"job_id": job["id"], "status": "queued", "queue_position": self.queue.qsize()}
+
+    async def _worker(self):
+        while True:
+            job_id, enqueued_at = await self.queue.get()
+            try:
+                await self._process(job_id, enqueued_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Trip job {job_id} crashed: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, job_id: str, enqueued_at: float):
+        # Claim atomically: when several processes queued the same job, only one moves it to running
+        job = await db.trip_jobs.find_one_and_update(
+            {"id": job_id, "status": "queued"},
+            {"$set": {"status": "running", "started_at": datetime.now(timezone.utc).isoformat()}},
+            {"_id": 0}
+        )
+        if not job:
+            return
+
+        wait = time.time() - enqueued_at
+        self.total_wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.running += 1
+        try:
+            trip_request = TripRequest(**job["request"])
+            partial: Dict[str, Any] = {}
+            async for event in stream_trip_events(trip_request):
+                if event["event"] == "item":
+                    partial.setdefault(event["section"], []).append(event["data"])
+                elif event["event"] == "section":
+                    partial[event["section"]] = event["data"]
+                elif event["event"] == "meta":
+                    partial.update(event["data"])
+                elif event["event"] == "complete":
+                    await db.trip_jobs.update_one({"id": job_id}, {"$set": {
+                        "status": "completed",
+                        "source": event["source"],
+                        "result": event["trip"],
+                        "partial": {},
+                        "finished_at": datetime.now(timezone.utc).isoformat()
+                    }})
+                    self.completed += 1
+                    return
+                # Persist every finished itinerary day so a crash mid-itinerary keeps the days already planned
+                if event["event"] in ("section", "section_end") or event.get("section") == "itinerary":
+                    await db.trip_jobs.update_one({"id": job_id}, {"$set": {"partial": partial}})
+            raise RuntimeError("Generation ended without a result")
+        except Exception as e:
+            self.failed += 1
+            await db.trip_jobs.update_one({"id": job_id}, {"$set": {
+                "status": "failed",
+                "error": str(e),
+                "finished_at": datetime.now(timezone.utc).isoformat()
+            }})
+        finally:
+            self.running -= 1
+
+    def stats(self) -> dict:
+        started = self.completed + self.failed + self.running
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_seconds": round(self.total_wait_seconds / started, 3) if started else 0.0,
+            "max_wait_seconds": round(self.max_wait_seconds, 3)
+        }
+
+trip_jobs = TripJobQueue(TRIP_JOB_WORKERS, TRIP_JOB_QUEUE_MAX)
+
+@api_router.post("/trips/jobs", status_code=202)
+async def create_trip_job(trip_request: TripRequest, user_id: Optional[str] = Depends(get_optional_user_id)):
+    """Queue a trip generation job and return its id immediately; jobs submitted with a token are private to that user"""
+    return await trip_jobs.submit(trip_request, user_id)
+
+@api_router.get("/trips/jobs/{job_id}")
+async def get_trip_job(job_id: str, user_id: Optional[str] = Depends(get_optional_user_id)):
+    """Get job status with partial or final trip results"""
+    job = await db.trip_jobs.find_one({"id": job_id}, {"_id": 0, "request": 0})
+    # Anonymous jobs are readable by whoever holds the (unguessable) id
+    if not job or job.pop("user_id", None) not in (None, user_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+def invalidate_converted_trip(trip_id: str):
+    converted_trip_cache.delete_where(lambda key: key[0] == trip_id)
+
+# ==================== TRIP STORAGE ====================
+
+def parse_day_range(days: str) -> tuple:
+    """Parse "3" or "1-3" into an inclusive (first, last) day range"""
+    try:
+        first, _, last = days.partition("-")
+        first, last = int(first), int(last or first)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="days must look like '3' or '1-3'")
+    if first < 1 or last < first:
+        raise HTTPException(status_code=400, detail="Invalid day range")
+    return first, last
+
+async def store_trip(trip_data: dict):
+    """Persist a trip as one document, or as a header plus per-day documents in split mode.
+
+    Both modes upsert on (id, user_id), so re-saving a trip replaces it whichever mode wrote it before.
+    """
+    query = {"id": trip_data["id"], "user_id": trip_data["user_id"]}
+    days_query = {"trip_id": trip_data["id"], "user_id": trip_data["user_id"]}
+    if TRIP_STORAGE_MODE != "split":
+        await db.trips.replace_one(query, trip_data, upsert=True)
+        # Drop days left behind if this trip was last saved in split mode
+        await db.trip_days.delete_many(days_query)
+        return
+
+    itinerary = trip_data.get("itinerary") or []
+    header = {k: v for k, v in trip_data.items() if k != "itinerary"}
+    header["itinerary_storage"] = "split"
+    header["day_count"] = len(itinerary)
+    await db.trips.replace_one(query, header, upsert=True)
+    await db.trip_days.delete_many(days_query)
+    if itinerary:
+        await db.trip_days.insert_many([
+            {"trip_id": trip_data["id"], "user_id": trip_data["user_id"], "day_number": idx + 1, "day": day}
+            for idx, day in enumerate(itinerary)
+        ])
+
+async def load_trip(trip_id: str, user_id: str, day_range: Optional[tuple] = None) -> Optional[dict]:
+    """Load a trip in either storage format, optionally with only a range of itinerary days"""
+    projection: Dict[str, Any] = {"_id": 0}
+    if day_range:
+        # Only materialize the requested days when the itinerary is embedded
+        projection["itinerary"] = {"$slice": [day_range[0] - 1, day_range[1] - day_range[0] + 1]}
+    trip = await db.trips.find_one({"id": trip_id, "user_id": user_id}, projection)
+    if not trip:
+        return None
+
+    if trip.get("itinerary_storage") == "split":
+        query: Dict[str, Any] = {"trip_id": trip_id, "user_id": user_id}
+        if day_range:
+            query["day_number"] = {"$gte": day_range[0], "$lte": day_range[1]}
+        days = await db.trip_days.find(query, {"_id": 0, "day": 1}).sort("day_number", ASCENDING).to_list(None)
+        trip["itinerary"] = [d["day"] for d in days]
+        total = trip.pop("day_count", len(days))
+        trip.pop("itinerary_storage", None)
+    else:
+        total = trip.get("total_days", len(trip.get("itinerary", [])))
+
+    if day_range:
+        trip["itinerary_range"] = {"first": day_range[0], "last": min(day_range[1], total), "total": total}
+    return trip
+
+async def update_trip_parts(trip_id: str, user_id: str, fields: Dict[str, Any], days: Dict[int, dict]) -> bool:
+    """Patch top-level fields and individual itinerary days of a saved trip in place, in either storage format"""
+    query = {"id": trip_id, "user_id": user_id}
+    header = await db.trips.find_one(query, {"_id": 0, "itinerary_storage": 1})
+    if header is None:
+        return False
+    updates = dict(fields)
+    if header.get("itinerary_storage") == "split":
+        if days:
+            await db.trip_days.bulk_write([
+                UpdateOne({"trip_id": trip_id, "user_id": user_id, "day_number": number}, {"$set": {"day": day}})
+                for number, day in days.items()
+            ])
+    else:
+        updates.update({f"itinerary.{number - 1}": day for number, day in days.items()})
+    if updates:
+        await db.trips.update_one(query, {"$set": updates})
+    invalidate_converted_trip(trip_id)
+    return True
+
+async def attach_itineraries(trips: List[dict], user_id: str):
+    """Fill in itinerary days for split-mode trip headers with a single query"""
+    split = {t["id"]: t for t in trips if t.get("itinerary_storage") == "split"}
+    if not split:
+        return
+    days = await db.trip_days.find(
+        {"trip_id": {"$in": list(split)}, "user_id": user_id}, {"_id": 0}
+    ).sort([("trip_id", ASCENDING), ("day_number", ASCENDING)]).to_list(None)
+    for trip in split.values():
+        trip["itinerary"] = []
+        trip.pop("itinerary_storage", None)
+        trip.pop("day_count", None)
+    for day in days:
+        split[day["trip_id"]]["itinerary"].append(day["day"])
 
 @api_router.post("/trips/save")
 async def save_trip(trip_data: dict, current_user: dict = Depends(get_current_user)):
     trip_data["user_id"] = current_user["id"]
     trip_data["status"] = "planned"
     trip_data.pop("_id", None)
-    await db.trips.insert_one(trip_data)
-    trip_data.pop("_id", None)
+    await store_trip(trip_data)
+    invalidate_converted_trip(trip_data["id"])
     return {"message": "Trip saved", "trip_id": trip_data["id"]}
 
+def encode_trip_cursor(trip: dict) -> str:
+    raw = json.dumps([trip.get("created_at"), trip.get("id")]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_trip_cursor(cursor: str) -> tuple:
+    try:
+        created_at, trip_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return created_at, trip_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @api_router.get("/trips/my-trips")
-async def get_my_trips(current_user: dict = Depends(get_current_user)):
-    trips = await db.trips.find({"user_id": current_user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return trips
+async def get_my_trips(
+    request: Request,
+    summary: bool = False,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user_readonly)
+):
+    """List the user's trips newest first; the next page cursor is returned in X-Next-Cursor"""
+    limit = max(1, min(limit, 100))
+    query: Dict[str, Any] = {"user_id": current_user["id"]}
+    if cursor:
+        created_at, trip_id = decode_trip_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": trip_id}}
+        ]
+    projection = TRIP_SUMMARY_PROJECTION if summary else {"_id": 0}
+    trips = await db.trips.find(query, projection).sort(
+        [("created_at", DESCENDING), ("id", DESCENDING)]
+    ).to_list(limit + 1)
+    if not summary:
+        await attach_itineraries(trips[:limit], current_user["id"])
+    
+    body = dumps_json(trips[:limit])
+    headers = {
+        "ETag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        "Cache-Control": "private, no-cache"
+    }
+    if len(trips) > limit:
+        trips = trips[:limit]
+        headers["X-Next-Cursor"] = encode_trip_cursor(trips[-1])
+    
+    if etag_matches(request.headers.get("if-none-match", ""), {headers["ETag"]}):
+        return Response(status_code=304, headers=headers)
+    return trip_response(trips, headers)
 
 @api_router.get("/trips/{trip_id}")
-async def get_trip(trip_id: str, current_user: dict = Depends(get_current_user)):
-    trip = await db.trips.find_one({"id": trip_id, "user_id": current_user["id"]}, {"_id": 0})
+async def get_trip(
+    trip_id: str,
+    currency: Optional[str] = None,
+    days: Optional[str] = None,
+    current_user: dict = Depends(get_current_user_readonly)
+):
+    """Get a saved trip, optionally converted to another currency and/or limited to a day range"""
+    if currency and currency not in CURRENCY_RATES:
+        raise HTTPException(status_code=400, detail="Unsupported currency")
+    day_range = parse_day_range(days) if days else None
+    
+    cache_key = (trip_id, currency, day_range, CURRENCY_RATES_VERSION)
+    if currency:
+        cached = converted_trip_cache.get(cache_key)
+        if cached and cached["user_id"] == current_user["id"]:
+            return trip_response(cached)
+    
+    trip = await load_trip(trip_id, current_user["id"], day_range)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
-    return trip
+    if not currency or currency == trip.get("currency"):
+        return trip_response(trip)
+    
+    converted = convert_trip_currency(trip, currency)
+    converted_trip_cache.set(cache_key, converted)
+    return trip_response(converted)
 
 @api_router.delete("/trips/{trip_id}")
 async def delete_trip(trip_id: str, current_user: dict = Depends(get_current_user)):
     result = await db.trips.delete_one({"id": trip_id, "user_id": current_user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Trip not found")
+    await db.trip_days.delete_many({"trip_id": trip_id, "user_id": current_user["id"]})
+    invalidate_converted_trip(trip_id)
     return {"message": "Trip deleted"}
 
+@api_router.post("/trips/{trip_id}/rebalance")
+async def rebalance_saved_trip(trip_id: str, request: Optional[TripRebalanceRequest] = None, current_user: dict = Depends(get_current_user)):
+    """Re-fit a saved trip's activities, meals, local transport and hotel choice to its budget (or a new one)"""
+    request = request or TripRebalanceRequest()
+    if request.budget is not None and request.budget <= 0:
+        raise HTTPException(status_code=400, detail="Budget must be positive")
+    trip = await load_trip(trip_id, current_user["id"])
+    if not trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+
+    before = copy.deepcopy(trip.get("itinerary") or [])
+    summary = rebalance_trip(trip, request.budget, request.food_preferences, request.accommodation_type)
+    fields: Dict[str, Any] = {"total_estimated_cost": trip["total_estimated_cost"]}
+    if "hotels" in trip:
+        fields["hotels"] = trip["hotels"]
+    if request.budget is not None:
+        trip["budget"] = fields["budget"] = request.budget
+    days = {idx + 1: day for idx, (old, day) in enumerate(zip(before, trip.get("itinerary") or [])) if old != day}
+    await update_trip_parts(trip_id, current_user["id"], fields, days)
+    return trip_response({**summary, "trip": trip})
+
+# ==================== TRIP EDITING ====================
+
+def trip_day_date(trip: dict, day_number: int) -> str:
+    from datetime import datetime as dt
+    day = trip["itinerary"][day_number - 1]
+    if day.get("date"):
+        return day["date"]
+    start = dt.strptime(trip.get("start_date") or datetime.now(timezone.utc).strftime("%Y-%m-%d"), "%Y-%m-%d")
+    return (start + timedelta(days=day_number - 1)).strftime("%Y-%m-%d")
+
+def trip_party(trip: dict) -> TravelerDetails:
+    return TravelerDetails.model_validate(trip.get("travelers") or {})
+
+def count_travelers_in(trip: dict) -> int:
+    return sum(trip_party(trip).model_dump().values())
+
+def planned_names(days: List[dict]) -> List[str]:
+    return [item["name"] for day in days for slot in SLOT_HOURS for item in day.get(f"{slot}_activities") or [] if item.get("name")]
+
+def trip_day_budget(trip: dict, edit: TripEditRequest) -> float:
+    """Per-day share of the budget left once flights and hotels are paid for"""
+    itinerary = trip["itinerary"]
+    model = TripBudget(trip, edit.food_preferences, edit.accommodation_type)
+    # Whatever the cost model prices outside the days themselves: flights and lodging
+    travel_cost = model.current_total() - sum(model.day_cost(day) for day in itinerary)
+    return max(money(trip.get("budget")) - travel_cost, 0.0) / len(itinerary)
+
+def edit_preferences(edit: TripEditRequest) -> str:
+    lines = []
+    if edit.interests:
+        lines.append(f"- Interests: {', '.join(edit.interests)}")
+    if edit.food_preferences:
+        lines.append(f"- Food: {edit.food_preferences}")
+    if edit.accommodation_type:
+        lines.append(f"- Accommodation: {edit.accommodation_type}")
+    if edit.instructions:
+        lines.append(f"- Change request: {edit.instructions}")
+    return "\n".join(lines)
+
+def build_day_edit_prompt(trip: dict, day_number: int, edit: TripEditRequest) -> str:
+    """Just enough context to replan one day: route, dates, party, that day's budget and what other days cover"""
+    itinerary = trip["itinerary"]
+    day = itinerary[day_number - 1]
+    location = day.get("location") or ", ".join(trip.get("destinations") or [])
+    day_budget = trip_day_budget(trip, edit)
+    others = planned_names(itinerary[:day_number - 1] + itinerary[day_number:])
+    return f"""You are an expert travel planner. Replan one day of an existing trip in JSON format.
+
+- Destinations: {', '.join(trip.get('destinations') or [location])}
+- Dates: {trip.get('start_date') or trip_day_date(trip, 1)} to {trip.get('end_date') or trip_day_date(trip, len(itinerary))} ({len(itinerary)} days)
+- Travelers: {count_travelers_in(trip)}
+- Budget for this day: {round(day_budget)} {trip.get('currency') or 'USD'}
+- Planned on other days (do not repeat): {'; '.join(others) or 'nothing yet'}
+{edit_preferences(edit)}
+
+Plan ONLY day {day_number} ({trip_day_date(trip, day_number)}), spent in {location}.
+
+Return valid JSON with:
+{trip_schema(["itinerary"])}"""
+
+def build_hotels_edit_prompt(trip: dict, edit: TripEditRequest) -> str:
+    locations = [day.get("location") or "" for day in trip.get("itinerary") or []]
+    nights: Dict[str, int] = {}
+    for location in locations[:-1]:
+        nights[location] = nights.get(location, 0) + 1
+    stays = ", ".join(f"{location} ({count} nights)" for location, count in nights.items()) or ", ".join(trip.get("destinations") or [])
+    current = [hotel.get("name", "") for hotel in trip.get("hotels") or [] if isinstance(hotel, dict)]
+    return f"""You are an expert travel planner. Suggest hotels for an existing trip in JSON format.
+
+- Destinations: {', '.join(trip.get('destinations') or nights)}
+- Stays: {stays}
+- Dates: {trip.get('start_date', '')} to {trip.get('end_date', '')}
+- Travelers: {count_travelers_in(trip)}
+- Trip budget: {trip.get('budget', '')} {trip.get('currency') or 'USD'}
+- Replace these hotels: {'; '.join(current) or 'none'}
+{edit_preferences(edit)}
+
+Suggest one or two hotels per city and use the city name in each hotel's location.
+
+Return valid JSON with:
+{trip_schema(["hotels"])}"""
+
+def plan_offline_day(trip: dict, day_number: int, edit: TripEditRequest) -> dict:
+    """Replan one day from the local POI data, avoiding POIs already used on other days"""
+    itinerary = trip["itinerary"]
+    day = itinerary[day_number - 1]
+    date = trip_day_date(trip, day_number)
+    day_request = TripRequest(
+        customer_type="plan_only",
+        departure_location=trip.get("departure_location") or "",
+        destinations=[day.get("location") or (trip.get("destinations") or ["Unknown"])[0]],
+        start_date=date,
+        end_date=date,
+        budget=trip_day_budget(trip, edit),
+        currency=trip.get("currency") or "USD",
+        travelers=trip_party(trip),
+        interests=edit.interests or trip.get("interests") or [],
+        fitness_interests=trip.get("fitness_interests") or [],
+        food_preferences=edit.food_preferences or trip.get("food_preferences") or "No preference",
+        accommodation_type=edit.accommodation_type or trip.get("accommodation_type") or "mid-range"
+    )
+    exclude = set(planned_names(itinerary[:day_number - 1] + itinerary[day_number:])) | set(planned_names([day]))
+    planned, _ = plan_offline_itinerary(day_request, 1, count_travelers(day_request), exclude)
+    return planned[0]
+
+async def regenerate_trip_day(trip: dict, day_number: int, edit: TripEditRequest) -> Tuple[dict, str]:
+    """New content for one day from the LLM, or the offline planner when it is unavailable"""
+    if llm_client.available:
+        try:
+            response = await llm_client.complete(build_day_edit_prompt(trip, day_number, edit))
+            days = parse_llm_json(response).get("itinerary")
+            if isinstance(days, list) and days and isinstance(days[0], dict):
+                return days[0], "ai"
+            logger.warning(f"Day regeneration returned no itinerary day for trip {trip.get('id')}")
+        except Exception as e:
+            logger.error(f"AI day regeneration failed: {str(e)}")
+    return plan_offline_day(trip, day_number, edit), "offline"
+
+@api_router.post("/trips/{trip_id}/days/{day_number}/regenerate")
+async def regenerate_day(trip_id: str, day_number: int, edit: Optional[TripEditRequest] = None, current_user: dict = Depends(get_current_user)):
+    """Replan a single itinerary day and patch only that day and the trip total"""
+    edit = edit or TripEditRequest()
+    trip = await load_trip(trip_id, current_user["id"])
+    if not trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    if not 1 <= day_number <= len(trip.get("itinerary") or []):
+        raise HTTPException(status_code=404, detail="Day not found")
+
+    day, source = await regenerate_trip_day(trip, day_number, edit)
+    previous = trip["itinerary"][day_number - 1]
+    day["day_number"] = day_number
+    day["date"] = trip_day_date(trip, day_number)
+    day.setdefault("location", previous.get("location", ""))
+    trip["itinerary"][day_number - 1] = day
+
+    model = TripBudget(trip, edit.food_preferences, edit.accommodation_type)
+    day["estimated_cost"] = round(model.day_cost(day))
+    total = round(model.current_total())
+    await update_trip_parts(trip_id, current_user["id"], {"total_estimated_cost": total}, {day_number: day})
+    return {"day": day, "total_estimated_cost": total, "source": source}
+
+@api_router.post("/trips/{trip_id}/hotels/regenerate")
+async def regenerate_hotels(trip_id: str, edit: Optional[TripEditRequest] = None, current_user: dict = Depends(get_current_user)):
+    """Suggest new hotels for a saved trip and patch only the hotels and the trip total"""
+    edit = edit or TripEditRequest()
+    trip = await load_trip(trip_id, current_user["id"])
+    if not trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    if not llm_client.available:
+        raise HTTPException(status_code=503, detail="Hotel suggestions are unavailable right now")
+
+    try:
+        hotels = parse_llm_json(await llm_client.complete(build_hotels_edit_prompt(trip, edit))).get("hotels")
+    except Exception as e:
+        logger.error(f"AI hotel regeneration failed: {str(e)}")
+        hotels = None
+    if not isinstance(hotels, list) or not hotels:
+        raise HTTPException(status_code=502, detail="Could not generate hotel suggestions")
+
+    trip["hotels"] = [hotel for hotel in hotels if isinstance(hotel, dict)]
+    total = round(TripBudget(trip, edit.food_preferences, edit.accommodation_type).current_total())
+    await update_trip_parts(trip_id, current_user["id"], {"hotels": trip["hotels"], "total_estimated_cost": total}, {})
+    return {"hotels": trip["hotels"], "total_estimated_cost": total}
+
 # ==================== CONTACT & NEWSLETTER ====================
 
 @api_router.post("/contact")
@@ -853,27 +4426,99 @@ async def subscribe_newsletter(data: NewsletterSubscribe):
     existing = await db.newsletter.find_one({"email": data.email})
     if existing:
         return {"message": "Already subscribed"}
-    await db.newsletter.insert_one({
-        "id": str(uuid.uuid4()),
-        "email": data.email,
-        "subscribed_at": datetime.now(timezone.utc).isoformat()
-    })
+    try:
+        await db.newsletter.insert_one({
+            "id": str(uuid.uuid4()),
+            "email": data.email,
+            "subscribed_at": datetime.now(timezone.utc).isoformat()
+        })
+    except DuplicateKeyError:
+        # A concurrent request subscribed the same email between the lookup and the insert
+        return {"message": "Already subscribed"}
     return {"message": "Subscribed successfully"}
 
 # ==================== DESTINATIONS ====================
 
 @api_router.get("/destinations/popular")
-async def get_popular_destinations():
-    return [
-        {"name": "Paris, France", "image": "https://images.unsplash.com/photo-1502602898657-3e91760cbb34?w=800", "tagline": "City of Lights", "rating": 4.9},
-        {"name": "Tokyo, Japan", "image": "https://images.unsplash.com/photo-1540959733332-eab4deabeeaf?w=800", "tagline": "Where tradition meets future", "rating": 4.8},
-        {"name": "Bali, Indonesia", "image": "https://images.unsplash.com/photo-1537996194471-e657df975ab4?w=800", "tagline": "Island of the Gods", "rating": 4.9},
-        {"name": "New York, USA", "image": "https://images.unsplash.com/photo-1496442226666-8d4d0e62e6e9?w=800", "tagline": "The city that never sleeps", "rating": 4.7},
-        {"name": "Santorini, Greece", "image": "https://images.unsplash.com/photo-1570077188670-e3a8d69ac5ff?w=800", "tagline": "Aegean gem", "rating": 4.9},
-        {"name": "Dubai, UAE", "image": "https://images.unsplash.com/photo-1512453979798-5ea266f8880c?w=800", "tagline": "Future reimagined", "rating": 4.8},
-        {"name": "Maldives", "image": "https://images.unsplash.com/photo-1514282401047-d79a71a590e8?w=800", "tagline": "Paradise on Earth", "rating": 4.9},
-        {"name": "Rome, Italy", "image": "https://images.unsplash.com/photo-1552832230-c0197dd311b5?w=800", "tagline": "Eternal City", "rating": 4.8}
+async def get_popular_destinations(request: Request):
+    return static_response(request, STATIC_PAYLOADS["destinations"])
+
+# ==================== DATABASE INDEXES ====================
+
+# (keys, options) per collection; create_index is idempotent so this runs on every startup
+MONGO_INDEXES = {
+    "users": [
+        ([("email", ASCENDING)], {"unique": True}),
+        ([("id", ASCENDING)], {"unique": True})
+    ],
+    "trips": [
+        ([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], {}),
+        ([("id", ASCENDING), ("user_id", ASCENDING)], {})
+    ],
+    "trip_days": [
+        ([("trip_id", ASCENDING), ("user_id", ASCENDING), ("day_number", ASCENDING)], {})
+    ],
+    "newsletter": [
+        ([("email", ASCENDING)], {"unique": True})
+    ],
+    "trip_cache": [
+        ([("key", ASCENDING)], {"unique": True}),
+        ([("expires_at", ASCENDING)], {"expireAfterSeconds": 0})
+    ],
+    "trip_jobs": [
+        ([("id", ASCENDING)], {"unique": True}),
+        ([("status", ASCENDING), ("created_at", ASCENDING)], {})
     ]
+}
+
+# Hot queries checked with explain() in self-check mode: (collection, filter, sort)
+HOT_QUERIES = [
+    ("users", {"email": "self-check@example.com"}, None),
+    ("users", {"id": "self-check"}, None),
+    ("trips", {"user_id": "self-check"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("trips", {"id": "self-check", "user_id": "self-check"}, None),
+    ("trip_days", {"trip_id": "self-check", "user_id": "self-check"}, [("day_number", ASCENDING)]),
+    ("newsletter", {"email": "self-check@example.com"}, None),
+    ("trip_jobs", {"id": "self-check"}, None)
+]
+
+async def ensure_indexes():
+    """Create the indexes every hot query relies on"""
+    for collection, indexes in MONGO_INDEXES.items():
+        for keys, options in indexes:
+            try:
+                await db[collection].create_index(keys, **options)
+            except Exception as e:
+                logger.warning(f"Could not create index {keys} on {collection}: {str(e)}")
+
+def _plan_stages(plan: Any) -> List[str]:
+    if isinstance(plan, dict):
+        stages = [plan["stage"]] if "stage" in plan else []
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in _plan_stages(item)]
+    return []
+
+async def verify_query_plans() -> List[dict]:
+    """Explain each hot query and warn about any that fall back to a collection scan"""
+    report = []
+    for collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explained = await cursor.explain()
+        except Exception as e:
+            logger.warning(f"explain() failed for {collection} {query}: {str(e)}")
+            continue
+        stages = _plan_stages(explained.get("queryPlanner", {}).get("winningPlan", {}))
+        collscan = "COLLSCAN" in stages
+        if collscan:
+            logger.warning(f"Query on {collection} with {list(query)} uses COLLSCAN")
+        report.append({"collection": collection, "fields": list(query), "stages": stages, "collscan": collscan})
+    return report
 
 # ==================== HEALTH ====================
 
@@ -885,6 +4530,21 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@api_router.get("/metrics")
+async def get_metrics():
+    """Runtime counters for caches and generation pipeline"""
+    return {
+        "trip_cache": trip_cache.stats(),
+        "trip_coalescing": trip_singleflight.stats(),
+        "trip_jobs": trip_jobs.stats(),
+        "converted_trip_cache": converted_trip_cache.stats(),
+        "password_hashing": password_hasher.stats(),
+        "user_cache": user_cache.stats(),
+        "packing_cache": packing_cache.stats(),
+        "llm": llm_client.stats(),
+        "trip_reuse": trip_reuse_index.stats()
+    }
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -893,8 +4553,22 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
+@app.on_event("startup")
+async def bootstrap_database():
+    await ensure_indexes()
+    if DB_INDEX_SELF_CHECK:
+        await verify_query_plans()
+
+@app.on_event("startup")
+async def start_trip_job_workers():
+    await trip_jobs.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await trip_jobs.stop()
+    password_hasher.executor.shutdown(wait=False)
+    await llm_client.close()
     client.close()
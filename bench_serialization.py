@@ -0,0 +1,79 @@
+"""
+Odyssey - trip serialization benchmark
+Compares FastAPI's default path (jsonable_encoder + stdlib json) with orjson
+on representative 30-day trip documents. Run: python bench_serialization.py
+"""
+import os
+import sys
+import json
+import time
+import statistics
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "odyssey_bench")
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+import server
+
+
+def build_trip(days=30):
+    """30-day, 5-destination trip with realistic section sizes"""
+    request = server.TripRequest(
+        departure_location="New York",
+        destinations=["Paris", "Rome", "Barcelona", "Amsterdam", "London"],
+        start_date="2026-06-01",
+        end_date=(date(2026, 6, 1) + timedelta(days=days - 1)).isoformat(),
+        budget=25000,
+        travelers=server.TravelerDetails(adults=2, children_above_10=1),
+        interests=["museums", "food", "hiking"],
+        fitness_interests=["running"],
+    )
+    trip = server.generate_fallback_trip(request, days, 3)
+    for day in trip["itinerary"]:
+        activity = day["morning_activities"][0]
+        for slot in ("morning_activities", "afternoon_activities", "evening_activities"):
+            day[slot] = [dict(activity, name=f"{slot} {n}") for n in range(3)]
+        day["restaurants"] = [dict(day["restaurants"][0], name=f"Restaurant {n}") for n in range(4)]
+    trip["hotels"] = [{"name": f"Hotel {n}", "location": "Center", "rating": 4.5, "price_per_night": 180,
+                       "amenities": ["wifi", "pool", "gym", "breakfast"], "booking_link": "https://booking.com"}
+                      for n in range(5)]
+    return trip
+
+
+def measure(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "p50": statistics.median(samples),
+        "p99": samples[int(len(samples) * 0.99) - 1],
+    }
+
+
+def main(iterations=500):
+    trip = build_trip()
+    encoded = orjson.dumps(trip)
+    print(f"Trip payload: {len(trip['itinerary'])} days, {len(encoded) / 1024:.1f} KiB")
+
+    cases = {
+        "jsonable_encoder + json": lambda: json.dumps(
+            jsonable_encoder(trip), ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8"),
+        "orjson": lambda: orjson.dumps(trip),
+        "json.loads": lambda: json.loads(encoded),
+        "orjson.loads": lambda: orjson.loads(encoded),
+    }
+    for name, fn in cases.items():
+        result = measure(fn, iterations)
+        print(f"{name:<26} p50={result['p50']:.3f} ms  p99={result['p99']:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
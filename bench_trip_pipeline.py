@@ -0,0 +1,82 @@
+"""
+Odyssey - trip generation load test
+Drives /api/trips/generate on a running backend and reports throughput and tail
+latency. Start the backend against the stub LLM so no tokens are spent, e.g.:
+
+    LLM_PROVIDER=stub LLM_STUB_LATENCY=lognormal:2.0:0.5 LLM_STUB_MALFORMED_RATE=0.05 \
+        uvicorn server:app --app-dir backend --port 8001
+
+Run: python bench_trip_pipeline.py [--url http://localhost:8001] [--requests 200] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import date, timedelta
+
+import httpx
+
+
+DESTINATION_SETS = [
+    ["Paris"],
+    ["Tokyo", "Kyoto"],
+    ["Rome", "Florence", "Venice"],
+    ["Bangkok", "Phuket"],
+]
+
+
+def build_request(n, days):
+    """Vary the start date per request so every call misses the trip cache"""
+    start = date(2027, 1, 1) + timedelta(days=n)
+    return {
+        "departure_location": "New York",
+        "destinations": DESTINATION_SETS[n % len(DESTINATION_SETS)],
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=days - 1)).isoformat(),
+        "budget": 5000,
+        "currency": "USD",
+        "travelers": {"adults": 2},
+        "passport_countries": ["India"],
+    }
+
+
+async def run(url, total, concurrency, days):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(base_url=url, timeout=300) as client:
+        async def one(n):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/api/trips/generate", json=build_request(n, days))
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(n) for n in range(total)))
+        elapsed = time.perf_counter() - started
+        metrics = (await client.get("/api/metrics")).json()
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+    print(f"{total} requests, concurrency {concurrency}, {days}-day trips")
+    print(f"throughput  {total / elapsed:.2f} req/s, errors {errors}")
+    print(f"latency     p50={statistics.median(latencies):.2f}s  p95={pct(0.95):.2f}s  p99={pct(0.99):.2f}s  max={latencies[-1]:.2f}s")
+    print(f"llm         {metrics.get('llm')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--days", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.requests, args.concurrency, args.days))
+
+
+if __name__ == "__main__":
+    main()
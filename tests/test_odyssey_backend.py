@@ -6,9 +6,39 @@ import pytest
 import requests
 import os
 import uuid
+import json
+import time
+import datetime
+import asyncio
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://travel-planner-169.preview.emergentagent.com')
 
+@pytest.fixture
+def auth_headers():
+    response = requests.post(f"{BASE_URL}/api/auth/register", json={
+        "email": f"test_{uuid.uuid4().hex[:8]}@example.com",
+        "password": "testpass123",
+        "name": "Test User"
+    })
+    return {"Authorization": f"Bearer {response.json()['token']}"}
+
+@pytest.fixture
+def server(monkeypatch):
+    """The backend module imported in-process, for unit tests of internals the HTTP API cannot reach"""
+    monkeypatch.setenv("MONGO_URL", os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    monkeypatch.setenv("DB_NAME", os.environ.get("DB_NAME", "odyssey_test"))
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(__file__), "..", "backend"))
+    return pytest.importorskip("server")
+
+@pytest.fixture
+def stub_llm(server, monkeypatch):
+    """Route in-process LLM calls to the instant stub provider"""
+    client = server.LLMClient(server.StubProvider("fixed:0", 0, 0, 0, 0))
+    monkeypatch.setattr(server, "llm_client", client)
+    monkeypatch.setattr(server, "LLM_MAX_RETRIES", 0)
+    return client
+
+
 class TestHealthEndpoints:
     """Health check and basic API tests"""
     
@@ -46,6 +76,20 @@ class TestCountriesAPI:
         assert "name" in country
         assert "flag" in country
     
+    def test_countries_etag_not_modified(self):
+        response = requests.get(f"{BASE_URL}/api/countries")
+        assert response.status_code == 200
+        assert "max-age" in response.headers["Cache-Control"]
+        etag = response.headers["ETag"]
+        response = requests.get(f"{BASE_URL}/api/countries", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+    
+    def test_countries_gzip(self):
+        response = requests.get(f"{BASE_URL}/api/countries", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert len(response.json()) > 50
+    
     def test_us_country_exists(self):
         response = requests.get(f"{BASE_URL}/api/countries")
         assert response.status_code == 200
@@ -112,6 +156,47 @@ class TestCurrencyConversion:
         assert response.status_code == 200
         data = response.json()
         assert data["converted"] > 8000  # INR rate is ~83
+    
+    def test_batch_convert_amounts(self):
+        response = requests.post(f"{BASE_URL}/api/convert-currency/batch", json={
+            "from_curr": "USD",
+            "to_curr": "EUR",
+            "amounts": [100, 250.5, 0]
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["converted"]) == 3
+        assert data["converted"][0] == 92.0
+        assert data["converted"][2] == 0
+    
+    def test_batch_convert_trip(self):
+        trip = {
+            "currency": "USD",
+            "budget": 1000,
+            "hotels": [{"name": "Hotel", "price_per_night": 100}],
+            "itinerary": [{"day_number": 1, "estimated_cost": 50, "morning_activities": [{"name": "Tour", "cost": 10}]}]
+        }
+        response = requests.post(f"{BASE_URL}/api/convert-currency/batch", json={"to_curr": "EUR", "trip": trip})
+        assert response.status_code == 200
+        converted = response.json()["trip"]
+        assert converted["currency"] == "EUR"
+        assert converted["budget"] == 920.0
+        assert converted["hotels"][0]["price_per_night"] == 92.0
+        assert converted["itinerary"][0]["morning_activities"][0]["cost"] == 9.2
+    
+    def test_batch_requires_payload(self):
+        response = requests.post(f"{BASE_URL}/api/convert-currency/batch", json={"to_curr": "EUR"})
+        assert response.status_code == 400
+    
+    def test_batch_unsupported_currency(self):
+        response = requests.post(f"{BASE_URL}/api/convert-currency/batch", json={
+            "from_curr": "USD",
+            "to_curr": "XYZ",
+            "amounts": [100]
+        })
+        assert response.status_code == 400
+        response = requests.post(f"{BASE_URL}/api/convert-currency/batch", json={"to_curr": "EUR", "trip": {"currency": "XYZ", "budget": 100}})
+        assert response.status_code == 400
 
 
 class TestCityAutocomplete:
@@ -143,6 +228,24 @@ class TestCityAutocomplete:
         assert london is not None
         assert london["country"] == "United Kingdom"
     
+    def test_autocomplete_airport_code(self):
+        response = requests.get(f"{BASE_URL}/api/autocomplete/cities?q=JFK")
+        assert response.status_code == 200
+        data = response.json()
+        assert data[0]["city"] == "New York"
+    
+    def test_autocomplete_alternate_name(self):
+        response = requests.get(f"{BASE_URL}/api/autocomplete/cities?q=bombay")
+        assert response.status_code == 200
+        data = response.json()
+        assert data[0]["city"] == "Mumbai"
+    
+    def test_autocomplete_accent_folding(self):
+        response = requests.get(f"{BASE_URL}/api/autocomplete/cities?q=cancún")
+        assert response.status_code == 200
+        data = response.json()
+        assert data[0]["city"] == "Cancun"
+    
     def test_autocomplete_short_query(self):
         """Short queries should return default cities"""
         response = requests.get(f"{BASE_URL}/api/autocomplete/cities?q=a")
@@ -173,6 +276,20 @@ class TestVisaRequirements:
         data = response.json()
         assert data["visa_required"] == False
         assert data["type"] == "citizen"
+    
+    def test_visa_batch(self):
+        payload = {"passport_countries": ["US", "IN"], "destination_countries": ["FR", "JP", "US"]}
+        response = requests.post(f"{BASE_URL}/api/visa-requirements/batch", json=payload)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert len(results) == 6
+        pairs = {(r["passport_country"], r["destination_country"]): r for r in results}
+        assert pairs[("US", "US")]["type"] == "citizen"
+        assert pairs[("US", "FR")]["visa_required"] == False
+    
+    def test_visa_batch_requires_pairs(self):
+        response = requests.post(f"{BASE_URL}/api/visa-requirements/batch", json={"passport_countries": [], "destination_countries": ["FR"]})
+        assert response.status_code == 400
 
 
 class TestPopularDestinations:
@@ -234,6 +351,71 @@ class TestBaggageInfo:
         assert "checked" in data
 
 
+class TestPackingList:
+    """Tests for /api/generate-packing-list endpoint"""
+    
+    def test_cold_hiking_checklist(self):
+        response = requests.post(
+            f"{BASE_URL}/api/generate-packing-list",
+            params={"destination": "Reykjavik", "duration": 10, "weather": "Cold and snowy"},
+            json={"activities": ["Hiking"], "travelers": {"adults": 2}}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        items = {entry["item"]: entry["quantity"] for entries in data.values() for entry in entries}
+        assert items["Underwear"] == 12
+        assert items["T-shirts/Tops"] == 7
+        assert "Warm jacket/Coat" in items
+        assert "Hiking boots" in items
+        assert "Swimsuit" not in items
+    
+    def test_cold_weather_overrides_hot(self):
+        response = requests.post(
+            f"{BASE_URL}/api/generate-packing-list",
+            params={"destination": "Cairo", "duration": 5, "weather": "hot days, cold nights"},
+            json={"activities": [], "travelers": {"adults": 1}}
+        )
+        assert response.status_code == 200
+        items = [entry["item"] for entries in response.json().values() for entry in entries]
+        assert "Warm jacket/Coat" in items
+        assert "Swimsuit" not in items
+        assert "Insect repellent (DEET)" not in items
+    
+    def test_zero_day_quantities(self):
+        response = requests.post(
+            f"{BASE_URL}/api/generate-packing-list",
+            params={"destination": "Paris", "duration": 0},
+            json={"activities": [], "travelers": {"adults": 1}}
+        )
+        assert response.status_code == 200
+        clothing = {entry["item"]: entry["quantity"] for entry in response.json()["clothing"]}
+        assert clothing["T-shirts/Tops"] == 0
+        assert clothing["Underwear"] == 2
+    
+    def test_infant_items(self):
+        response = requests.post(
+            f"{BASE_URL}/api/generate-packing-list",
+            params={"destination": "Paris", "duration": 4},
+            json={"activities": [], "travelers": {"adults": 2, "infants": 1}}
+        )
+        assert response.status_code == 200
+        family = {entry["item"]: entry["quantity"] for entry in response.json()["family"]}
+        assert family["Diapers"] == 24
+    
+    def test_traveler_scaled_items(self):
+        response = requests.post(
+            f"{BASE_URL}/api/generate-packing-list",
+            params={"destination": "Paris", "duration": 4},
+            json={"activities": [], "travelers": {"adults": 2, "children_below_10": 2, "seniors": 1, "infants": 1}}
+        )
+        assert response.status_code == 200
+        items = {entry["item"]: entry["quantity"] for entries in response.json().values() for entry in entries}
+        assert items["Games/Activity books"] == 2
+        assert items["Medication organizer"] == 1
+        assert items["Compression socks for flights"] == 1
+        assert all(quantity > 0 for quantity in items.values())
+
+
 class TestAuthEndpoints:
     """Tests for authentication endpoints"""
     
@@ -273,6 +455,20 @@ class TestAuthEndpoints:
         })
         assert response.status_code == 401
     
+    def test_me_with_token(self):
+        unique_email = f"test_{uuid.uuid4().hex[:8]}@example.com"
+        token = requests.post(f"{BASE_URL}/api/auth/register", json={
+            "email": unique_email,
+            "password": "testpass123",
+            "name": "Test User"
+        }).json()["token"]
+        response = requests.get(f"{BASE_URL}/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["email"] == unique_email
+        assert data["name"] == "Test User"
+        assert "password" not in data
+    
     def test_me_without_token(self):
         response = requests.get(f"{BASE_URL}/api/auth/me")
         assert response.status_code in [401, 403]
@@ -301,6 +497,56 @@ class TestContactAndNewsletter:
         data = response.json()
         assert "message" in data
 
+    def test_newsletter_subscribe_twice(self):
+        unique_email = f"newsletter_{uuid.uuid4().hex[:8]}@test.com"
+        requests.post(f"{BASE_URL}/api/newsletter/subscribe", json={"email": unique_email})
+        response = requests.post(f"{BASE_URL}/api/newsletter/subscribe", json={"email": unique_email})
+        assert response.status_code == 200
+        assert response.json()["message"] == "Already subscribed"
+
+
+class TestMongoIndexes:
+    """In-process tests of index creation and the explain() self-check; need a reachable MONGO_URL"""
+    
+    async def connect(self, server, monkeypatch):
+        client = server.AsyncIOMotorClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=2000)
+        try:
+            await client.admin.command("ping")
+        except Exception:
+            pytest.skip("MongoDB is not reachable")
+        monkeypatch.setattr(server, "db", client[os.environ["DB_NAME"]])
+        await server.ensure_indexes()
+        return client
+    
+    def test_hot_queries_avoid_collscan(self, server, monkeypatch):
+        async def scenario():
+            client = await self.connect(server, monkeypatch)
+            try:
+                return await server.verify_query_plans()
+            finally:
+                client.close()
+        
+        report = asyncio.run(scenario())
+        assert len(report) == len(server.HOT_QUERIES)
+        assert [entry for entry in report if entry["collscan"]] == []
+    
+    def test_concurrent_newsletter_subscribe(self, server, monkeypatch):
+        email = f"race_{uuid.uuid4().hex[:8]}@test.com"
+        
+        async def scenario():
+            client = await self.connect(server, monkeypatch)
+            try:
+                await server.db.newsletter.insert_one({"id": str(uuid.uuid4()), "email": email})
+                # The other request's insert lands after this one's lookup
+                async def not_found(*args, **kwargs):
+                    return None
+                monkeypatch.setattr(type(server.db.newsletter), "find_one", not_found)
+                return await server.subscribe_newsletter(server.NewsletterSubscribe(email=email))
+            finally:
+                client.close()
+        
+        assert asyncio.run(scenario()) == {"message": "Already subscribed"}
+
 
 class TestAirportsEndpoint:
     """Tests for /api/airports endpoint"""
@@ -315,5 +561,535 @@ class TestAirportsEndpoint:
         assert "EWR" in airport_codes
 
 
+class TestMetricsEndpoint:
+    """Tests for /api/metrics endpoint"""
+    
+    def test_metrics_has_trip_cache_counters(self):
+        response = requests.get(f"{BASE_URL}/api/metrics")
+        assert response.status_code == 200
+        data = response.json()
+        assert "trip_cache" in data
+        for field in ["entries", "memory_hits", "shared_hits", "misses", "hit_ratio"]:
+            assert field in data["trip_cache"]
+    
+    def test_metrics_has_coalescing_counters(self):
+        response = requests.get(f"{BASE_URL}/api/metrics")
+        assert response.status_code == 200
+        data = response.json()
+        assert "trip_coalescing" in data
+        for field in ["in_flight", "leaders", "coalesced"]:
+            assert field in data["trip_coalescing"]
+    
+    def test_metrics_has_password_hashing_pool(self):
+        response = requests.get(f"{BASE_URL}/api/metrics")
+        assert response.status_code == 200
+        data = response.json()
+        for field in ["workers", "rounds", "queued", "active", "avg_wait_ms"]:
+            assert field in data["password_hashing"]
+    
+    def test_metrics_has_llm_client_state(self):
+        response = requests.get(f"{BASE_URL}/api/metrics")
+        assert response.status_code == 200
+        data = response.json()
+        for field in ["provider", "calls", "retries", "retry_budget", "circuit_state", "short_circuited"]:
+            assert field in data["llm"]
+        assert data["llm"]["circuit_state"] in ["closed", "open", "half_open"]
+    
+    def test_metrics_has_trip_reuse_index(self):
+        response = requests.get(f"{BASE_URL}/api/metrics")
+        assert response.status_code == 200
+        data = response.json()
+        for field in ["entries", "lookups", "reuses", "reuse_ratio"]:
+            assert field in data["trip_reuse"]
+    
+    def test_reuse_index_degenerate_requests(self, server):
+        index = server.TripSimilarityIndex(10, 0.9, 0.2, 30)
+        trip_request = server.TripRequest(**dict(TestTripStreaming.trip_request, budget=0, start_date="2026-06-03", end_date="2026-06-01"))
+        assert index.daily_budget(trip_request) == pytest.approx(0.5)
+        index.add(trip_request, {"itinerary": []})
+        assert index.find(trip_request) is not None
+
+
+class TestLLMCircuitBreaker:
+    """In-process tests for the LLM client's circuit breaker and stream deadline"""
+    
+    def half_open_client(self, server, latency):
+        client = server.LLMClient(server.StubProvider(latency, 0, 0, 0, 0))
+        client.breaker.state = "open"
+        client.breaker.opened_at = time.monotonic() - client.breaker.cooldown_seconds
+        return client
+    
+    def test_cancelled_half_open_trial_releases_breaker(self, server):
+        async def consume(stream):
+            async for _ in stream:
+                pass
+        
+        async def scenario():
+            for call in (lambda c: c.complete("{}"), lambda c: consume(c.stream("{}"))):
+                client = self.half_open_client(server, "fixed:30")
+                task = asyncio.create_task(call(client))
+                await asyncio.sleep(0.05)
+                assert client.breaker.trial_in_flight
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+                assert client.breaker.state == "half_open"
+                assert client.breaker.allow()
+        
+        asyncio.run(scenario())
+    
+    def test_closed_stream_releases_breaker(self, server):
+        async def scenario():
+            client = self.half_open_client(server, "fixed:0")
+            stream = client.stream("{}")
+            await stream.__anext__()
+            await stream.aclose()
+            assert client.breaker.allow()
+        
+        asyncio.run(scenario())
+    
+    def test_stalled_stream_times_out(self, server, monkeypatch):
+        monkeypatch.setattr(server, "LLM_TIMEOUT_SECONDS", 0.05)
+        monkeypatch.setattr(server, "LLM_MAX_RETRIES", 0)
+        
+        async def scenario():
+            client = server.LLMClient(server.StubProvider("fixed:30", 0, 0, 0, 0))
+            with pytest.raises(asyncio.TimeoutError):
+                async for _ in client.stream("{}"):
+                    pass
+            assert client.timeouts == 1
+            assert client.breaker.failures == 1
+        
+        asyncio.run(scenario())
+
+
+class TestLLMJsonRepair:
+    """In-process tests for lenient parsing and salvage of malformed or truncated LLM output"""
+    
+    def test_truncated_string_drops_open_value(self, server):
+        trip, open_containers = server.repair_llm_json('{"title": "Paris", "local_tips": {"customs": ["Say bonj')
+        assert trip == {"title": "Paris"}
+        assert open_containers == 1
+    
+    def test_trailing_commas_removed(self, server):
+        trip, open_containers = server.repair_llm_json('{"title": "Paris", "flights": [1, 2,], }')
+        assert trip == {"title": "Paris", "flights": [1, 2]}
+        assert open_containers == 0
+    
+    def test_prose_and_fences_skipped(self, server):
+        assert server.repair_llm_json('Here you go:\n```json\n{"title": "T"}\n```\nEnjoy') == ({"title": "T"}, 0)
+        assert server.parse_llm_json('```json\n{"title": "T"}\n```') == {"title": "T"}
+    
+    def test_brackets_inside_strings_ignored(self, server):
+        trip, open_containers = server.repair_llm_json('{"title": "say \\"hi\\" {[", "flights": [1')
+        assert trip == {"title": 'say "hi" {['}
+        assert open_containers == 1
+    
+    def test_unclosed_nested_arrays_closed(self, server):
+        text = '{"title": "T", "itinerary": [{"day_number": 1, "morning_activities": [{"name": "A"}]}, {"day_number": 2, "morning_activities": [{"name": "B"}'
+        trip, open_containers = server.repair_llm_json(text)
+        assert [day["day_number"] for day in trip["itinerary"]] == [1, 2]
+        assert open_containers == 4
+    
+    def test_cut_off_itinerary_day_dropped(self, server):
+        text = '{"title": "T", "itinerary": [{"day_number": 1, "morning_activities": [{"name": "A"}]}, {"day_number": 2, "morning_activities": [{"name": "B"}'
+        trip = server.salvage_trip_json(text)
+        assert trip["title"] == "T"
+        assert [day["day_number"] for day in trip["itinerary"]] == [1]
+    
+    def test_cut_between_days_keeps_all_days(self, server):
+        trip = server.salvage_trip_json('{"title": "T", "itinerary": [{"day_number": 1}, {"day_number": 2}, ')
+        assert [day["day_number"] for day in trip["itinerary"]] == [1, 2]
+    
+    def test_cut_off_section_discarded(self, server):
+        trip = server.salvage_trip_json('{"title": "T", "hotels": [{"name": "A"}, {"name": "B", "rating": 4,')
+        assert trip == {"title": "T"}
+    
+    def test_no_json_rejected(self, server):
+        with pytest.raises(ValueError):
+            server.repair_llm_json("Sorry, I cannot help with that")
+        with pytest.raises(ValueError):
+            server.repair_llm_json('{"title": "unterminated')
+    
+    def test_complete_partial_trip_rerequests_missing_parts(self, server, stub_llm):
+        trip_request = server.TripRequest(**dict(TestTripStreaming.trip_request, start_date="2026-06-01", end_date="2026-06-04"))
+        sections = server.trip_sections(trip_request)
+        salvaged = server.salvage_trip_json('{"title": "T", "itinerary": [{"day_number": 1, "location": "Paris"}, {"day_number": 2, "location": "Par')
+        trip, complete = asyncio.run(server.complete_partial_trip(trip_request, salvaged, sections))
+        assert complete
+        assert [day["day_number"] for day in trip["itinerary"]] == [1, 2, 3, 4]
+        assert all(name in trip for name in sections)
+    
+    def test_complete_partial_trip_falls_back_when_llm_fails(self, server, stub_llm, monkeypatch):
+        monkeypatch.setattr(stub_llm.provider, "failure_rate", 1.0)
+        trip_request = server.TripRequest(**dict(TestTripStreaming.trip_request, start_date="2026-06-01", end_date="2026-06-04"))
+        sections = server.trip_sections(trip_request)
+        trip, complete = asyncio.run(server.complete_partial_trip(trip_request, {"itinerary": [{"day_number": 1}]}, sections))
+        assert not complete
+        assert len(trip["itinerary"]) == 4
+        assert all(name in trip for name in sections)
+
+
+class TestTripFanOut:
+    """In-process tests for splitting long trips into day windows and merging them back"""
+    
+    def fan_out_request(self, server, total_days):
+        start = "2026-07-01"
+        end = (datetime.date.fromisoformat(start) + datetime.timedelta(days=total_days - 1)).isoformat()
+        return server.TripRequest(**dict(TestTripStreaming.trip_request, destinations=["Paris", "Rome"], start_date=start, end_date=end))
+    
+    @pytest.mark.parametrize("total_days", [1, 7, 8, 30])
+    def test_windows_cover_every_day_once(self, server, total_days):
+        windows = server.plan_day_windows(self.fan_out_request(server, total_days), total_days)
+        covered = [day for window in windows for day in range(window["first_day"], window["last_day"] + 1)]
+        assert covered == list(range(1, total_days + 1))
+        for window in windows:
+            assert window["last_day"] - window["first_day"] < server.TRIP_FANOUT_DAY_WINDOW
+            first = datetime.date.fromisoformat("2026-07-01") + datetime.timedelta(days=window["first_day"] - 1)
+            assert window["start_date"] == first.isoformat()
+    
+    def test_failed_window_filled_from_offline_plan(self, server, stub_llm):
+        trip_request = self.fan_out_request(server, 12)
+        windows = server.plan_day_windows(trip_request, 12)
+        failed = windows[1]
+        
+        async def call(prompt):
+            if f"Plan ONLY days {failed['first_day']} to {failed['last_day']} " in prompt:
+                raise RuntimeError("window failed")
+            return server.parse_llm_json(await stub_llm.complete(prompt))
+        
+        window_days = asyncio.run(server.request_window_days(trip_request, 12, 2, windows, call))
+        assert window_days[1] == []
+        assert all(days for index, days in enumerate(window_days) if index != 1)
+        fallback = server.generate_fallback_trip(trip_request, 12, 2)
+        itinerary, complete = server.fill_window_days(trip_request, windows, window_days, fallback)
+        assert not complete
+        assert [day["day_number"] for day in itinerary] == list(range(1, 13))
+        for day in itinerary[failed["first_day"] - 1:failed["last_day"]]:
+            assert day["location"] == failed["location"]
+            assert day["morning_activities"] == fallback["itinerary"][day["day_number"] - 1]["morning_activities"]
+
+
+class TestTripStreaming:
+    """Tests for /api/trips/generate/stream endpoint"""
+    
+    trip_request = {
+        "departure_location": "New York",
+        "destinations": ["Paris"],
+        "start_date": "2026-06-01",
+        "end_date": "2026-06-03",
+        "budget": 3000,
+        "currency": "USD",
+        "travelers": {"adults": 2}
+    }
+    
+    def test_stream_ndjson_events(self):
+        response = requests.post(f"{BASE_URL}/api/trips/generate/stream", json=self.trip_request, timeout=180)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        events = [json.loads(line) for line in response.text.splitlines() if line]
+        assert events[0]["event"] == "meta"
+        assert events[-1]["event"] == "complete"
+        assert len(events[-1]["trip"]["itinerary"]) == 3
+        assert events[-1]["trip"]["packing_suggestions"]["legal_documents"]
+    
+    def test_plan_only_skips_flights_and_hotels(self):
+        trip_request = dict(self.trip_request, customer_type="plan_only", start_date="2026-06-02", end_date="2026-06-04")
+        response = requests.post(f"{BASE_URL}/api/trips/generate/stream", json=trip_request, timeout=180)
+        assert response.status_code == 200
+        events = [json.loads(line) for line in response.text.splitlines() if line]
+        trip = events[-1]["trip"]
+        assert trip["flights"] == []
+        assert trip["hotels"] == []
+        assert len(trip["itinerary"]) == 3
+
+    def test_days_have_distinct_activities(self):
+        trip_request = dict(self.trip_request, destinations=["Paris", "Rome"], start_date="2026-06-05", end_date="2026-06-08")
+        response = requests.post(f"{BASE_URL}/api/trips/generate/stream", json=trip_request, timeout=180)
+        assert response.status_code == 200
+        events = [json.loads(line) for line in response.text.splitlines() if line]
+        days = events[-1]["trip"]["itinerary"]
+        mornings = [tuple(activity["name"] for activity in day["morning_activities"]) for day in days]
+        assert len(set(mornings)) == len(days)
+        assert {day["location"] for day in days} == {"Paris", "Rome"}
+
+    def test_stream_matches_generate_budget_fit(self):
+        trip_request = dict(self.trip_request, budget=900, start_date="2026-06-10", end_date="2026-06-12")
+        response = requests.post(f"{BASE_URL}/api/trips/generate/stream", json=trip_request, timeout=180)
+        assert response.status_code == 200
+        streamed = [json.loads(line) for line in response.text.splitlines() if line][-1]["trip"]
+        generated = requests.post(f"{BASE_URL}/api/trips/generate", json=trip_request, timeout=180).json()
+        assert streamed["total_estimated_cost"] == generated["total_estimated_cost"]
+        assert streamed["itinerary"] == generated["itinerary"]
+
+    def test_stream_invalid_format(self):
+        response = requests.post(f"{BASE_URL}/api/trips/generate/stream?format=xml", json=self.trip_request)
+        assert response.status_code == 400
+
+
+class TestTripJobs:
+    """Tests for /api/trips/jobs background generation endpoints"""
+    
+    def test_create_and_poll_job(self):
+        response = requests.post(f"{BASE_URL}/api/trips/jobs", json=TestTripStreaming.trip_request)
+        assert response.status_code == 202
+        data = response.json()
+        assert data["status"] == "queued"
+        job_id = data["job_id"]
+        
+        response = requests.get(f"{BASE_URL}/api/trips/jobs/{job_id}")
+        assert response.status_code == 200
+        job = response.json()
+        assert job["id"] == job_id
+        assert job["status"] in ["queued", "running", "completed", "failed"]
+        assert "request" not in job
+    
+    def test_unknown_job(self):
+        response = requests.get(f"{BASE_URL}/api/trips/jobs/{uuid.uuid4()}")
+        assert response.status_code == 404
+    
+    def test_job_private_to_submitter(self, auth_headers):
+        response = requests.post(f"{BASE_URL}/api/trips/jobs", json=TestTripStreaming.trip_request, headers=auth_headers)
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+        assert requests.get(f"{BASE_URL}/api/trips/jobs/{job_id}").status_code == 404
+        response = requests.get(f"{BASE_URL}/api/trips/jobs/{job_id}", headers=auth_headers)
+        assert response.status_code == 200
+        assert "user_id" not in response.json()
+    
+    def test_metrics_has_job_queue(self):
+        response = requests.get(f"{BASE_URL}/api/metrics")
+        assert response.status_code == 200
+        data = response.json()
+        for field in ["queue_depth", "running", "avg_wait_seconds"]:
+            assert field in data["trip_jobs"]
+
+
+class TestTripCurrency:
+    """Tests for server-side currency conversion on /api/trips/{trip_id}"""
+    
+    def test_get_trip_in_other_currency(self, auth_headers):
+        trip_id = str(uuid.uuid4())
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json={
+            "id": trip_id,
+            "currency": "USD",
+            "budget": 1000,
+            "hotels": [{"name": "Hotel", "price_per_night": 100}],
+            "itinerary": []
+        })
+        response = requests.get(f"{BASE_URL}/api/trips/{trip_id}?currency=EUR", headers=auth_headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["currency"] == "EUR"
+        assert data["budget"] == 920.0
+        assert data["hotels"][0]["price_per_night"] == 92.0
+        
+        response = requests.get(f"{BASE_URL}/api/trips/{trip_id}", headers=auth_headers)
+        assert response.json()["budget"] == 1000
+    
+    def test_unsupported_currency(self, auth_headers):
+        response = requests.get(f"{BASE_URL}/api/trips/{uuid.uuid4()}?currency=XXX", headers=auth_headers)
+        assert response.status_code == 400
+
+
+class TestMyTripsPagination:
+    """Tests for summaries, cursor pagination and ETags on /api/trips/my-trips"""
+    
+    @pytest.fixture
+    def saved_trips(self, auth_headers):
+        for i in range(3):
+            requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json={
+                "id": str(uuid.uuid4()),
+                "title": f"Trip {i}",
+                "destinations": ["Paris"],
+                "created_at": f"2026-01-0{i + 1}T00:00:00+00:00",
+                "itinerary": [{"day_number": 1}]
+            })
+        return auth_headers
+    
+    def test_summary_and_pagination(self, saved_trips):
+        response = requests.get(f"{BASE_URL}/api/trips/my-trips?summary=true&limit=2", headers=saved_trips)
+        assert response.status_code == 200
+        first_page = response.json()
+        assert [t["title"] for t in first_page] == ["Trip 2", "Trip 1"]
+        assert "itinerary" not in first_page[0]
+        cursor = response.headers["X-Next-Cursor"]
+        
+        response = requests.get(f"{BASE_URL}/api/trips/my-trips?summary=true&limit=2&cursor={cursor}", headers=saved_trips)
+        assert response.status_code == 200
+        assert [t["title"] for t in response.json()] == ["Trip 0"]
+        assert "X-Next-Cursor" not in response.headers
+    
+    def test_etag_not_modified(self, saved_trips):
+        response = requests.get(f"{BASE_URL}/api/trips/my-trips", headers=saved_trips)
+        etag = response.headers["ETag"]
+        response = requests.get(f"{BASE_URL}/api/trips/my-trips", headers={**saved_trips, "If-None-Match": etag})
+        assert response.status_code == 304
+
+    def test_etag_list_weak_and_wildcard(self, saved_trips):
+        etag = requests.get(f"{BASE_URL}/api/trips/my-trips", headers=saved_trips).headers["ETag"]
+        for if_none_match in [f'"stale", {etag}', f"W/{etag}", "*"]:
+            response = requests.get(f"{BASE_URL}/api/trips/my-trips", headers={**saved_trips, "If-None-Match": if_none_match})
+            assert response.status_code == 304
+        response = requests.get(f"{BASE_URL}/api/trips/my-trips", headers={**saved_trips, "If-None-Match": '"stale"'})
+        assert response.status_code == 200
+
+    def test_resave_replaces_trip(self, auth_headers):
+        trip = {"id": str(uuid.uuid4()), "title": "Draft", "destinations": ["Paris"], "itinerary": [{"day_number": 1}]}
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json=trip)
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json=dict(trip, title="Final"))
+        response = requests.get(f"{BASE_URL}/api/trips/my-trips", headers=auth_headers)
+        assert [t["title"] for t in response.json()] == ["Final"]
+
+
+class TestTripDayRange:
+    """Tests for ranged itinerary loading on /api/trips/{trip_id}"""
+    
+    def test_get_day_range(self, auth_headers):
+        trip_id = str(uuid.uuid4())
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json={
+            "id": trip_id,
+            "total_days": 5,
+            "itinerary": [{"day_number": n} for n in range(1, 6)]
+        })
+        response = requests.get(f"{BASE_URL}/api/trips/{trip_id}?days=2-3", headers=auth_headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert [d["day_number"] for d in data["itinerary"]] == [2, 3]
+        assert data["itinerary_range"] == {"first": 2, "last": 3, "total": 5}
+    
+    def test_invalid_day_range(self, auth_headers):
+        response = requests.get(f"{BASE_URL}/api/trips/{uuid.uuid4()}?days=3-1", headers=auth_headers)
+        assert response.status_code == 400
+
+
+class TestTripRebalance:
+    """Tests for /api/trips/{trip_id}/rebalance budget fitting"""
+
+    def test_rebalance_fits_budget(self, auth_headers):
+        trip_id = str(uuid.uuid4())
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json={
+            "id": trip_id,
+            "currency": "USD",
+            "budget": 5000,
+            "travelers": {"adults": 2},
+            "hotels": [
+                {"name": "Grand Palace Hotel", "location": "Paris", "rating": 5, "price_per_night": 900},
+                {"name": "Hotel Centre", "location": "Paris", "rating": 3, "price_per_night": 120}
+            ],
+            "itinerary": [
+                {"day_number": n, "location": "Paris", "morning_activities": [{"name": "Private tour", "cost": 500}]}
+                for n in range(1, 4)
+            ]
+        })
+        response = requests.post(f"{BASE_URL}/api/trips/{trip_id}/rebalance", headers=auth_headers, json={"budget": 1200})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["within_budget"]
+        assert data["total_estimated_cost"] <= 1200
+
+        saved = requests.get(f"{BASE_URL}/api/trips/{trip_id}", headers=auth_headers).json()
+        assert saved["budget"] == 1200
+        assert saved["total_estimated_cost"] == data["total_estimated_cost"]
+
+    def test_lodging_follows_customer_type(self, server):
+        itinerary = [{"day_number": n, "location": "Paris"} for n in range(1, 4)]
+        
+        def fixed_cost(**fields):
+            trip = {"currency": "USD", "travelers": {"adults": 2}, "itinerary": itinerary, **fields}
+            return server.TripBudget(trip).fixed_cost
+        
+        assert fixed_cost(customer_type="partial") == fixed_cost(customer_type="fresh") > 0
+        assert fixed_cost(customer_type="plan_only") == 0
+        assert fixed_cost(customer_type="partial", existing_bookings={"has_hotel": True}) == 0
+
+    def test_party_costs_scale_with_travelers(self, server):
+        def plan(adults):
+            trip_request = server.TripRequest(**dict(TestTripStreaming.trip_request, budget=100000, travelers={"adults": adults}, fitness_interests=["Gym Access"]))
+            return trip_request, server.generate_fallback_trip(trip_request, 3, adults)
+        
+        _, solo = plan(1)
+        pair_request, pair = plan(2)
+        for one, two in zip(solo["itinerary"], pair["itinerary"]):
+            assert two["fitness_activities"][0]["cost"] == 2 * one["fitness_activities"][0]["cost"] > 0
+            assert abs(two["estimated_cost"] - 2 * one["estimated_cost"]) <= 1
+        
+        entry = {"trip": solo, "start_date": pair_request.start_date, "currency": "USD", "travelers": 1}
+        adapted = server.adapt_reused_trip(entry, pair_request)
+        for day, expected in zip(adapted["itinerary"], pair["itinerary"]):
+            assert day["fitness_activities"][0]["cost"] == expected["fitness_activities"][0]["cost"]
+            assert abs(day["estimated_cost"] - expected["estimated_cost"]) <= 1
+        adapted["travelers"] = pair["travelers"]
+        assert abs(server.TripBudget(adapted).current_total() - server.TripBudget(pair).current_total()) <= 10
+
+    def test_rebalance_without_body(self, auth_headers):
+        trip_id = str(uuid.uuid4())
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json={
+            "id": trip_id,
+            "currency": "USD",
+            "budget": 2000,
+            "travelers": {"adults": 1},
+            "itinerary": [{"day_number": 1, "location": "Paris", "morning_activities": [{"name": "Louvre Museum", "cost": 25}]}]
+        })
+        response = requests.post(f"{BASE_URL}/api/trips/{trip_id}/rebalance", headers=auth_headers)
+        assert response.status_code == 200
+        assert response.json()["budget"] == 2000
+
+    def test_rebalance_unknown_trip(self, auth_headers):
+        response = requests.post(f"{BASE_URL}/api/trips/{uuid.uuid4()}/rebalance", headers=auth_headers, json={})
+        assert response.status_code == 404
+
+
+
+class TestTripEditing:
+    """Tests for regenerating a single day of a saved trip"""
+
+    def test_regenerate_day(self, auth_headers):
+        trip_id = str(uuid.uuid4())
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json={
+            "id": trip_id,
+            "currency": "USD",
+            "budget": 2000,
+            "destinations": ["Rome"],
+            "start_date": "2026-09-01",
+            "end_date": "2026-09-02",
+            "travelers": {"adults": 2},
+            "itinerary": [
+                {"day_number": n, "location": "Rome", "morning_activities": [{"name": f"Walk {n}", "cost": 0}]}
+                for n in range(1, 3)
+            ]
+        })
+        response = requests.post(f"{BASE_URL}/api/trips/{trip_id}/days/2/regenerate", headers=auth_headers, json={"instructions": "More art"}, timeout=180)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["day"]["day_number"] == 2
+        assert data["day"]["date"] == "2026-09-02"
+
+        saved = requests.get(f"{BASE_URL}/api/trips/{trip_id}", headers=auth_headers).json()
+        assert saved["itinerary"][1] == data["day"]
+        assert saved["itinerary"][0]["morning_activities"][0]["name"] == "Walk 1"
+        assert saved["total_estimated_cost"] == data["total_estimated_cost"]
+
+    def test_regenerate_missing_day(self, auth_headers):
+        trip_id = str(uuid.uuid4())
+        requests.post(f"{BASE_URL}/api/trips/save", headers=auth_headers, json={"id": trip_id, "itinerary": [{"day_number": 1}]})
+        response = requests.post(f"{BASE_URL}/api/trips/{trip_id}/days/5/regenerate", headers=auth_headers)
+        assert response.status_code == 404
+
+    def test_offline_day_keeps_trip_preferences(self, server, monkeypatch):
+        trip_request = server.TripRequest(**dict(TestTripStreaming.trip_request, interests=["Museums"], fitness_interests=["Yoga Classes"], accommodation_type="budget"))
+        trip = server.generate_fallback_trip(trip_request, 3, 2)
+        planned = []
+        plan = server.plan_offline_itinerary
+        monkeypatch.setattr(server, "plan_offline_itinerary", lambda day_request, *args: planned.append(day_request) or plan(day_request, *args))
+        
+        server.plan_offline_day(trip, 2, server.TripEditRequest())
+        server.plan_offline_day(trip, 2, server.TripEditRequest(interests=["Food"], accommodation_type="boutique"))
+        assert [(r.interests, r.fitness_interests, r.accommodation_type) for r in planned] == [
+            (["Museums"], ["Yoga Classes"], "budget"),
+            (["Food"], ["Yoga Classes"], "boutique")
+        ]
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])